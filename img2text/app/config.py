@@ -1,6 +1,8 @@
 import os
-from dataclasses import dataclass
-from typing import Optional
+from dataclasses import dataclass, field
+from typing import Dict, Optional
+
+from .scheduler import parse_weights
 
 @dataclass
 class Config:
@@ -14,10 +16,87 @@ class Config:
     batch_size: int = 10
     use_gpu: bool = True
     
+    # Decoding settings
+    decoding_strategy: str = "greedy"
+    max_new_tokens: int = 50
+    num_beams: int = 3
+    early_stopping: bool = True
+    temperature: float = 1.0
+    top_p: float = 0.9
+    top_k: int = 50
+    compute_confidence: bool = False
+    
+    # CPU performance settings
+    cpu_optimize: bool = False
+    vision_encoder_mode: str = "eager"
+    intra_op_threads: Optional[int] = None
+    inter_op_threads: Optional[int] = None
+    accuracy_check_samples: int = 16
+    min_caption_agreement: float = 0.9
+    
+    # Model loading settings
+    model_cache_dir: Optional[str] = None
+    model_snapshot_dir: Optional[str] = None
+    offline: bool = False
+    
+    # Number of worker processes, each with its own model
+    workers: int = 1
+    
+    # Prefetch settings
+    prefetch_workers: int = 4
+    prefetch_queue_size: int = 32
+    
+    # Work fetching settings
+    fetch_page_size: int = 500
+    resume: bool = True
+    
+    # Work leasing settings
+    use_leases: bool = True
+    lease_seconds: int = 900
+    worker_id: Optional[str] = None
+    
+    # Create indexes for the pending-work queries at startup
+    ensure_indexes: bool = True
+    
+    # MongoDB write-back settings
+    write_batch_size: int = 100
+    write_flush_interval: float = 1.0
+    
+    # Duplicate detection settings
+    dedup: bool = True
+    dedup_max_distance: int = 3
+    caption_cache_ttl_seconds: int = 30 * 24 * 3600
+    caption_cache_max_entries: int = 1_000_000
+    
+    # Vision embedding cache settings
+    embedding_cache_dir: Optional[str] = None
+    embedding_cache_dtype: str = "float16"
+    
+    # Metrics settings
+    metrics_port: Optional[int] = None
+    metrics_dump_path: Optional[str] = None
+    
+    # Priority and fair-share scheduling settings
+    priority_scheduling: bool = False
+    fair_share_field: str = "dataset_id"
+    fair_share_weights: Dict[str, float] = field(default_factory=dict)
+    priority_age_boost_seconds: float = 600.0
+    
+    # Profiling settings; 0 batches disables the profiler
+    profile_batches: int = 0
+    profile_dir: str = "profiles"
+    
     # Optional settings
     dataset_id: Optional[str] = None
     callback_url: Optional[str] = None
     
+    # Callback delivery settings
+    callback_batch_size: int = 50
+    callback_flush_interval: float = 1.0
+    callback_timeout: float = 10.0
+    callback_max_retries: int = 5
+    callback_spill_path: Optional[str] = "callback_spill.jsonl"
+    
     @classmethod
     def from_env(cls) -> 'Config':
         """Create configuration from environment variables."""
@@ -26,8 +105,55 @@ class Config:
             model_name=os.getenv('MODEL_NAME', cls.model_name),
             batch_size=int(os.getenv('BATCH_SIZE', cls.batch_size)),
             use_gpu=os.getenv('USE_GPU', 'true').lower() == 'true',
+            decoding_strategy=os.getenv('DECODING_STRATEGY', cls.decoding_strategy),
+            max_new_tokens=int(os.getenv('MAX_NEW_TOKENS', cls.max_new_tokens)),
+            num_beams=int(os.getenv('NUM_BEAMS', cls.num_beams)),
+            early_stopping=os.getenv('EARLY_STOPPING', 'true').lower() == 'true',
+            temperature=float(os.getenv('TEMPERATURE', cls.temperature)),
+            top_p=float(os.getenv('TOP_P', cls.top_p)),
+            top_k=int(os.getenv('TOP_K', cls.top_k)),
+            compute_confidence=os.getenv('COMPUTE_CONFIDENCE', 'false').lower() == 'true',
+            cpu_optimize=os.getenv('CPU_OPTIMIZE', 'false').lower() == 'true',
+            vision_encoder_mode=os.getenv('VISION_ENCODER_MODE', cls.vision_encoder_mode),
+            intra_op_threads=int(os.getenv('INTRA_OP_THREADS', 0)) or None,
+            inter_op_threads=int(os.getenv('INTER_OP_THREADS', 0)) or None,
+            accuracy_check_samples=int(os.getenv('ACCURACY_CHECK_SAMPLES', cls.accuracy_check_samples)),
+            min_caption_agreement=float(os.getenv('MIN_CAPTION_AGREEMENT', cls.min_caption_agreement)),
+            model_cache_dir=os.getenv('MODEL_CACHE_DIR'),
+            model_snapshot_dir=os.getenv('MODEL_SNAPSHOT_DIR'),
+            offline=os.getenv('HF_HUB_OFFLINE', 'false').lower() in ('1', 'true'),
+            workers=int(os.getenv('WORKERS', cls.workers)),
+            prefetch_workers=int(os.getenv('PREFETCH_WORKERS', cls.prefetch_workers)),
+            prefetch_queue_size=int(os.getenv('PREFETCH_QUEUE_SIZE', cls.prefetch_queue_size)),
+            fetch_page_size=int(os.getenv('FETCH_PAGE_SIZE', cls.fetch_page_size)),
+            resume=os.getenv('RESUME', 'true').lower() == 'true',
+            use_leases=os.getenv('USE_LEASES', 'true').lower() == 'true',
+            lease_seconds=int(os.getenv('LEASE_SECONDS', cls.lease_seconds)),
+            worker_id=os.getenv('WORKER_ID'),
+            ensure_indexes=os.getenv('ENSURE_INDEXES', 'true').lower() == 'true',
+            write_batch_size=int(os.getenv('WRITE_BATCH_SIZE', cls.write_batch_size)),
+            write_flush_interval=float(os.getenv('WRITE_FLUSH_INTERVAL', cls.write_flush_interval)),
+            dedup=os.getenv('DEDUP', 'true').lower() == 'true',
+            dedup_max_distance=int(os.getenv('DEDUP_MAX_DISTANCE', cls.dedup_max_distance)),
+            caption_cache_ttl_seconds=int(os.getenv('CAPTION_CACHE_TTL', cls.caption_cache_ttl_seconds)),
+            caption_cache_max_entries=int(os.getenv('CAPTION_CACHE_MAX_ENTRIES', cls.caption_cache_max_entries)),
+            embedding_cache_dir=os.getenv('EMBEDDING_CACHE_DIR'),
+            embedding_cache_dtype=os.getenv('EMBEDDING_CACHE_DTYPE', cls.embedding_cache_dtype),
+            metrics_port=int(os.getenv('METRICS_PORT', 0)) or None,
+            metrics_dump_path=os.getenv('METRICS_DUMP'),
+            priority_scheduling=os.getenv('PRIORITY_SCHEDULING', 'false').lower() == 'true',
+            fair_share_field=os.getenv('FAIR_SHARE_FIELD', cls.fair_share_field),
+            fair_share_weights=parse_weights(os.getenv('FAIR_SHARE_WEIGHTS')),
+            priority_age_boost_seconds=float(os.getenv('PRIORITY_AGE_BOOST', cls.priority_age_boost_seconds)),
+            profile_batches=int(os.getenv('PROFILE_BATCHES', cls.profile_batches)),
+            profile_dir=os.getenv('PROFILE_DIR', cls.profile_dir),
             dataset_id=os.getenv('DATASET_ID'),
-            callback_url=os.getenv('CALLBACK_URL')
+            callback_url=os.getenv('CALLBACK_URL'),
+            callback_batch_size=int(os.getenv('CALLBACK_BATCH_SIZE', cls.callback_batch_size)),
+            callback_flush_interval=float(os.getenv('CALLBACK_FLUSH_INTERVAL', cls.callback_flush_interval)),
+            callback_timeout=float(os.getenv('CALLBACK_TIMEOUT', cls.callback_timeout)),
+            callback_max_retries=int(os.getenv('CALLBACK_MAX_RETRIES', cls.callback_max_retries)),
+            callback_spill_path=os.getenv('CALLBACK_SPILL_PATH', cls.callback_spill_path) or None
         )
     
     def validate(self) -> None:
@@ -36,4 +162,67 @@ class Config:
             raise ValueError("MongoDB URI is required")
             
         if self.batch_size < 1:
-            raise ValueError("Batch size must be positive")
\ No newline at end of file
+            raise ValueError("Batch size must be positive")
+        
+        if self.decoding_strategy not in ("greedy", "beam", "sample"):
+            raise ValueError("Decoding strategy must be greedy, beam or sample")
+        
+        if self.max_new_tokens < 1:
+            raise ValueError("Max new tokens must be positive")
+        
+        if self.num_beams < 1:
+            raise ValueError("Number of beams must be positive")
+        
+        if self.temperature <= 0:
+            raise ValueError("Temperature must be positive")
+        
+        if not 0 < self.top_p <= 1:
+            raise ValueError("Top-p must be between 0 and 1")
+        
+        if self.vision_encoder_mode not in ("eager", "compile", "trace"):
+            raise ValueError("Vision encoder mode must be eager, compile or trace")
+        
+        if not 0 <= self.min_caption_agreement <= 1:
+            raise ValueError("Minimum caption agreement must be between 0 and 1")
+        
+        if self.embedding_cache_dtype not in ("float16", "float32"):
+            raise ValueError("Embedding cache dtype must be float16 or float32")
+        
+        if self.workers < 1:
+            raise ValueError("Workers must be positive")
+        
+        if self.prefetch_workers < 1:
+            raise ValueError("Prefetch workers must be positive")
+        
+        if self.prefetch_queue_size < 1:
+            raise ValueError("Prefetch queue size must be positive")
+        
+        if self.fetch_page_size < 1:
+            raise ValueError("Fetch page size must be positive")
+        
+        if self.lease_seconds < 1:
+            raise ValueError("Lease duration must be positive")
+        
+        if self.write_batch_size < 1:
+            raise ValueError("Write batch size must be positive")
+        
+        if self.dedup_max_distance < 0:
+            raise ValueError("Dedup max distance must not be negative")
+        
+        if self.caption_cache_max_entries < 1:
+            raise ValueError("Caption cache max entries must be positive")
+        
+        if self.callback_batch_size < 1:
+            raise ValueError("Callback batch size must be positive")
+        
+        if self.priority_scheduling and not self.use_leases:
+            raise ValueError("Priority scheduling requires leases")
+        
+        if any(weight <= 0 for weight in self.fair_share_weights.values()):
+            raise ValueError("Fair-share weights must be positive")
+        
+        if self.profile_batches < 0:
+            raise ValueError("Profile batches must not be negative")
+        
+        if self.callback_max_retries < 0:
+            raise ValueError("Callback max retries must not be negative")
\ No newline at end of file
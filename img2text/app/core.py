@@ -1,14 +1,28 @@
 import logging
+import time
+from collections import Counter
 from datetime import datetime
-from typing import Dict, Any
+from typing import Any, Callable, Dict, List, Optional, Tuple
 
 import torch
 from PIL import Image
-from transformers import BlipProcessor, BlipForConditionalGeneration
 import pymongo
-import requests
 
+from .callbacks import CallbackDispatcher
 from .config import Config
+from .decoding import decoding_signature, generate_kwargs, sequence_log_probs
+from .dedup import CaptionCache
+from .embeddings import EmbeddingStore
+from .fetcher import PendingImageFetcher
+from .indexes import check_pending_queries, ensure_indexes
+from .lease import LEASE_FIELDS, WorkLease, owned_filter
+from .metrics import METRICS
+from .models import load_captioning_model
+from .optimize import caption_agreement, configure_threads, optimize_vision_encoder, quantize_dynamic
+from .pipeline import ImagePrefetcher, PreparedImage
+from .profiling import BatchProfiler
+from .scheduler import FairShareScheduler
+from .writer import BulkWriter
 from .utils import setup_logging
 
 logger = logging.getLogger(__name__)
@@ -28,18 +42,93 @@ class ImageCaptioner:
         # Initialize MongoDB
         self.client = pymongo.MongoClient(config.mongo_uri)
         self.db = self.client.get_default_database()
+        if config.ensure_indexes:
+            ensure_indexes(self.db)
+            check_pending_queries(self.db, config.dataset_id)
+        self.writer = BulkWriter(
+            self.db.images,
+            batch_size=config.write_batch_size,
+            flush_interval=config.write_flush_interval
+        )
+        self.lease = None
+        if config.use_leases:
+            self.lease = WorkLease(self.db.images, config.worker_id, config.lease_seconds)
+        self.scheduler = None
+        if config.priority_scheduling:
+            self.scheduler = FairShareScheduler(
+                self.db.images,
+                weights=config.fair_share_weights,
+                flow_field=config.fair_share_field,
+                age_boost_seconds=config.priority_age_boost_seconds
+            )
+        self.callbacks = None
+        if config.callback_url:
+            self.callbacks = CallbackDispatcher(
+                config.callback_url,
+                batch_size=config.callback_batch_size,
+                flush_interval=config.callback_flush_interval,
+                timeout=config.callback_timeout,
+                max_retries=config.callback_max_retries,
+                spill_path=config.callback_spill_path
+            )
+        self.counts: Counter = Counter()
+        self.profiler = None
+        if config.profile_batches:
+            self.profiler = BatchProfiler(config.profile_batches, config.profile_dir, "img2text")
+        self.generate_kwargs = generate_kwargs(
+            config.decoding_strategy,
+            max_new_tokens=config.max_new_tokens,
+            num_beams=config.num_beams,
+            early_stopping=config.early_stopping,
+            temperature=config.temperature,
+            top_p=config.top_p,
+            top_k=config.top_k
+        )
+        self.cache = None
+        if config.dedup:
+            # Captions depend on the decoding settings as well as the model
+            self.cache = CaptionCache(
+                self.db.caption_cache,
+                namespace=f"{config.model_name}:{decoding_signature(self.generate_kwargs)}",
+                max_distance=config.dedup_max_distance,
+                ttl_seconds=config.caption_cache_ttl_seconds,
+                max_entries=config.caption_cache_max_entries
+            )
+        
+        # Pin thread pools before torch starts using them
+        configure_threads(config.intra_op_threads, config.inter_op_threads)
+        
+        # Initialize AI model, on GPU if available and configured
+        device = "cuda" if config.use_gpu and torch.cuda.is_available() else "cpu"
+        logger.info(f"Using {device.upper()} for inference")
+        self.processor, self.model = load_captioning_model(
+            config.model_name,
+            device=device,
+            cache_dir=config.model_cache_dir,
+            offline=config.offline,
+            snapshot_dir=config.model_snapshot_dir
+        )
         
-        # Initialize AI model
-        logger.info(f"Loading model: {config.model_name}")
-        self.processor = BlipProcessor.from_pretrained(config.model_name)
-        self.model = BlipForConditionalGeneration.from_pretrained(config.model_name)
+        # Weights and vision encoder mode in use, e.g. fp32-eager or int8-trace
+        self.encoder_signature = "fp32-eager"
+        self.embeddings = None
+        if config.cpu_optimize:
+            if device == "cpu":
+                self._optimize_for_cpu()
+            else:
+                logger.warning("CPU optimization requested but running on GPU, ignoring")
         
-        # Use GPU if available and configured
-        if config.use_gpu and torch.cuda.is_available():
-            logger.info("Using GPU for inference")
-            self.model.to("cuda")
-        else:
-            logger.info("Using CPU for inference")
+        if config.embedding_cache_dir:
+            # Embeddings of the fp32 and the quantized or compiled encoders
+            # differ; the fp32 store keeps its original namespace
+            namespace = config.model_name
+            if self.encoder_signature != "fp32-eager":
+                namespace = f"{namespace}:{self.encoder_signature}"
+            self.embeddings = EmbeddingStore(
+                config.embedding_cache_dir,
+                namespace=namespace,
+                dtype=config.embedding_cache_dtype
+            )
     
     def process_image(self, image_path: str) -> str:
         """Generate caption for a single image.
@@ -55,74 +144,427 @@ class ImageCaptioner:
         """
         try:
             # Load and process image
-            image = Image.open(image_path)
-            inputs = self.processor(image, return_tensors="pt")
-            
-            # Move inputs to GPU if available and configured
-            if self.config.use_gpu and torch.cuda.is_available():
-                inputs = {k: v.to("cuda") for k, v in inputs.items()}
-            
-            # Generate caption
-            outputs = self.model.generate(**inputs, max_length=50)
-            caption = self.processor.decode(outputs[0], skip_special_tokens=True)
-            
-            return caption
+            image = Image.open(image_path).convert("RGB")
+            return self.process_batch([image])[0]
             
         except Exception as e:
             logger.error(f"Error processing image {image_path}: {str(e)}")
             raise
     
-    def process_dataset(self) -> None:
-        """Process all pending images in the dataset."""
+    def process_batch(self, images: List[Image.Image]) -> List[str]:
+        """Generate captions for a batch of images in a single forward pass.
+        
+        Args:
+            images: Decoded RGB images
+            
+        Returns:
+            Generated captions, in the same order as the input images
+        """
+        inputs = self.processor(images=images, return_tensors="pt", padding=True)
+        return self._generate(inputs["pixel_values"])
+    
+    def _preprocess(self, image: Image.Image) -> Dict[str, Any]:
+        """Run BLIP preprocessing for a single image.
+        
+        Called from the prefetch worker threads.
+        """
+        return self.processor(images=image, return_tensors="pt")
+    
+    def _generate(self, pixel_values: torch.Tensor, model: Optional[torch.nn.Module] = None,
+                  content_hashes: Optional[List[str]] = None) -> List[str]:
+        """Run ``generate`` on a batch of preprocessed pixel values.
+        
+        Args:
+            pixel_values: Preprocessed images
+            model: Model to use instead of ``self.model``
+            content_hashes: Content hash per image; with an embedding store,
+                cached vision embeddings are used for these images
+        """
+        return self._generate_scored(pixel_values, model, content_hashes)[0]
+    
+    def _generate_scored(self, pixel_values: torch.Tensor, model: Optional[torch.nn.Module] = None,
+                         content_hashes: Optional[List[str]] = None,
+                         with_confidence: bool = False) -> Tuple[List[str], Optional[List[Tuple[float, float]]]]:
+        """Run ``generate`` and optionally score the generated captions.
+        
+        Per-step scores are only kept by ``generate`` when ``with_confidence``
+        is set; otherwise only the token ids are returned.
+        
+        Args:
+            pixel_values: Preprocessed images
+            model: Model to use instead of ``self.model``
+            content_hashes: Content hash per image, for the embedding store
+            with_confidence: Compute the log-probability of each caption
+        
+        Returns:
+            Captions, and per caption its log-probability and confidence
+            (``None`` unless ``with_confidence`` is set)
+        """
+        model = model or self.model
+        kwargs = dict(self.generate_kwargs)
+        if with_confidence:
+            kwargs.update(output_scores=True, return_dict_in_generate=True)
+        
+        # Move inputs to GPU if available and configured
+        if self.config.use_gpu and torch.cuda.is_available():
+            pixel_values = pixel_values.to("cuda")
+        
+        # Generate captions
+        with torch.inference_mode(), METRICS.timer("inference"):
+            if self.embeddings is not None and content_hashes is not None:
+                image_embeds = self._image_embeddings(pixel_values, content_hashes, model)
+                outputs = self._generate_from_embeddings(image_embeds, model, **kwargs)
+            else:
+                outputs = model.generate(pixel_values=pixel_values, **kwargs)
+            
+            if not with_confidence:
+                return self.processor.batch_decode(outputs, skip_special_tokens=True), None
+            
+            scores = sequence_log_probs(
+                model.text_decoder,
+                outputs,
+                pad_token_id=model.config.text_config.pad_token_id
+            )
+        return self.processor.batch_decode(outputs.sequences, skip_special_tokens=True), scores
+    
+    def _image_embeddings(self, pixel_values: torch.Tensor, content_hashes: List[str],
+                          model: torch.nn.Module) -> torch.Tensor:
+        """Vision encoder outputs for a batch, reusing and filling the embedding store.
+        
+        Only images without a stored embedding go through the vision encoder.
+        """
+        cached = self.embeddings.get_many(content_hashes)
+        missing = [i for i, key in enumerate(content_hashes) if key not in cached]
+        if missing:
+            encoded = model.vision_model(pixel_values=pixel_values[missing])[0]
+            computed = {content_hashes[i]: embeds for i, embeds in zip(missing, encoded)}
+            self.embeddings.put_many(computed)
+            cached.update(computed)
+        
+        dtype = model.text_decoder.get_input_embeddings().weight.dtype
+        return torch.stack([cached[key] for key in content_hashes]).to(pixel_values.device, dtype)
+    
+    def _generate_from_embeddings(self, image_embeds: torch.Tensor, model: torch.nn.Module, **kwargs) -> Any:
+        """Decode captions from vision embeddings.
+        
+        Mirrors ``BlipForConditionalGeneration.generate`` after its vision
+        encoder call, so captions match those generated from pixel values.
+        """
+        text_config = model.config.text_config
+        image_attention_mask = torch.ones(image_embeds.shape[:-1], dtype=torch.long, device=image_embeds.device)
+        input_ids = torch.full(
+            (image_embeds.shape[0], 1),
+            text_config.bos_token_id,
+            dtype=torch.long,
+            device=image_embeds.device
+        )
+        return model.text_decoder.generate(
+            input_ids=input_ids,
+            eos_token_id=text_config.sep_token_id,
+            pad_token_id=text_config.pad_token_id,
+            encoder_hidden_states=image_embeds,
+            encoder_attention_mask=image_attention_mask,
+            **kwargs
+        )
+    
+    def _optimize_for_cpu(self) -> None:
+        """Quantize the model to int8 and optionally compile its vision encoder.
+        
+        The optimized model captions a sample of the dataset next to the
+        fp32 model. It replaces the fp32 model only if the token-level F1
+        of its captions reaches ``min_caption_agreement``.
+        """
+        logger.info("Applying dynamic int8 quantization")
+        optimized = optimize_vision_encoder(quantize_dynamic(self.model), self.config.vision_encoder_mode)
+        
+        sample = self._accuracy_sample()
+        if sample is not None:
+            reference, reference_time = self._timed_captions(sample, self.model)
+            # A first pass warms up compiled or traced encoders before timing
+            self._timed_captions(sample, optimized)
+            candidate, candidate_time = self._timed_captions(sample, optimized)
+            exact, f1 = caption_agreement(reference, candidate)
+            logger.info(
+                f"CPU optimization on {len(reference)} images: {exact:.0%} exact matches, "
+                f"token F1 {f1:.3f}, {reference_time / candidate_time:.2f}x speedup"
+            )
+            if f1 < self.config.min_caption_agreement:
+                logger.error(
+                    f"Optimized captions agree below {self.config.min_caption_agreement}, "
+                    "keeping the fp32 model"
+                )
+                return
+        
+        self.model = optimized
+        self.encoder_signature = f"int8-{self.config.vision_encoder_mode}"
+    
+    def _accuracy_sample(self) -> Optional[torch.Tensor]:
+        """Preprocess up to ``accuracy_check_samples`` images of the dataset.
+        
+        Returns:
+            Stacked pixel values, or None if no sample image could be loaded
+        """
+        if self.config.accuracy_check_samples < 1:
+            return None
+        
+        query = {"dataset_id": self.config.dataset_id} if self.config.dataset_id else {}
+        pixel_values = []
+        for image in self.db.images.find(query, {"path": 1}).limit(self.config.accuracy_check_samples):
+            try:
+                with Image.open(image["path"]) as img:
+                    pixel_values.append(self._preprocess(img.convert("RGB"))["pixel_values"])
+            except Exception as e:
+                logger.debug(f"Skipping accuracy sample {image['path']}: {str(e)}")
+        
+        if not pixel_values:
+            logger.warning("No images available for the CPU optimization accuracy check")
+            return None
+        return torch.cat(pixel_values)
+    
+    def _timed_captions(self, pixel_values: torch.Tensor, model: torch.nn.Module) -> Tuple[List[str], float]:
+        """Caption a sample with ``model``, returning captions and elapsed seconds."""
+        started = time.perf_counter()
+        captions = []
+        for i in range(0, len(pixel_values), self.config.batch_size):
+            captions.extend(self._generate(pixel_values[i:i + self.config.batch_size], model))
+        return captions, time.perf_counter() - started
+    
+    def process_dataset(self, shard: Optional[Dict[str, Any]] = None,
+                        progress: Optional[Callable[[int], None]] = None) -> Dict[str, int]:
+        """Process all pending images in the dataset in batches of ``batch_size``.
+        
+        Pending documents are streamed in ``_id`` order by a
+        ``PendingImageFetcher`` and decoded by an ``ImagePrefetcher`` while
+        the previous batch is running through the model.
+        
+        With leases enabled, each page is claimed for this worker so several
+        workers can share a dataset, and documents left ``processing`` by a
+        crashed worker are reclaimed once their lease expires. Otherwise
+        progress is checkpointed every ``fetch_page_size`` images so an
+        interrupted run resumes where it stopped.
+        
+        With ``priority_scheduling``, each batch is chosen by the
+        ``FairShareScheduler`` instead: the highest ``priority`` class first,
+        with older images boosted and datasets sharing a class by weight.
+        A batch never mixes priority classes.
+        
+        Args:
+            shard: Extra filter restricting this run to part of the dataset,
+                e.g. an ``_id`` range; checkpointing is disabled for shards
+            progress: Called with the number of images finished after each batch
+        
+        Returns:
+            Counts of completed, errored and deduplicated images, and of
+            results that could not be written back
+        """
         # Build query
         query = {"status": "pending"}
         if self.config.dataset_id:
             query["dataset_id"] = self.config.dataset_id
+        if shard:
+            query.update(shard)
+        
+        checkpoint_key = None
+        if self.config.resume and not self.lease and not shard:
+            checkpoint_key = self._checkpoint_key()
+        
+        self.counts = Counter()
+        write_failures = len(self.writer.failures)
+        
+        fetcher = PendingImageFetcher(
+            self.db,
+            query,
+            # Scheduled work is chosen one batch at a time, so urgent images
+            # wait for at most the batches already claimed
+            page_size=self.config.batch_size if self.scheduler else self.config.fetch_page_size,
+            checkpoint_key=checkpoint_key,
+            lease=self.lease,
+            scheduler=self.scheduler
+        )
         
         try:
-            # Find pending images
-            images = self.db.images.find(query)
+            if self.lease:
+                self.lease.reclaim_expired(query, include_own=True)
             
-            for image in images:
-                try:
-                    # Generate caption
-                    caption = self.process_image(image["path"])
-                    
-                    # Update MongoDB
-                    self._update_image_status(
-                        image["_id"],
-                        status="completed",
-                        caption=caption
-                    )
+            with ImagePrefetcher(
+                self._preprocess,
+                num_workers=self.config.prefetch_workers,
+                queue_size=self.config.prefetch_queue_size,
+                compute_hashes=self.cache is not None or self.embeddings is not None
+            ) as prefetcher:
+                since_checkpoint = 0
+                if self.profiler:
+                    self.profiler.start()
+                batches = prefetcher.iter_batches(
+                    fetcher,
+                    self.config.batch_size,
+                    split_on="effective_priority" if self.scheduler else None
+                )
+                for batch in batches:
+                    self._process_documents(batch)
+                    if self.profiler:
+                        self.profiler.step()
+                    if self.lease:
+                        self.lease.renew()
+                    if progress:
+                        progress(len(batch))
                     
-                    # Send callback if configured
-                    if self.config.callback_url:
-                        self._send_callback({
-                            "prompt_id": str(image["_id"]),
-                            "image_path": image["path"],
-                            "caption": caption
-                        })
-                    
-                    logger.info(f"Successfully processed image: {image['path']}")
-                    
-                except Exception as e:
-                    # Log error and update status
-                    logger.error(f"Error processing image {image['path']}: {str(e)}")
-                    self._update_image_status(
-                        image["_id"],
-                        status="error",
-                        error=str(e)
-                    )
+                    since_checkpoint += len(batch)
+                    if since_checkpoint >= self.config.fetch_page_size:
+                        self._save_checkpoint(fetcher, batch[-1].document["_id"])
+                        since_checkpoint = 0
+            
+            fetcher.clear_checkpoint()
+            if self.cache:
+                logger.info(f"Caption cache: {self.cache.stats()}")
+            if self.embeddings is not None:
+                logger.info(f"Embedding store: {self.embeddings.stats()}")
+            
+            self.writer.flush()
                     
         except Exception as e:
             logger.error(f"Error accessing MongoDB: {str(e)}")
             raise
+        
+        return {
+            "completed": self.counts["completed"],
+            "error": self.counts["error"],
+            "deduplicated": self.counts["deduplicated"],
+            "write_failures": len(self.writer.failures) - write_failures
+        }
+    
+    def _checkpoint_key(self) -> str:
+        """Key identifying this run's progress checkpoint."""
+        return f"img2text:{self.config.dataset_id or '*'}"
     
-    def _update_image_status(self, image_id: str, status: str, **kwargs) -> None:
+    def _save_checkpoint(self, fetcher: PendingImageFetcher, last_id: Any) -> None:
+        """Persist buffered results, then checkpoint the last processed image.
+        
+        The checkpoint only advances once every buffered update is written;
+        if a flush failed and will be retried, the previous checkpoint is
+        kept so a restart does not skip images whose results were lost.
+        
+        Args:
+            fetcher: Fetcher whose checkpoint to advance
+            last_id: ``_id`` of the last processed image
+        """
+        self.writer.flush()
+        if self.writer.pending:
+            logger.warning(f"{self.writer.pending} updates not yet written, keeping the previous checkpoint")
+            return
+        fetcher.save_checkpoint(last_id)
+    
+    def _process_documents(self, batch: List[PreparedImage]) -> None:
+        """Caption a batch of prepared images and record the results.
+        
+        Images that failed to decode are marked as errors individually.
+        Duplicates of previously captioned images reuse the cached caption;
+        the remaining images are captioned together in one ``generate`` call.
+        
+        Args:
+            batch: Prepared images from the prefetcher
+        """
+        loaded = []
+        for prepared in batch:
+            image = prepared.document
+            if prepared.error is not None:
+                logger.error(f"Error processing image {image['path']}: {str(prepared.error)}")
+                self._update_image_status(image, status="error", error=str(prepared.error))
+            else:
+                loaded.append(prepared)
+        
+        if not loaded:
+            return
+        
+        # Reuse the captions of images seen before
+        if self.cache:
+            cached = self.cache.lookup_many([(p.content_hash, p.perceptual_hash) for p in loaded])
+            for prepared, caption in zip(loaded, cached):
+                if caption is not None:
+                    self._complete_image(prepared.document, caption, deduplicated=True)
+            loaded = [p for p, caption in zip(loaded, cached) if caption is None]
+        
+        # Byte-identical copies within the batch are captioned once
+        unique: Dict[Any, PreparedImage] = {}
+        for prepared in loaded:
+            unique.setdefault(prepared.content_hash or prepared.document["_id"], prepared)
+        if not unique:
+            return
+        
+        try:
+            pixel_values = torch.cat([p.inputs["pixel_values"] for p in unique.values()])
+            generated, scores = self._generate_scored(
+                pixel_values,
+                content_hashes=[p.content_hash for p in unique.values()],
+                with_confidence=self.config.compute_confidence
+            )
+            captions = dict(zip(unique, generated))
+            confidences = dict(zip(unique, scores or [None] * len(unique)))
+        except Exception as e:
+            logger.error(f"Error captioning batch of {len(unique)} images: {str(e)}")
+            for prepared in loaded:
+                self._update_image_status(prepared.document, status="error", error=str(e))
+            return
+        
+        if self.cache:
+            self.cache.store_many([
+                (p.content_hash, p.perceptual_hash, captions[key])
+                for key, p in unique.items() if p.content_hash
+            ])
+        
+        for prepared in loaded:
+            key = prepared.content_hash or prepared.document["_id"]
+            self._complete_image(
+                prepared.document,
+                captions[key],
+                deduplicated=unique[key] is not prepared,
+                score=confidences[key]
+            )
+    
+    def _complete_image(self, image: Dict[str, Any], caption: str, deduplicated: bool = False,
+                        score: Optional[Tuple[float, float]] = None) -> None:
+        """Record a caption for an image and send its callback.
+        
+        Args:
+            image: Image document
+            caption: Generated or reused caption
+            deduplicated: Whether the caption was copied from a duplicate image
+            score: Log-probability and confidence of the caption, if computed
+        """
+        fields: Dict[str, Any] = {"caption": caption}
+        if score is not None:
+            fields["log_prob"], fields["confidence"] = score
+        if deduplicated:
+            fields["deduplicated"] = True
+            self.counts["deduplicated"] += 1
+            METRICS.inc("images_deduplicated_total")
+        
+        # Update MongoDB
+        self._update_image_status(image, status="completed", **fields)
+        
+        # Queue callback if configured
+        if self.callbacks is not None:
+            payload = {
+                "prompt_id": str(image["_id"]),
+                "image_path": image["path"],
+                "caption": caption
+            }
+            if score is not None:
+                payload["confidence"] = fields["confidence"]
+            self.callbacks.send(payload)
+        
+        logger.info(f"Successfully processed image: {image['path']}")
+    
+    def _update_image_status(self, image: Dict[str, Any], status: str, **kwargs) -> None:
         """Update the status and metadata of an image in MongoDB.
         
+        The update is buffered and written in bulk by ``self.writer``. A
+        claimed image is only updated while this worker still holds its
+        lease; if the lease was taken over the update matches nothing and
+        is counted by the writer.
+        
         Args:
-            image_id: MongoDB ID of the image
+            image: Image document
             status: New status to set
             **kwargs: Additional fields to update
         """
@@ -132,27 +574,12 @@ class ImageCaptioner:
             **kwargs
         }
         
-        self.db.images.update_one(
-            {"_id": image_id},
-            {"$set": update_data}
+        self.writer.update_one(
+            owned_filter(image),
+            {"$set": update_data, "$unset": LEASE_FIELDS}
         )
-    
-    def _send_callback(self, data: Dict[str, Any]) -> None:
-        """Send callback notification.
-        
-        Args:
-            data: Data to send in the callback
-        """
-        try:
-            response = requests.post(
-                self.config.callback_url,
-                json={"results": [data]},
-                timeout=10
-            )
-            response.raise_for_status()
-            logger.info("Callback sent successfully")
-        except Exception as e:
-            logger.error(f"Callback failed: {str(e)}")
+        self.counts[status] += 1
+        METRICS.inc("images_total", status=status)
     
     def __enter__(self):
         """Context manager entry."""
@@ -160,5 +587,13 @@ class ImageCaptioner:
     
     def __exit__(self, exc_type, exc_val, exc_tb):
         """Context manager exit with proper cleanup."""
+        if self.profiler:
+            # Write what was recorded when there were fewer batches than requested
+            self.profiler.stop()
+        self.writer.close()
+        if self.callbacks is not None:
+            self.callbacks.close()
+        if self.embeddings is not None:
+            self.embeddings.close()
         if self.client:
             self.client.close()
\ No newline at end of file
@@ -0,0 +1,78 @@
+import json
+import math
+from typing import Any, Dict, List, Tuple
+
+import torch
+
+DECODING_STRATEGIES = ("greedy", "beam", "sample")
+
+def generate_kwargs(strategy: str = "greedy", max_new_tokens: int = 50,
+                    num_beams: int = 3, early_stopping: bool = True,
+                    temperature: float = 1.0, top_p: float = 0.9, top_k: int = 50,
+                    output_scores: bool = False) -> Dict[str, Any]:
+    """Build ``generate`` keyword arguments for a decoding strategy.
+
+    Per-step scores are only requested when ``output_scores`` is set, so
+    plain captioning never keeps a (batch, vocab) tensor per step.
+
+    Args:
+        strategy: ``greedy``, ``beam`` or ``sample``
+        max_new_tokens: Maximum caption length in tokens
+        num_beams: Beam width for beam search
+        early_stopping: Stop beam search once enough beams have finished
+        temperature: Sampling temperature
+        top_p: Nucleus sampling probability mass
+        top_k: Number of highest-probability tokens considered when sampling
+        output_scores: Return scores for computing sequence log-probabilities
+    """
+    if strategy not in DECODING_STRATEGIES:
+        raise ValueError(f"Unknown decoding strategy: {strategy}")
+
+    kwargs: Dict[str, Any] = {"max_new_tokens": max_new_tokens}
+    if strategy == "beam":
+        kwargs.update(num_beams=num_beams, early_stopping=early_stopping)
+    elif strategy == "sample":
+        kwargs.update(do_sample=True, temperature=temperature, top_p=top_p, top_k=top_k)
+    else:
+        kwargs.update(num_beams=1, do_sample=False)
+
+    if output_scores:
+        kwargs.update(output_scores=True, return_dict_in_generate=True)
+    return kwargs
+
+def decoding_signature(kwargs: Dict[str, Any]) -> str:
+    """Stable string identifying the captions a set of ``generate`` arguments produces."""
+    relevant = {k: v for k, v in kwargs.items() if k not in ("output_scores", "return_dict_in_generate")}
+    return json.dumps(relevant, sort_keys=True)
+
+def sequence_log_probs(model: Any, outputs: Any, pad_token_id: int) -> List[Tuple[float, float]]:
+    """Log-probability of each generated sequence.
+
+    Uses ``compute_transition_scores`` to recover the per-token
+    log-probabilities of the chosen tokens, following beam indices for
+    beam search. Padding after the end of a sequence is ignored.
+
+    Args:
+        model: Model whose ``generate`` produced ``outputs``
+        outputs: ``generate`` output with ``sequences`` and ``scores``
+        pad_token_id: Token used to pad finished sequences
+
+    Returns:
+        Per sequence, the total log-probability and a confidence in [0, 1],
+        the geometric mean of the token probabilities
+    """
+    beam_indices = getattr(outputs, "beam_indices", None)
+    transition = model.compute_transition_scores(
+        outputs.sequences,
+        outputs.scores,
+        beam_indices,
+        normalize_logits=beam_indices is None
+    )
+    generated = outputs.sequences[:, -transition.shape[1]:]
+    mask = generated != pad_token_id
+    transition = torch.where(mask, transition, torch.zeros_like(transition))
+
+    results = []
+    for log_prob, length in zip(transition.sum(dim=1).tolist(), mask.sum(dim=1).tolist()):
+        results.append((log_prob, math.exp(log_prob / length) if length else 0.0))
+    return results
@@ -0,0 +1,238 @@
+import hashlib
+import logging
+import threading
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from PIL import Image
+from pymongo import ASCENDING, IndexModel, UpdateOne
+from pymongo.collection import Collection
+
+logger = logging.getLogger(__name__)
+
+def content_hash(data: bytes) -> str:
+    """SHA-256 of the raw image file, identifying byte-identical copies."""
+    return hashlib.sha256(data).hexdigest()
+
+def perceptual_hash(image: Image.Image, hash_size: int = 8) -> str:
+    """Difference hash (dHash) of an image as a hex string.
+
+    The image is shrunk to ``hash_size + 1`` by ``hash_size`` grey pixels
+    and each bit records whether a pixel is brighter than its right-hand
+    neighbour, so re-encoded, resized or slightly edited copies of an image
+    hash to the same or nearby values.
+
+    Args:
+        image: Decoded image
+        hash_size: Hash width in bits per row; the hash has ``hash_size**2`` bits
+    """
+    grey = image.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = list(grey.getdata())
+
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return f"{value:0{hash_size * hash_size // 4}x}"
+
+def hamming_distance(a: str, b: str) -> int:
+    """Number of differing bits between two hex hashes."""
+    return bin(int(a, 16) ^ int(b, 16)).count("1")
+
+def hash_detail(phash: str) -> int:
+    """Number of informative bits in a dHash.
+
+    Flat images of any colour hash to all zeros, and smooth gradients to
+    all ones, so a hash with few set or few unset bits says little about
+    the image.
+    """
+    ones = bin(int(phash, 16)).count("1")
+    return min(ones, len(phash) * 4 - ones)
+
+class CaptionCache:
+    """Persistent captions of already seen images, keyed by image content.
+
+    Exact copies are found by content hash. Near-duplicates are found with
+    locality-sensitive hashing: the perceptual hash is split into ``bands``
+    and stored images sharing any band with the query are compared by
+    Hamming distance. With four bands, any image within three bits of a
+    stored one shares at least one band with it. Hashes with fewer than
+    ``min_detail`` informative bits, such as those of blank or solid-colour
+    images, only match exact copies, and each lookup compares at most
+    ``max_candidates`` stored images per query image.
+
+    Entries are scoped to a namespace (the model name), expire
+    ``ttl_seconds`` after their last use, and the least recently used are
+    evicted once the cache holds more than ``max_entries``.
+    """
+
+    def __init__(self, collection: Collection, namespace: str,
+                 max_distance: int = 3, bands: int = 4,
+                 ttl_seconds: int = 30 * 24 * 3600, max_entries: int = 1_000_000,
+                 min_detail: int = 8, max_candidates: int = 100):
+        """Initialize the cache and its indexes.
+
+        Args:
+            collection: Collection holding cache entries
+            namespace: Scope of the entries, e.g. the caption model name
+            max_distance: Largest Hamming distance treated as a duplicate;
+                0 disables near-duplicate matching
+            bands: Number of LSH bands the perceptual hash is split into
+            ttl_seconds: Seconds an unused entry is kept, 0 to keep forever
+            max_entries: Entries kept before the least recently used are evicted
+            min_detail: Informative bits a perceptual hash needs to be used
+                for near-duplicate matching
+            max_candidates: Stored images compared per query image
+        """
+        self.collection = collection
+        self.namespace = namespace
+        self.max_distance = max_distance
+        self.bands = bands
+        self.max_entries = max_entries
+        self.min_detail = min_detail
+        self.max_candidates = max_candidates
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self._stores = 0
+        self._lock = threading.Lock()
+
+        last_used = {"expireAfterSeconds": ttl_seconds} if ttl_seconds > 0 else {}
+        collection.create_indexes([
+            IndexModel([("namespace", ASCENDING), ("bands", ASCENDING)], name="namespace_bands"),
+            IndexModel([("last_used_at", ASCENDING)], name="last_used_at", **last_used),
+        ])
+
+    def _key(self, sha256: str) -> str:
+        """Entry ``_id`` for a content hash in this namespace."""
+        return f"{self.namespace}:{sha256}"
+
+    def _bands(self, phash: str) -> List[str]:
+        """LSH band keys of a perceptual hash, tagged with their position."""
+        width = len(phash) // self.bands
+        return [f"{i}:{phash[i * width:(i + 1) * width]}" for i in range(self.bands)]
+
+    def _matchable(self, phash: Optional[str]) -> bool:
+        """Whether a perceptual hash carries enough detail for near-duplicate matching."""
+        return bool(phash) and hash_detail(phash) >= self.min_detail
+
+    def lookup_many(self, hashes: Sequence[Tuple[str, Optional[str]]]) -> List[Optional[str]]:
+        """Find cached captions for a batch of images.
+
+        Args:
+            hashes: ``(content_hash, perceptual_hash)`` per image
+
+        Returns:
+            Cached caption per image, or None where there is no duplicate
+        """
+        if not hashes:
+            return []
+
+        exact = {
+            entry["_id"]: entry
+            for entry in self.collection.find(
+                {"_id": {"$in": list({self._key(sha) for sha, _ in hashes})}},
+                {"caption": 1}
+            )
+        }
+
+        near: List[Dict[str, Any]] = []
+        remaining = [
+            phash for sha, phash in hashes
+            if self._matchable(phash) and self._key(sha) not in exact
+        ]
+        if remaining and self.max_distance > 0:
+            bands = {band for phash in remaining for band in self._bands(phash)}
+            near = list(self.collection.find(
+                {"namespace": self.namespace, "bands": {"$in": list(bands)}},
+                {"caption": 1, "phash": 1}
+            ).limit(self.max_candidates * len(remaining)))
+
+        captions: List[Optional[str]] = []
+        used = set()
+        for sha, phash in hashes:
+            entry = exact.get(self._key(sha))
+            if entry is None and self._matchable(phash) and near:
+                entry = self._nearest(phash, near)
+                if entry is not None:
+                    self.near_hits += 1
+
+            if entry is None:
+                self.misses += 1
+                captions.append(None)
+            else:
+                self.hits += 1
+                used.add(entry["_id"])
+                captions.append(entry["caption"])
+
+        if used:
+            self.collection.update_many(
+                {"_id": {"$in": list(used)}},
+                {"$set": {"last_used_at": datetime.utcnow()}, "$inc": {"hits": 1}}
+            )
+        return captions
+
+    def _nearest(self, phash: str, candidates: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """Closest candidate within ``max_distance`` of ``phash``, if any."""
+        best, best_distance = None, self.max_distance + 1
+        for candidate in candidates:
+            distance = hamming_distance(phash, candidate["phash"])
+            if distance < best_distance:
+                best, best_distance = candidate, distance
+        return best
+
+    def store_many(self, entries: Sequence[Tuple[str, Optional[str], str]]) -> None:
+        """Record captions for newly captioned images.
+
+        Args:
+            entries: ``(content_hash, perceptual_hash, caption)`` per image
+        """
+        if not entries:
+            return
+
+        now = datetime.utcnow()
+        ops = []
+        for sha, phash, caption in entries:
+            fields = {"namespace": self.namespace, "caption": caption, "last_used_at": now}
+            if self._matchable(phash):
+                # Low-detail hashes get no bands, so they never become candidates
+                fields.update(phash=phash, bands=self._bands(phash))
+            ops.append(UpdateOne(
+                {"_id": self._key(sha)},
+                {"$set": fields, "$setOnInsert": {"created_at": now, "hits": 0}},
+                upsert=True
+            ))
+        self.collection.bulk_write(ops, ordered=False)
+
+        with self._lock:
+            before = self._stores
+            self._stores += len(entries)
+            evict = before // 1000 != self._stores // 1000
+        if evict:
+            self.evict()
+
+    def evict(self) -> int:
+        """Remove least recently used entries above ``max_entries``.
+
+        Returns:
+            Number of evicted entries
+        """
+        excess = self.collection.estimated_document_count() - self.max_entries
+        if excess <= 0:
+            return 0
+
+        oldest = self.collection.find({}, {"_id": 1}).sort("last_used_at", ASCENDING).limit(excess)
+        result = self.collection.delete_many({"_id": {"$in": [entry["_id"] for entry in oldest]}})
+        logger.info(f"Evicted {result.deleted_count} caption cache entries")
+        return result.deleted_count
+
+    def stats(self) -> Dict[str, Any]:
+        """Return hit/miss counters for this process."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "near_duplicate_hits": self.near_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
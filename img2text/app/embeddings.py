@@ -0,0 +1,149 @@
+import fcntl
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+class EmbeddingStore:
+    """On-disk cache of vision encoder outputs keyed by image content hash.
+
+    Embeddings are appended to a single flat data file that is read back
+    through a read-only ``numpy.memmap``, so cached embeddings are paged in
+    by the OS rather than loaded into memory up front. A SQLite index maps
+    each content hash to its offset and shape in the data file. The data
+    is written before the index entry is committed, so a crash can only
+    leave unreferenced bytes behind, never a dangling index entry. Appends
+    hold an exclusive file lock, so worker processes can share a store.
+
+    Stores are scoped to a namespace (the model name and encoder mode):
+    each namespace gets its own subdirectory, since embeddings from
+    different, or differently quantized, vision encoders are not
+    interchangeable.
+    """
+
+    def __init__(self, directory: str, namespace: str, dtype: str = "float16"):
+        """Open or create the store.
+
+        Args:
+            directory: Root directory of the embedding cache
+            namespace: Scope of the embeddings, e.g. the caption model name
+                and encoder mode
+            dtype: On-disk element type, ``float16`` or ``float32``
+        """
+        digest = hashlib.sha1(namespace.encode()).hexdigest()[:16]
+        self.path = Path(directory) / digest
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.data_path = self.path / "embeddings.bin"
+        self.dtype = np.dtype(dtype)
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._map: Optional[np.memmap] = None
+        self._data = open(self.data_path, "ab")
+        self._index = sqlite3.connect(str(self.path / "index.sqlite"), check_same_thread=False)
+        self._index.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, offset INTEGER, rows INTEGER, cols INTEGER)"
+        )
+        self._index.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._index.execute(
+            "INSERT OR IGNORE INTO meta VALUES ('namespace', ?), ('dtype', ?)",
+            (namespace, self.dtype.name)
+        )
+        stored_dtype = self._index.execute("SELECT value FROM meta WHERE key = 'dtype'").fetchone()[0]
+        if stored_dtype != self.dtype.name:
+            raise ValueError(f"Embedding store {self.path} holds {stored_dtype}, not {self.dtype.name}")
+        self._index.commit()
+
+    def _view(self, end: int) -> np.memmap:
+        """Memory map of the data file covering at least ``end`` elements."""
+        if self._map is None or len(self._map) < end:
+            self._map = np.memmap(self.data_path, dtype=self.dtype, mode="r")
+        return self._map
+
+    def get_many(self, keys: Sequence[str]) -> Dict[str, torch.Tensor]:
+        """Load cached embeddings.
+
+        Args:
+            keys: Content hashes to look up
+
+        Returns:
+            Embeddings found, by key, as float32 tensors of shape (rows, cols)
+        """
+        unique = list(dict.fromkeys(keys))
+        with self._lock:
+            rows = self._index.execute(
+                f"SELECT key, offset, rows, cols FROM embeddings WHERE key IN ({','.join('?' * len(unique))})",
+                unique
+            ).fetchall() if unique else []
+
+            found = {}
+            for key, offset, n_rows, n_cols in rows:
+                view = self._view(offset + n_rows * n_cols)
+                flat = np.asarray(view[offset:offset + n_rows * n_cols], dtype=np.float32)
+                found[key] = torch.from_numpy(flat.reshape(n_rows, n_cols))
+
+        self.hits += len(found)
+        self.misses += len(unique) - len(found)
+        return found
+
+    def put_many(self, embeddings: Dict[str, torch.Tensor]) -> None:
+        """Append embeddings, skipping keys that are already stored.
+
+        Args:
+            embeddings: 2-D embeddings (rows, cols) by content hash
+        """
+        if not embeddings:
+            return
+
+        with self._lock:
+            placeholders = ','.join('?' * len(embeddings))
+            existing = {
+                key for (key,) in self._index.execute(
+                    f"SELECT key FROM embeddings WHERE key IN ({placeholders})", list(embeddings)
+                )
+            }
+
+            fcntl.flock(self._data.fileno(), fcntl.LOCK_EX)
+            try:
+                entries = []
+                offset = os.fstat(self._data.fileno()).st_size // self.dtype.itemsize
+                for key, embedding in embeddings.items():
+                    if key in existing:
+                        continue
+                    array = embedding.detach().to("cpu", torch.float32).numpy().astype(self.dtype)
+                    self._data.write(array.tobytes())
+                    entries.append((key, offset, array.shape[0], array.shape[1]))
+                    offset += array.size
+
+                self._data.flush()
+                os.fsync(self._data.fileno())
+                self._index.executemany("INSERT OR IGNORE INTO embeddings VALUES (?, ?, ?, ?)", entries)
+                self._index.commit()
+            finally:
+                fcntl.flock(self._data.fileno(), fcntl.LOCK_UN)
+
+    def __len__(self) -> int:
+        """Number of stored embeddings."""
+        with self._lock:
+            return self._index.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def stats(self) -> Dict[str, int]:
+        """Return hit/miss counters for this process."""
+        return {"hits": self.hits, "misses": self.misses, "stored": len(self)}
+
+    def close(self) -> None:
+        """Close the data file and the index."""
+        with self._lock:
+            self._map = None
+            self._data.close()
+            self._index.close()
@@ -0,0 +1,155 @@
+import logging
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+from pymongo import ASCENDING
+from pymongo.database import Database
+
+from .lease import WorkLease
+from .scheduler import FairShareScheduler
+
+logger = logging.getLogger(__name__)
+
+class PendingImageFetcher:
+    """Streams pending image documents in pages ordered by ``_id``.
+
+    Each page is fetched with a fresh, short-lived query starting after the
+    last ``_id`` seen, so no cursor stays open during inference and memory
+    use is bounded by ``page_size``. The last processed ``_id`` can be
+    checkpointed so that a restarted run resumes where it left off.
+
+    When a ``WorkLease`` is given, each page is claimed for this worker and
+    the lease, rather than the checkpoint, records which work is taken.
+    With a ``FairShareScheduler`` as well, pages are chosen by priority and
+    fair share instead of ``_id`` order, and each document carries the
+    ``effective_priority`` it was scheduled at.
+    """
+
+    CHECKPOINT_COLLECTION = "checkpoints"
+
+    def __init__(self, db: Database, query: Dict[str, Any],
+                 page_size: int = 500,
+                 fields: Sequence[str] = ("_id", "path"),
+                 checkpoint_key: Optional[str] = None,
+                 lease: Optional[WorkLease] = None,
+                 scheduler: Optional[FairShareScheduler] = None):
+        """Initialize the fetcher.
+
+        Args:
+            db: Database holding the ``images`` collection
+            query: Filter selecting pending documents
+            page_size: Number of documents fetched per query
+            fields: Fields to project from each document
+            checkpoint_key: Key under which progress is checkpointed, or
+                None to disable checkpointing
+            lease: Optional lease used to claim each page
+            scheduler: Optional scheduler choosing each page; requires a
+                lease, since pages are no longer in ``_id`` order
+        """
+        if scheduler and not lease:
+            raise ValueError("Priority scheduling requires leases")
+        self.db = db
+        self.query = query
+        self.page_size = page_size
+        self.projection = {field: 1 for field in fields}
+        if lease:
+            # Completion writes are filtered on the lease token
+            self.projection["lease_token"] = 1
+        self.checkpoint_key = checkpoint_key
+        self.lease = lease
+        self.scheduler = scheduler
+
+    def count(self) -> int:
+        """Count pending documents after the current checkpoint."""
+        return self.db.images.count_documents(self._page_query(self.load_checkpoint()))
+
+    def _page_query(self, last_id: Optional[Any]) -> Dict[str, Any]:
+        """Build the query for the page following ``last_id``."""
+        query = self.lease.claimable_query(self.query) if self.lease else dict(self.query)
+        if last_id is not None:
+            # Keep any _id range the base query is restricted to
+            bounds = query.get("_id", {})
+            query["_id"] = {**bounds, "$gt": last_id} if isinstance(bounds, dict) else bounds
+        return query
+
+    def iter_pages(self) -> Iterator[List[Dict[str, Any]]]:
+        """Yield pages of pending documents, starting after the checkpoint.
+
+        With a lease, each page is claimed before it is yielded and only
+        the documents this worker won are returned.
+        """
+        if self.scheduler:
+            yield from self._iter_scheduled_pages()
+            return
+
+        last_id = self.load_checkpoint()
+        if last_id is not None:
+            logger.info(f"Resuming after checkpointed image {last_id}")
+
+        while True:
+            page = list(
+                self.db.images.find(self._page_query(last_id), self.projection)
+                .sort("_id", ASCENDING)
+                .limit(self.page_size)
+            )
+            if not page:
+                return
+
+            last_id = page[-1]["_id"]
+            if self.lease:
+                page = self.lease.claim([doc["_id"] for doc in page], self.query, self.projection)
+                if not page:
+                    continue
+
+            yield page
+
+    def _iter_scheduled_pages(self) -> Iterator[List[Dict[str, Any]]]:
+        """Yield pages chosen by the scheduler, claimed in service order."""
+        while True:
+            selected = self.scheduler.select(self.lease.claimable_query(self.query), self.page_size)
+            if not selected:
+                return
+
+            claimed = {
+                doc["_id"]: doc
+                for doc in self.lease.claim([doc["_id"] for doc in selected], self.query, self.projection)
+            }
+            page = []
+            for doc in selected:
+                if doc["_id"] in claimed:
+                    page.append({**claimed[doc["_id"]], "effective_priority": doc["effective_priority"]})
+            self.scheduler.commit([doc for doc in selected if doc["_id"] in claimed])
+            if page:
+                yield page
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        """Yield pending documents one at a time."""
+        for page in self.iter_pages():
+            yield from page
+
+    def load_checkpoint(self) -> Optional[Any]:
+        """Return the last checkpointed ``_id``, if any."""
+        if not self.checkpoint_key:
+            return None
+        checkpoint = self.db[self.CHECKPOINT_COLLECTION].find_one({"_id": self.checkpoint_key})
+        return checkpoint["last_id"] if checkpoint else None
+
+    def save_checkpoint(self, last_id: Any) -> None:
+        """Record ``last_id`` as the last fully processed document.
+
+        Args:
+            last_id: ``_id`` of the last document whose result is persisted
+        """
+        if not self.checkpoint_key:
+            return
+        self.db[self.CHECKPOINT_COLLECTION].update_one(
+            {"_id": self.checkpoint_key},
+            {"$set": {"last_id": last_id, "updated_at": datetime.utcnow()}},
+            upsert=True
+        )
+
+    def clear_checkpoint(self) -> None:
+        """Remove the checkpoint after a complete pass over the dataset."""
+        if not self.checkpoint_key:
+            return
+        self.db[self.CHECKPOINT_COLLECTION].delete_one({"_id": self.checkpoint_key})
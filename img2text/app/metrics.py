@@ -0,0 +1,217 @@
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds, from fast per-image stages up to slow batches
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+Key = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+def _key(name: str, labels: Dict[str, Any]) -> Key:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...], **extra: str) -> str:
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+class MetricsRegistry:
+    """Process-wide counters and latency histograms.
+
+    Histograms have fixed buckets, so snapshots taken in other processes
+    (e.g. worker processes) can be merged by adding them up. Metrics are
+    rendered in the Prometheus text format or as a JSON summary with
+    p50/p95/p99 latencies interpolated from the buckets.
+    """
+
+    def __init__(self, prefix: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        """Create an empty registry.
+
+        Args:
+            prefix: Prefix of every exported metric name
+            buckets: Histogram bucket upper bounds in seconds
+        """
+        self.prefix = prefix
+        self.buckets = buckets
+        self._histograms: Dict[Key, List[float]] = {}
+        self._counters: Dict[Key, float] = {}
+        self._remote: Dict[Any, Dict[str, Dict[Key, Any]]] = {}
+        self._lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    def observe(self, name: str, seconds: float, **labels: Any) -> None:
+        """Record a duration in histogram ``name``."""
+        key = _key(name, labels)
+        with self._lock:
+            # Bucket counts followed by the sum of observations
+            values = self._histograms.setdefault(key, [0] * (len(self.buckets) + 1) + [0.0])
+            index = next((i for i, bound in enumerate(self.buckets) if seconds <= bound), len(self.buckets))
+            values[index] += 1
+            values[-1] += seconds
+
+    def inc(self, name: str, value: float = 1, **labels: Any) -> None:
+        """Add ``value`` to counter ``name``."""
+        key = _key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, stage: str) -> Iterator[None]:
+        """Time the enclosed block as one observation of ``stage``."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("stage_seconds", time.perf_counter() - started, stage=stage)
+
+    def snapshot(self) -> Dict[str, Dict[Key, Any]]:
+        """Copy of this process's metrics, for merging into another registry."""
+        with self._lock:
+            return {
+                "histograms": {key: list(values) for key, values in self._histograms.items()},
+                "counters": dict(self._counters),
+            }
+
+    def update_remote(self, source: Any, snapshot: Dict[str, Dict[Key, Any]]) -> None:
+        """Replace the latest snapshot received from ``source`` (e.g. a worker)."""
+        with self._lock:
+            self._remote[source] = snapshot
+
+    def reset(self) -> None:
+        """Drop all recorded metrics."""
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+            self._remote.clear()
+
+    def _merged(self) -> Dict[str, Dict[Key, Any]]:
+        """This process's metrics plus the latest remote snapshots."""
+        merged = self.snapshot()
+        with self._lock:
+            remotes = list(self._remote.values())
+        for remote in remotes:
+            for key, values in remote["histograms"].items():
+                current = merged["histograms"].setdefault(key, [0] * len(values))
+                merged["histograms"][key] = [a + b for a, b in zip(current, values)]
+            for key, value in remote["counters"].items():
+                merged["counters"][key] = merged["counters"].get(key, 0) + value
+        return merged
+
+    def _quantile(self, values: List[float], q: float) -> float:
+        """Estimate a quantile in seconds by interpolating within its bucket."""
+        counts = values[:-1]
+        rank = q * sum(counts)
+        seen = 0
+        for i, count in enumerate(counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[i - 1] if i else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return 0.0
+
+    def render_prometheus(self) -> str:
+        """Metrics in the Prometheus text exposition format."""
+        merged = self._merged()
+        lines = []
+        for name in sorted({key[0] for key in merged["histograms"]}):
+            metric = f"{self.prefix}_{name}"
+            lines.append(f"# TYPE {metric} histogram")
+            for (key_name, labels), values in sorted(merged["histograms"].items()):
+                if key_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), values[:-1]):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    lines.append(f"{metric}_bucket{_format_labels(labels, le=le)} {cumulative}")
+                lines.append(f"{metric}_sum{_format_labels(labels)} {values[-1]}")
+                lines.append(f"{metric}_count{_format_labels(labels)} {cumulative}")
+        for name in sorted({key[0] for key in merged["counters"]}):
+            metric = f"{self.prefix}_{name}"
+            lines.append(f"# TYPE {metric} counter")
+            for (key_name, labels), value in sorted(merged["counters"].items()):
+                if key_name == name:
+                    lines.append(f"{metric}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def _summary(self, values: List[float]) -> Dict[str, float]:
+        """Count, total and latency percentiles of one histogram."""
+        count = sum(values[:-1])
+        return {
+            "count": count,
+            "total_seconds": round(values[-1], 6),
+            "mean_ms": round(values[-1] / count * 1000, 3) if count else 0.0,
+            "p50_ms": round(self._quantile(values, 0.50) * 1000, 3),
+            "p95_ms": round(self._quantile(values, 0.95) * 1000, 3),
+            "p99_ms": round(self._quantile(values, 0.99) * 1000, 3),
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        """JSON-friendly summary: latency percentiles per stage, other histograms and counters."""
+        merged = self._merged()
+        stages, histograms = {}, {}
+        for (name, labels), values in sorted(merged["histograms"].items()):
+            if name == "stage_seconds":
+                stages[dict(labels)["stage"]] = self._summary(values)
+            else:
+                histograms[f"{name}{_format_labels(labels)}"] = self._summary(values)
+        counters = {
+            f"{name}{_format_labels(labels)}": value
+            for (name, labels), value in sorted(merged["counters"].items())
+        }
+        return {"stages": stages, "histograms": histograms, "counters": counters}
+
+    def dump(self, path: str) -> None:
+        """Write the JSON summary to ``path``."""
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+        logger.info(f"Metrics written to {path}")
+
+    def start_http_server(self, port: int, host: str = "0.0.0.0") -> None:
+        """Serve ``/metrics`` (Prometheus) and ``/metrics.json`` from a daemon thread."""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body, content_type = registry.render_prometheus(), "text/plain; version=0.0.4"
+                elif self.path == "/metrics.json":
+                    body, content_type = json.dumps(registry.to_dict()), "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                data = body.encode()
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(
+            target=self._server.serve_forever,
+            name=f"{self.prefix}-metrics",
+            daemon=True
+        ).start()
+        logger.info(f"Serving metrics on port {self._server.server_address[1]}")
+
+    def stop_http_server(self) -> None:
+        """Stop the metrics endpoint if it is running."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+METRICS = MetricsRegistry("img2text")
@@ -0,0 +1,96 @@
+import logging
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from transformers import BlipForConditionalGeneration, BlipProcessor
+
+logger = logging.getLogger(__name__)
+
+def is_snapshot(path: Optional[str]) -> bool:
+    """Check whether ``path`` holds a complete saved model snapshot."""
+    return bool(path) and (Path(path) / "config.json").is_file()
+
+def load_options(cache_dir: Optional[str] = None, offline: bool = False) -> Dict[str, Any]:
+    """Common ``from_pretrained`` options for loading from a local weight cache.
+
+    Args:
+        cache_dir: Pre-populated Hugging Face cache directory
+        offline: Never contact the Hub; fail if the weights are not cached
+    """
+    options: Dict[str, Any] = {"local_files_only": offline}
+    if cache_dir:
+        options["cache_dir"] = cache_dir
+    return options
+
+def load_captioning_model(model_name: str, device: str = "cpu",
+                          cache_dir: Optional[str] = None, offline: bool = False,
+                          snapshot_dir: Optional[str] = None
+                          ) -> Tuple[BlipProcessor, BlipForConditionalGeneration]:
+    """Load the BLIP processor and model with as little copying as possible.
+
+    A snapshot written by ``save_snapshot`` is preferred when present; it is
+    loaded from safetensors without touching the network. Otherwise the
+    weights are resolved from ``cache_dir`` (or the default Hugging Face
+    cache). Weights are loaded with ``low_cpu_mem_usage`` so they are
+    materialised once instead of being copied over a randomly initialised
+    model, and on GPU they are placed on the device directly.
+
+    Args:
+        model_name: Hub model ID or local model directory
+        device: ``cuda`` or ``cpu``
+        cache_dir: Pre-populated Hugging Face cache directory
+        offline: Never contact the Hub
+        snapshot_dir: Directory of a saved snapshot to load from if present
+
+    Returns:
+        Processor and model, ready for inference
+    """
+    started = time.monotonic()
+    options = load_options(cache_dir, offline)
+    source = model_name
+    if is_snapshot(snapshot_dir):
+        source = snapshot_dir
+        options = {"local_files_only": True, "use_safetensors": True}
+
+    logger.info(f"Loading model: {source}")
+    processor = BlipProcessor.from_pretrained(source, **options)
+    model = BlipForConditionalGeneration.from_pretrained(
+        source,
+        low_cpu_mem_usage=True,
+        device_map={"": device} if device == "cuda" else None,
+        **options
+    )
+    model.eval()
+    logger.info(f"Model loaded in {time.monotonic() - started:.1f}s")
+    return processor, model
+
+def save_snapshot(processor: BlipProcessor, model: BlipForConditionalGeneration,
+                  snapshot_dir: str) -> None:
+    """Save a loaded processor and model as a safetensors snapshot.
+
+    The snapshot is written to a temporary directory next to
+    ``snapshot_dir`` and renamed into place, so a concurrent loader never
+    sees a partial snapshot.
+
+    Args:
+        processor: Loaded BLIP processor
+        model: Loaded BLIP model
+        snapshot_dir: Target directory, replaced if it exists
+    """
+    target = Path(snapshot_dir)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=target.parent, prefix=f".{target.name}-")
+    try:
+        processor.save_pretrained(tmp_dir)
+        model.save_pretrained(tmp_dir, safe_serialization=True)
+        if target.exists():
+            shutil.rmtree(target)
+        os.replace(tmp_dir, target)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    logger.info(f"Saved model snapshot to {target}")
@@ -0,0 +1,132 @@
+import io
+import logging
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional
+
+from PIL import Image
+
+from .dedup import content_hash, perceptual_hash
+from .metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+@dataclass
+class PreparedImage:
+    """An image document together with its preprocessed model inputs."""
+
+    document: Dict[str, Any]
+    inputs: Optional[Dict[str, Any]] = None
+    error: Optional[Exception] = None
+    content_hash: Optional[str] = None
+    perceptual_hash: Optional[str] = None
+
+class ImagePrefetcher:
+    """Bounded producer/consumer stage that decodes images ahead of inference.
+
+    Documents are handed to a thread pool that opens each file, converts it
+    to RGB and runs the preprocessing callable. At most ``queue_size``
+    images are in flight at any time, so decoding overlaps with inference
+    without loading the whole dataset into memory.
+
+    With ``compute_hashes``, the content and perceptual hashes used for
+    duplicate detection are computed on the same worker threads, from the
+    bytes and image already in memory.
+    """
+
+    def __init__(self, preprocess: Callable[[Image.Image], Dict[str, Any]],
+                 num_workers: int = 4, queue_size: int = 32,
+                 compute_hashes: bool = False):
+        """Initialize the prefetcher.
+
+        Args:
+            preprocess: Callable turning an RGB image into model inputs
+            num_workers: Number of decode worker threads
+            queue_size: Maximum number of images decoded ahead of the consumer
+            compute_hashes: Also hash each image for duplicate detection
+        """
+        self.preprocess = preprocess
+        self.queue_size = queue_size
+        self.compute_hashes = compute_hashes
+        self.executor = ThreadPoolExecutor(
+            max_workers=num_workers,
+            thread_name_prefix="img2text-decode"
+        )
+
+    def _prepare(self, document: Dict[str, Any]) -> PreparedImage:
+        """Decode and preprocess a single image document."""
+        try:
+            with METRICS.timer("decode"):
+                with open(document["path"], "rb") as f:
+                    data = f.read()
+                with Image.open(io.BytesIO(data)) as image:
+                    rgb = image.convert("RGB")
+            with METRICS.timer("preprocess"):
+                inputs = self.preprocess(rgb)
+            if not self.compute_hashes:
+                return PreparedImage(document=document, inputs=inputs)
+
+            with METRICS.timer("hash"):
+                return PreparedImage(
+                    document=document,
+                    inputs=inputs,
+                    content_hash=content_hash(data),
+                    perceptual_hash=perceptual_hash(rgb)
+                )
+        except Exception as e:
+            return PreparedImage(document=document, error=e)
+
+    def iter_prepared(self, documents: Iterable[Dict[str, Any]]) -> Iterator[PreparedImage]:
+        """Yield prepared images in document order.
+
+        Args:
+            documents: Image documents to decode
+
+        Yields:
+            PreparedImage for each document, with either inputs or an error
+        """
+        pending: Deque[Future] = deque()
+        for document in documents:
+            pending.append(self.executor.submit(self._prepare, document))
+            if len(pending) >= self.queue_size:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+    def iter_batches(self, documents: Iterable[Dict[str, Any]],
+                     batch_size: int,
+                     split_on: Optional[str] = None) -> Iterator[List[PreparedImage]]:
+        """Yield prepared images grouped into lists of ``batch_size``.
+
+        Args:
+            documents: Image documents to decode
+            batch_size: Number of images per batch
+            split_on: Document field; a batch is cut short whenever its
+                value changes, e.g. so a batch holds one priority class
+        """
+        batch = []
+        for prepared in self.iter_prepared(documents):
+            if split_on and batch and batch[-1].document.get(split_on) != prepared.document.get(split_on):
+                yield batch
+                batch = []
+            batch.append(prepared)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+
+        if batch:
+            yield batch
+
+    def close(self) -> None:
+        """Shut down the worker pool, cancelling any queued work."""
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self):
+        """Context manager entry."""
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """Context manager exit."""
+        self.close()
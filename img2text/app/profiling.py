@@ -0,0 +1,128 @@
+import logging
+import os
+import pickle
+import time
+from typing import Optional
+
+import torch
+from torch.profiler import ProfilerActivity, profile
+
+logger = logging.getLogger(__name__)
+
+# Allocation events kept by the CUDA memory history
+MEMORY_HISTORY_ENTRIES = 100_000
+
+# torch 2.1 replaced the private memory history API used by torch 2.0
+TORCH_2_1 = tuple(int(part) for part in torch.__version__.split(".")[:2]) >= (2, 1)
+
+def start_memory_history() -> None:
+    """Start recording CUDA allocation events."""
+    if TORCH_2_1:
+        torch.cuda.memory._record_memory_history(max_entries=MEMORY_HISTORY_ENTRIES)
+    else:
+        torch.cuda.memory._record_memory_history(True, trace_alloc_max_entries=MEMORY_HISTORY_ENTRIES)
+
+def dump_memory_history(path: str) -> None:
+    """Write the recorded CUDA allocation events to ``path`` and stop recording."""
+    if TORCH_2_1:
+        torch.cuda.memory._dump_snapshot(path)
+        torch.cuda.memory._record_memory_history(enabled=None)
+    else:
+        with open(path, "wb") as f:
+            pickle.dump(torch.cuda.memory._snapshot(), f)
+        torch.cuda.memory._record_memory_history(False)
+
+class BatchProfiler:
+    """Profiles the first ``batches`` batches with ``torch.profiler``, then stops.
+
+    Only operators run on the thread that called ``start`` are recorded,
+    so ``start``, ``step`` and ``stop`` must be called from the thread
+    running the model. When profiling stops, three files are written to
+    ``output_dir``, named ``<name>-<pid>-<time>``:
+
+    - ``.trace.json``: Chrome trace, viewable in Perfetto or chrome://tracing
+    - ``.ops.txt``: operator summaries sorted by time and by allocated memory
+    - ``.memory.pickle``: CUDA allocation snapshot for
+      https://pytorch.org/memory_viz (CUDA only; CPU allocations are in the
+      operator summary)
+
+    Callers keep no profiler at all when profiling is off, so normal runs
+    pay nothing for it.
+    """
+
+    def __init__(self, batches: int, output_dir: str, name: str):
+        """Prepare a profiler; nothing is recorded until ``start``.
+
+        Args:
+            batches: Number of batches to profile
+            output_dir: Directory the trace files are written to
+            name: Prefix of the trace file names
+        """
+        self.batches = batches
+        self.output_dir = output_dir
+        self.name = name
+        self.steps = 0
+        self.cuda = torch.cuda.is_available()
+        self._profiler: Optional[profile] = None
+        self._finished = False
+
+    @property
+    def active(self) -> bool:
+        """Whether batches are currently being recorded."""
+        return self._profiler is not None
+
+    def start(self) -> None:
+        """Start recording, unless profiling already ran."""
+        if self._finished or self._profiler is not None:
+            return
+        activities = [ProfilerActivity.CPU]
+        if self.cuda:
+            activities.append(ProfilerActivity.CUDA)
+            start_memory_history()
+        self._profiler = profile(
+            activities=activities,
+            record_shapes=True,
+            profile_memory=True,
+            with_stack=True
+        )
+        self._profiler.start()
+        logger.info(f"Profiling the next {self.batches} batches")
+
+    def step(self) -> None:
+        """Mark the end of a batch, stopping once ``batches`` were recorded."""
+        if self._profiler is None:
+            return
+        self._profiler.step()
+        self.steps += 1
+        if self.steps >= self.batches:
+            self.stop()
+
+    def stop(self) -> None:
+        """Stop recording and write the trace files."""
+        if self._profiler is None:
+            return
+        profiler, self._profiler = self._profiler, None
+        self._finished = True
+        profiler.stop()
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        stem = os.path.join(
+            self.output_dir,
+            f"{self.name}-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}"
+        )
+        profiler.export_chrome_trace(f"{stem}.trace.json")
+
+        averages = profiler.key_averages()
+        time_key = "self_cuda_time_total" if self.cuda else "self_cpu_time_total"
+        memory_key = "self_cuda_memory_usage" if self.cuda else "self_cpu_memory_usage"
+        with open(f"{stem}.ops.txt", "w") as f:
+            f.write(f"Profiled {self.steps} batches\n\n")
+            f.write(f"Operators by {time_key}\n")
+            f.write(averages.table(sort_by=time_key, row_limit=50))
+            f.write(f"\n\nOperators by {memory_key}\n")
+            f.write(averages.table(sort_by=memory_key, row_limit=50))
+            f.write("\n")
+
+        if self.cuda:
+            dump_memory_history(f"{stem}.memory.pickle")
+        logger.info(f"Profile of {self.steps} batches written to {stem}.*")
@@ -0,0 +1,160 @@
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING
+from pymongo.collection import Collection
+
+logger = logging.getLogger(__name__)
+
+def parse_weights(spec: Optional[str]) -> Dict[str, float]:
+    """Parse fair-share weights written as ``name=weight,name=weight``.
+
+    Args:
+        spec: Weight specification, e.g. ``interactive=4,backfill=0.5``
+
+    Returns:
+        Weight per flow name
+    """
+    weights = {}
+    for item in filter(None, (part.strip() for part in (spec or "").split(","))):
+        name, sep, weight = item.partition("=")
+        if not sep:
+            raise ValueError(f"Invalid fair-share weight {item!r}, expected name=weight")
+        weights[name.strip()] = float(weight)
+    return weights
+
+class FairShareScheduler:
+    """Chooses which pending documents to claim next.
+
+    Documents are grouped into flows by ``flow_field`` (e.g. ``dataset_id``)
+    and ranked by an effective priority: their ``priority`` field (default
+    0, higher first) plus one for every ``age_boost_seconds`` they have been
+    waiting, so low-priority work is never starved. Waiting time is read
+    from ObjectId ``_id``s; documents with other ``_id`` types do not age.
+    Each selection is taken from the highest effective priority class only,
+    so batches never mix classes.
+
+    Within a class, flows share the selection by start-time weighted fair
+    queuing. Every claimed document costs its flow ``1 / weight`` of
+    virtual time and the flow with the earliest start tag goes next. A flow
+    that was idle restarts at the current virtual time rather than
+    catching up, so one large dataset cannot starve small ones, and a flow
+    with weight 4 gets four documents for every one of a weight 1 flow.
+
+    Candidates are the highest-priority and the oldest documents of each
+    flow, found with two indexed queries per flow.
+    """
+
+    def __init__(self, collection: Collection, weights: Optional[Dict[str, float]] = None,
+                 flow_field: str = "dataset_id", age_boost_seconds: float = 600.0,
+                 default_weight: float = 1.0):
+        """Initialize the scheduler.
+
+        Args:
+            collection: Collection holding the work documents
+            weights: Fair-share weight per flow
+            flow_field: Field identifying a document's flow
+            age_boost_seconds: Waiting time that raises a document's priority
+                by one; 0 disables aging
+            default_weight: Weight of flows not listed in ``weights``
+        """
+        self.collection = collection
+        self.weights = weights or {}
+        self.flow_field = flow_field
+        self.age_boost_seconds = age_boost_seconds
+        self.default_weight = default_weight
+        self._finish: Dict[Any, float] = {}
+        self._virtual_time = 0.0
+
+    def weight(self, flow: Any) -> float:
+        """Fair-share weight of a flow."""
+        return self.weights.get(str(flow), self.default_weight)
+
+    @staticmethod
+    def priority(document: Dict[str, Any]) -> int:
+        """Priority requested by a document; missing or invalid values count as 0."""
+        try:
+            return int(document.get("priority") or 0)
+        except (TypeError, ValueError):
+            return 0
+
+    def effective_priority(self, document: Dict[str, Any], now: datetime) -> int:
+        """Priority of a document after age boosting."""
+        priority = self.priority(document)
+        if self.age_boost_seconds <= 0:
+            return priority
+
+        if not isinstance(document["_id"], ObjectId):
+            return priority
+        created = document["_id"].generation_time.replace(tzinfo=None)
+        age = (now - created).total_seconds()
+        return priority + max(0, int(age // self.age_boost_seconds))
+
+    def select(self, query: Dict[str, Any], limit: int) -> List[Dict[str, Any]]:
+        """Pick up to ``limit`` documents to claim next.
+
+        Nothing is charged until ``commit`` is called with the documents
+        that were actually claimed.
+
+        Args:
+            query: Filter selecting claimable documents
+            limit: Maximum number of documents
+
+        Returns:
+            Documents with ``_id``, ``priority``, the flow field and an
+            ``effective_priority`` key, in service order
+        """
+        projection = {"_id": 1, "priority": 1, self.flow_field: 1}
+        if self.flow_field in query:
+            # Already restricted to one flow, e.g. a single dataset
+            flow_queries = [query]
+        else:
+            # Documents without the flow field form one flow, matched by None
+            flows = [None, *self.collection.distinct(self.flow_field, query)]
+            flow_queries = [{**query, self.flow_field: flow} for flow in flows]
+
+        candidates: Dict[Any, Dict[str, Any]] = {}
+        for flow_query in flow_queries:
+            for sort in ([("priority", DESCENDING), ("_id", ASCENDING)], [("_id", ASCENDING)]):
+                for document in self.collection.find(flow_query, projection).sort(sort).limit(limit):
+                    candidates[document["_id"]] = document
+        if not candidates:
+            return []
+
+        now = datetime.utcnow()
+        for document in candidates.values():
+            document["effective_priority"] = self.effective_priority(document, now)
+        top = max(document["effective_priority"] for document in candidates.values())
+
+        queues: Dict[Any, List[Dict[str, Any]]] = {}
+        for document in sorted(candidates.values(), key=lambda d: (-self.priority(d), d["_id"])):
+            if document["effective_priority"] == top:
+                queues.setdefault(document.get(self.flow_field), []).append(document)
+
+        finish = dict(self._finish)
+        virtual_time = self._virtual_time
+        selected = []
+        while queues and len(selected) < limit:
+            starts = {flow: max(virtual_time, finish.get(flow, 0.0)) for flow in queues}
+            flow = min(queues, key=lambda f: (starts[f], str(f)))
+            virtual_time = starts[flow]
+            finish[flow] = starts[flow] + 1 / self.weight(flow)
+            selected.append(queues[flow].pop(0))
+            if not queues[flow]:
+                del queues[flow]
+        logger.debug(f"Selected {len(selected)} documents at priority {top}")
+        return selected
+
+    def commit(self, documents: List[Dict[str, Any]]) -> None:
+        """Charge flows for the documents that were claimed.
+
+        Args:
+            documents: Claimed documents, in service order
+        """
+        for document in documents:
+            flow = document.get(self.flow_field)
+            start = max(self._virtual_time, self._finish.get(flow, 0.0))
+            self._finish[flow] = start + 1 / self.weight(flow)
+            self._virtual_time = start
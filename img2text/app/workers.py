@@ -0,0 +1,168 @@
+import logging
+import multiprocessing
+import os
+import queue
+import time
+from collections import Counter
+from dataclasses import replace
+from typing import Any, Dict, List, Optional
+
+import pymongo
+from pymongo.database import Database
+
+from .config import Config
+from .indexes import check_pending_queries, ensure_indexes
+from .metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+def shard_ranges(db: Database, query: Dict[str, Any], num_shards: int) -> List[Dict[str, Any]]:
+    """Split the documents matching ``query`` into ``_id`` ranges of similar size.
+
+    Boundaries come from ``$bucketAuto`` over the pending ``_id`` values. The
+    first range is open below and the last open above, so documents added
+    while the workers run are still covered.
+
+    Args:
+        db: Database holding the ``images`` collection
+        query: Filter selecting pending documents
+        num_shards: Number of ranges wanted
+
+    Returns:
+        One ``_id`` filter per shard; fewer than ``num_shards`` when there
+        are not enough documents
+    """
+    buckets = list(db.images.aggregate([
+        {"$match": query},
+        {"$bucketAuto": {"groupBy": "$_id", "buckets": num_shards}},
+    ]))
+    if len(buckets) <= 1:
+        return [{}]
+
+    bounds = [bucket["_id"]["min"] for bucket in buckets[1:]]
+    shards = [{"_id": {"$lt": bounds[0]}}]
+    shards += [{"_id": {"$gte": lo, "$lt": hi}} for lo, hi in zip(bounds, bounds[1:])]
+    shards.append({"_id": {"$gte": bounds[-1]}})
+    return shards
+
+def _run_worker(index: int, config: Config, shard: Dict[str, Any],
+                events: multiprocessing.Queue) -> None:
+    """Worker process: caption one shard and report progress to the parent."""
+    # Imported here so the parent never loads the model
+    from .core import ImageCaptioner
+
+    try:
+        with ImageCaptioner(config) as captioner:
+            counts = captioner.process_dataset(
+                shard=shard,
+                progress=lambda n: events.put(("progress", index, (n, METRICS.snapshot())))
+            )
+        events.put(("done", index, (counts, METRICS.snapshot())))
+    except Exception as e:
+        logging.getLogger(__name__).error(f"Worker {index} failed: {str(e)}")
+        events.put(("failed", index, str(e)))
+
+def run_workers(config: Config, num_workers: int,
+                threads_per_worker: Optional[int] = None,
+                log_interval: float = 10.0) -> Dict[str, int]:
+    """Caption the dataset with ``num_workers`` processes, one model each.
+
+    Pending documents are split into disjoint ``_id`` ranges, one per
+    worker. Each worker is given an equal share of the CPU cores as its
+    torch thread budget, so the processes do not oversubscribe the machine.
+    Workers send their metrics with every progress report, so the parent's
+    metrics endpoint shows all workers combined.
+
+    Args:
+        config: Configuration shared by all workers
+        num_workers: Number of worker processes
+        threads_per_worker: Intra-op threads per worker (default: cores / workers)
+        log_interval: Seconds between aggregated progress log lines
+
+    Returns:
+        Counts summed over all workers, plus ``failed_workers``
+    """
+    query = {"status": "pending"}
+    if config.dataset_id:
+        query["dataset_id"] = config.dataset_id
+
+    with pymongo.MongoClient(config.mongo_uri) as client:
+        db = client.get_default_database()
+        if config.ensure_indexes:
+            ensure_indexes(db)
+            check_pending_queries(db, config.dataset_id)
+        total = db.images.count_documents(query)
+        shards = shard_ranges(db, query, num_workers)
+
+    threads = threads_per_worker or max(1, (os.cpu_count() or 1) // len(shards))
+    logger.info(
+        f"Starting {len(shards)} workers for {total} pending images, "
+        f"{threads} threads each"
+    )
+
+    context = multiprocessing.get_context("spawn")
+    events = context.Queue()
+    processes = []
+    for index, shard in enumerate(shards):
+        worker_config = replace(
+            config,
+            intra_op_threads=config.intra_op_threads or threads,
+            inter_op_threads=config.inter_op_threads or 1,
+            prefetch_workers=min(config.prefetch_workers, threads),
+            ensure_indexes=False,
+            worker_id=f"{config.worker_id}-{index}" if config.worker_id else None,
+            # One spill file per worker, each replayed by the same worker next run
+            callback_spill_path=f"{config.callback_spill_path}.{index}" if config.callback_spill_path else None
+        )
+        process = context.Process(
+            target=_run_worker,
+            args=(index, worker_config, shard, events),
+            name=f"img2text-worker-{index}"
+        )
+        process.start()
+        processes.append(process)
+
+    totals: Counter = Counter()
+    finished = set()
+    done = 0
+    started = last_log = time.monotonic()
+    while len(finished) < len(processes):
+        try:
+            kind, index, payload = events.get(timeout=1.0)
+        except queue.Empty:
+            # A worker that died without reporting (e.g. OOM-killed) counts as failed
+            for index, process in enumerate(processes):
+                if index not in finished and not process.is_alive():
+                    logger.error(f"Worker {index} exited with code {process.exitcode}")
+                    finished.add(index)
+                    totals["failed_workers"] += 1
+            continue
+
+        if kind == "progress":
+            n, snapshot = payload
+            done += n
+            METRICS.update_remote(index, snapshot)
+        elif kind == "done":
+            counts, snapshot = payload
+            finished.add(index)
+            totals.update(counts)
+            METRICS.update_remote(index, snapshot)
+        elif kind == "failed":
+            finished.add(index)
+            totals["failed_workers"] += 1
+
+        now = time.monotonic()
+        if now - last_log >= log_interval:
+            rate = done / (now - started)
+            logger.info(f"Progress: {done}/{total} images, {rate:.1f} images/s")
+            last_log = now
+
+    for process in processes:
+        process.join()
+
+    elapsed = time.monotonic() - started
+    logger.info(
+        f"Workers finished: {done} images in {elapsed:.1f}s "
+        f"({done / elapsed if elapsed else 0:.1f} images/s), {dict(totals)}"
+    )
+    return dict(totals)
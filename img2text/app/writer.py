@@ -0,0 +1,154 @@
+import logging
+import threading
+import time
+from typing import Any, Dict, List, Tuple
+
+from pymongo import UpdateOne
+from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from .metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+class BulkWriter:
+    """Buffers MongoDB updates and flushes them as unordered bulk writes.
+
+    Updates are flushed when ``batch_size`` operations are buffered or when
+    ``flush_interval`` seconds have passed since the last flush, whichever
+    comes first. Documents that fail to update are logged and kept in
+    ``failures`` so that callers can report them. Updates that match no
+    document, e.g. because the filter names a lease another worker has
+    since taken over, are counted in ``unmatched``.
+    """
+
+    def __init__(self, collection: Collection, batch_size: int = 100,
+                 flush_interval: float = 1.0):
+        """Initialize the writer.
+
+        Args:
+            collection: Collection the updates are applied to
+            batch_size: Number of buffered updates that triggers a flush
+            flush_interval: Maximum seconds an update stays buffered
+        """
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.failures: List[Dict[str, Any]] = []
+        self.unmatched = 0
+
+        self._ops: List[Tuple[Dict[str, Any], Dict[str, Any]]] = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._closed = threading.Event()
+
+        self._thread = None
+        if flush_interval > 0:
+            self._thread = threading.Thread(
+                target=self._flush_periodically,
+                name="img2text-bulk-writer",
+                daemon=True
+            )
+            self._thread.start()
+
+    @property
+    def pending(self) -> int:
+        """Number of buffered updates, including failed ones awaiting a retry."""
+        with self._lock:
+            return len(self._ops)
+
+    def update_one(self, filter: Dict[str, Any], update: Dict[str, Any]) -> None:
+        """Queue a single-document update.
+
+        Args:
+            filter: Filter selecting the document
+            update: Update operators to apply
+        """
+        with self._lock:
+            self._ops.append((filter, update))
+            full = len(self._ops) >= self.batch_size
+
+        if full:
+            self.flush()
+
+    def flush(self) -> int:
+        """Write all buffered updates.
+
+        Returns:
+            Number of documents that failed to update in this flush
+        """
+        with self._flush_lock:
+            with self._lock:
+                ops, self._ops = self._ops, []
+                self._last_flush = time.monotonic()
+
+            if not ops:
+                return 0
+
+            try:
+                with METRICS.timer("mongo_write"):
+                    result = self.collection.bulk_write(
+                        [UpdateOne(f, u) for f, u in ops],
+                        ordered=False
+                    )
+                self._count_unmatched(len(ops) - result.matched_count)
+                logger.debug(f"Flushed {len(ops)} updates to {self.collection.name}")
+                return 0
+            except BulkWriteError as e:
+                errors = e.details.get("writeErrors", [])
+                self._count_unmatched(len(ops) - len(errors) - e.details.get("nMatched", 0))
+                for error in errors:
+                    self._record_failure(ops[error["index"]][0], error.get("errmsg", "unknown error"))
+                return len(errors)
+            except PyMongoError as e:
+                if self._closed.is_set():
+                    for f, _ in ops:
+                        self._record_failure(f, str(e))
+                    return len(ops)
+
+                # Keep the updates so the next flush retries them
+                logger.warning(f"Bulk write of {len(ops)} updates failed, will retry: {str(e)}")
+                with self._lock:
+                    self._ops[:0] = ops
+                return 0
+
+    def _count_unmatched(self, count: int) -> None:
+        """Record updates whose filter matched no document."""
+        if count <= 0:
+            return
+        self.unmatched += count
+        METRICS.inc("leases_lost_total", count)
+        logger.warning(f"{count} updates matched no document, most likely because another worker took over their lease")
+
+    def _record_failure(self, filter: Dict[str, Any], error: str) -> None:
+        """Record a document whose update could not be written."""
+        logger.error(f"Failed to update document {filter.get('_id')}: {error}")
+        self.failures.append({"filter": filter, "error": error})
+
+    def _flush_periodically(self) -> None:
+        """Background loop flushing updates older than ``flush_interval``."""
+        while not self._closed.wait(self.flush_interval):
+            if time.monotonic() - self._last_flush < self.flush_interval:
+                continue
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Background flush failed: {str(e)}")
+
+    def close(self) -> None:
+        """Stop the background flusher and write any remaining updates."""
+        self._closed.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+        if self.failures:
+            logger.error(f"{len(self.failures)} document updates could not be written")
+
+    def __enter__(self):
+        """Context manager entry."""
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """Context manager exit, flushing buffered updates."""
+        self.close()
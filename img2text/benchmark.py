@@ -0,0 +1,350 @@
+import argparse
+import functools
+import json
+import logging
+import os
+import platform
+import resource
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import ExitStack, contextmanager
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List
+
+import numpy as np
+from PIL import Image
+
+from app.utils import setup_logging
+
+logger = logging.getLogger(__name__)
+
+MOCK_MONGO_URI = "mongodb://localhost:27017/img2text_benchmark"
+
+MONGO_METHODS = (
+    "find", "find_one", "find_one_and_update", "update_one", "update_many",
+    "insert_one", "insert_many", "bulk_write", "aggregate", "count_documents",
+    "delete_one", "delete_many", "replace_one", "create_index", "create_indexes",
+)
+
+def create_synthetic_images(directory: str, count: int, size: int = 384, seed: int = 0) -> List[str]:
+    """Write ``count`` distinct random JPEG images and return their paths."""
+    rng = np.random.default_rng(seed)
+    paths = []
+    for i in range(count):
+        # Smooth gradients plus noise compress like photos rather than pure noise
+        base = rng.integers(0, 256, size=(4, 4, 3), dtype=np.uint8)
+        image = Image.fromarray(base).resize((size, size), Image.BILINEAR)
+        noise = rng.integers(-16, 16, size=(size, size, 3))
+        pixels = np.clip(np.asarray(image, dtype=np.int16) + noise, 0, 255).astype(np.uint8)
+        path = os.path.join(directory, f"synthetic_{i:06d}.jpg")
+        Image.fromarray(pixels).save(path, quality=90)
+        paths.append(path)
+    return paths
+
+def create_tiny_model(directory: str) -> str:
+    """Save a randomly initialised BLIP captioning model small enough to run anywhere.
+
+    Captions are meaningless, but every stage of the pipeline runs, so the
+    benchmark needs neither network access nor a GPU.
+    """
+    from transformers import (BertTokenizer, BlipConfig, BlipForConditionalGeneration,
+                              BlipImageProcessor, BlipProcessor)
+
+    os.makedirs(directory, exist_ok=True)
+    vocab = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", "[DEC]"] + [f"w{i}" for i in range(58)]
+    with open(os.path.join(directory, "vocab.txt"), "w") as f:
+        f.write("\n".join(vocab))
+    tokenizer = BertTokenizer(os.path.join(directory, "vocab.txt"))
+    tokenizer.add_special_tokens({"bos_token": "[DEC]"})
+    image_processor = BlipImageProcessor(size={"height": 64, "width": 64})
+    BlipProcessor(image_processor, tokenizer).save_pretrained(directory)
+
+    config = BlipConfig(
+        text_config=dict(vocab_size=len(vocab), hidden_size=64, num_hidden_layers=2,
+                         num_attention_heads=4, intermediate_size=128, bos_token_id=5,
+                         pad_token_id=0, sep_token_id=3, eos_token_id=3),
+        vision_config=dict(hidden_size=64, image_size=64, patch_size=16, num_hidden_layers=2,
+                           num_attention_heads=4, intermediate_size=128)
+    )
+    BlipForConditionalGeneration(config).save_pretrained(directory, safe_serialization=True)
+    return directory
+
+class StageTimer:
+    """Collects wall-clock latencies of named pipeline stages."""
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.samples[stage].append(seconds)
+
+    @contextmanager
+    def wrap(self, owner: Any, name: str, stage: str) -> Iterator[None]:
+        """Time every call of ``owner.name`` as ``stage`` until the context exits."""
+        original = getattr(owner, name)
+
+        @functools.wraps(original)
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.record(stage, time.perf_counter() - started)
+
+        setattr(owner, name, timed)
+        try:
+            yield
+        finally:
+            if isinstance(owner, type):
+                setattr(owner, name, original)
+            else:
+                delattr(owner, name)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """Call count, total and p50/p95/p99 latency in milliseconds per stage."""
+        result = {}
+        for stage, samples in sorted(self.samples.items()):
+            ms = np.asarray(samples) * 1000
+            result[stage] = {
+                "calls": len(samples),
+                "total_ms": round(float(ms.sum()), 3),
+                "p50_ms": round(float(np.percentile(ms, 50)), 3),
+                "p95_ms": round(float(np.percentile(ms, 95)), 3),
+                "p99_ms": round(float(np.percentile(ms, 99)), 3),
+            }
+        return result
+
+class MongoCallCounter:
+    """Counts MongoDB round trips by operation.
+
+    Real servers are observed through pymongo command monitoring. For
+    mongomock, which sends no commands, the public collection methods are
+    counted instead; calls made from inside another counted call are not.
+    """
+
+    def __init__(self):
+        self.counts: Counter = Counter()
+        self._local = threading.local()
+
+    def listener(self):
+        """Command listener to pass to ``pymongo.monitoring.register``."""
+        from pymongo import monitoring
+
+        counter = self
+
+        class Listener(monitoring.CommandListener):
+            def started(self, event):
+                if not getattr(counter._local, "depth", 0):
+                    counter.counts[event.command_name] += 1
+
+            def succeeded(self, event):
+                pass
+
+            def failed(self, event):
+                pass
+
+        return Listener()
+
+    @contextmanager
+    def patch_mongomock(self) -> Iterator[None]:
+        """Count calls to mongomock collection methods until the context exits."""
+        from mongomock.collection import Collection
+
+        originals = {name: getattr(Collection, name) for name in MONGO_METHODS}
+        for name, original in originals.items():
+            setattr(Collection, name, self._counted(name, original))
+        try:
+            yield
+        finally:
+            for name, original in originals.items():
+                setattr(Collection, name, original)
+
+    @contextmanager
+    def paused(self) -> Iterator[None]:
+        """Do not count calls made by the benchmark itself."""
+        depth = getattr(self._local, "depth", 0)
+        self._local.depth = depth + 1
+        try:
+            yield
+        finally:
+            self._local.depth = depth
+
+    def _counted(self, name: str, original: Callable) -> Callable:
+        @functools.wraps(original)
+        def counted(*args, **kwargs):
+            depth = getattr(self._local, "depth", 0)
+            if depth == 0:
+                self.counts[name] += 1
+            self._local.depth = depth + 1
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self._local.depth = depth
+        return counted
+
+def peak_rss_mb() -> Dict[str, float]:
+    """Peak resident set size of this process and of its finished children, in MB."""
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return {
+        "self": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1),
+        "children": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1),
+    }
+
+def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    """Caption synthetic images end to end and measure every stage."""
+    import pymongo
+
+    timer = StageTimer()
+    mongo_calls = MongoCallCounter()
+
+    with ExitStack() as stack:
+        workdir = stack.enter_context(tempfile.TemporaryDirectory(prefix="img2text-benchmark-"))
+        mongo_uri = args.mongo_uri
+        if mongo_uri:
+            pymongo.monitoring.register(mongo_calls.listener())
+        else:
+            try:
+                import mongomock
+            except ImportError:
+                raise SystemExit("mongomock is required without --mongo_uri: pip install mongomock")
+            stack.enter_context(mongomock.patch(servers=(("localhost", 27017),)))
+            mongo_uri = MOCK_MONGO_URI
+
+        # Imported after patching so every client the service creates is mocked
+        from app import Config, ImageCaptioner
+        from app.pipeline import ImagePrefetcher
+
+        model_name = args.model_name
+        if args.tiny_model:
+            model_name = create_tiny_model(os.path.join(workdir, "tiny-blip"))
+
+        dataset_id = f"benchmark-{datetime.utcnow():%Y%m%d%H%M%S}"
+        image_dir = os.path.join(workdir, "images")
+        os.makedirs(image_dir)
+        paths = create_synthetic_images(image_dir, args.warmup + args.images, args.image_size, args.seed)
+
+        config = Config(
+            mongo_uri=mongo_uri,
+            model_name=model_name,
+            batch_size=args.batch_size,
+            use_gpu=not args.cpu,
+            decoding_strategy=args.decoding_strategy,
+            compute_confidence=args.compute_confidence,
+            cpu_optimize=args.cpu_optimize,
+            prefetch_workers=args.prefetch_workers,
+            fetch_page_size=args.fetch_page_size,
+            ensure_indexes=bool(args.mongo_uri),
+            dedup=args.dedup,
+            embedding_cache_dir=os.path.join(workdir, "embeddings") if args.embedding_cache else None,
+            offline=args.tiny_model,
+            dataset_id=dataset_id
+        )
+        config.validate()
+
+        started = time.perf_counter()
+        captioner = stack.enter_context(ImageCaptioner(config))
+        load_seconds = time.perf_counter() - started
+
+        # Warm up the model and decode threads outside the measurement
+        if args.warmup:
+            captioner.db.images.insert_many([
+                {"path": path, "dataset_id": dataset_id, "status": "pending"} for path in paths[:args.warmup]
+            ])
+            captioner.process_dataset()
+            captioner.db.images.delete_many({"dataset_id": dataset_id})
+        
+        captioner.db.images.insert_many([
+            {"path": path, "dataset_id": dataset_id, "status": "pending"} for path in paths[args.warmup:]
+        ])
+        if not args.mongo_uri:
+            stack.enter_context(mongo_calls.patch_mongomock())
+
+        stack.enter_context(timer.wrap(ImagePrefetcher, "_prepare", "decode"))
+        stack.enter_context(timer.wrap(captioner, "_preprocess", "preprocess"))
+        stack.enter_context(timer.wrap(captioner, "_generate_scored", "inference"))
+        stack.enter_context(timer.wrap(captioner.writer.collection, "bulk_write", "mongo_write"))
+
+        started = time.perf_counter()
+        counts = captioner.process_dataset()
+        elapsed = time.perf_counter() - started
+        with mongo_calls.paused():
+            captioner.db.images.delete_many({"dataset_id": dataset_id})
+
+    import torch
+    import transformers
+
+    completed = counts.get("completed", 0)
+    return {
+        "service": "img2text",
+        "timestamp": datetime.utcnow().isoformat(),
+        "environment": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "transformers": transformers.__version__,
+            "cpu_count": os.cpu_count(),
+            "cuda": torch.cuda.is_available() and not args.cpu,
+            "mongo": "server" if args.mongo_uri else "mongomock",
+        },
+        "parameters": {
+            "images": args.images,
+            "warmup": args.warmup,
+            "image_size": args.image_size,
+            "batch_size": args.batch_size,
+            "model_name": "tiny-random-blip" if args.tiny_model else args.model_name,
+            "decoding_strategy": args.decoding_strategy,
+            "compute_confidence": args.compute_confidence,
+            "cpu_optimize": args.cpu_optimize,
+            "dedup": args.dedup,
+            "embedding_cache": args.embedding_cache,
+        },
+        "counts": counts,
+        "model_load_seconds": round(load_seconds, 3),
+        "elapsed_seconds": round(elapsed, 3),
+        "images_per_second": round(completed / elapsed, 3) if elapsed else 0.0,
+        "stages": timer.summary(),
+        "mongo_round_trips": {"total": sum(mongo_calls.counts.values()), **dict(mongo_calls.counts)},
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+def main():
+    """Entry point for the img2text benchmark."""
+    parser = argparse.ArgumentParser(description="Benchmark the Image-to-Text pipeline on synthetic images")
+    parser.add_argument("--images", type=int, default=200, help="Number of synthetic images")
+    parser.add_argument("--image_size", type=int, default=384, help="Side of the synthetic images in pixels")
+    parser.add_argument("--batch_size", type=int, default=10, help="Images per generate call")
+    parser.add_argument("--warmup", type=int, default=10, help="Images captioned before measuring")
+    parser.add_argument("--mongo_uri", help="MongoDB to benchmark against (default: in-memory mongomock)")
+    parser.add_argument("--model_name", default="Salesforce/blip-image-captioning-base", help="BLIP model")
+    parser.add_argument("--tiny_model", action="store_true",
+                        help="Use a tiny randomly initialised model instead of --model_name (no network)")
+    parser.add_argument("--cpu", action="store_true", help="Run on CPU even if a GPU is available")
+    parser.add_argument("--cpu_optimize", action="store_true", help="Benchmark the int8 CPU model")
+    parser.add_argument("--decoding_strategy", default="greedy", choices=["greedy", "beam", "sample"])
+    parser.add_argument("--compute_confidence", action="store_true", help="Score captions")
+    parser.add_argument("--dedup", action="store_true", help="Enable the duplicate caption cache")
+    parser.add_argument("--embedding_cache", action="store_true", help="Enable the vision embedding cache")
+    parser.add_argument("--prefetch_workers", type=int, default=4, help="Image decode threads")
+    parser.add_argument("--fetch_page_size", type=int, default=500, help="Documents per fetch")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic images")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    parser.add_argument("--log_level", default="WARNING", help="Logging level")
+    args = parser.parse_args()
+
+    setup_logging(log_level=args.log_level)
+    report = run_benchmark(args)
+
+    text = json.dumps(report, indent=2, default=str)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+        logger.warning(f"Benchmark report written to {args.output}")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,16 @@
 import argparse
+import atexit
 import logging
 import os
 import sys
 
+import pymongo
+
 from app import Config, ImageCaptioner
+from app.indexes import check_pending_queries, ensure_indexes
+from app.metrics import METRICS
+from app.models import load_captioning_model, save_snapshot
+from app.workers import run_workers
 from app.utils import setup_logging
 
 def main():
@@ -15,6 +22,23 @@ def main():
     parser.add_argument("--callback_url", help="Optional callback URL")
     parser.add_argument("--log_level", default="INFO", help="Logging level")
     parser.add_argument("--log_file", help="Optional log file path")
+    parser.add_argument("--ensure_indexes", action="store_true",
+                        help="Create MongoDB indexes, check query coverage and exit")
+    parser.add_argument("--workers", type=int,
+                        help="Number of worker processes, each captioning a shard of the dataset")
+    parser.add_argument("--metrics_port", type=int,
+                        help="Serve Prometheus metrics on this port while running")
+    parser.add_argument("--metrics_dump", metavar="PATH",
+                        help="Write per-stage latency metrics as JSON to PATH at exit")
+    parser.add_argument("--priority_scheduling", action="store_true",
+                        help="Claim images by priority and weighted fair share across datasets")
+    parser.add_argument("--fair_share_weights",
+                        help="Per-dataset weights, e.g. interactive=4,backfill=1")
+    parser.add_argument("--profile", type=int, metavar="N",
+                        help="Profile the first N batches with torch.profiler")
+    parser.add_argument("--profile_dir", help="Directory profiler traces are written to")
+    parser.add_argument("--save_snapshot", metavar="DIR",
+                        help="Load the model, save a ready-to-load snapshot to DIR and exit")
     
     args = parser.parse_args()
     
@@ -30,14 +54,58 @@ def main():
             os.environ['DATASET_ID'] = args.dataset_id
         if args.callback_url:
             os.environ['CALLBACK_URL'] = args.callback_url
+        if args.workers:
+            os.environ['WORKERS'] = str(args.workers)
+        if args.metrics_port:
+            os.environ['METRICS_PORT'] = str(args.metrics_port)
+        if args.metrics_dump:
+            os.environ['METRICS_DUMP'] = args.metrics_dump
+        if args.priority_scheduling:
+            os.environ['PRIORITY_SCHEDULING'] = 'true'
+        if args.fair_share_weights:
+            os.environ['FAIR_SHARE_WEIGHTS'] = args.fair_share_weights
+        if args.profile:
+            os.environ['PROFILE_BATCHES'] = str(args.profile)
+        if args.profile_dir:
+            os.environ['PROFILE_DIR'] = args.profile_dir
         
         # Create configuration from environment
         config = Config.from_env()
+        
+        if args.save_snapshot:
+            processor, model = load_captioning_model(
+                config.model_name,
+                cache_dir=config.model_cache_dir,
+                offline=config.offline
+            )
+            save_snapshot(processor, model, args.save_snapshot)
+            return
+        
         config.validate()
         
+        if args.ensure_indexes:
+            with pymongo.MongoClient(config.mongo_uri) as client:
+                db = client.get_default_database()
+                ensure_indexes(db)
+                if not check_pending_queries(db, config.dataset_id):
+                    sys.exit(1)
+            logger.info("Indexes ensured")
+            return
+        
+        if config.metrics_port:
+            METRICS.start_http_server(config.metrics_port)
+        if config.metrics_dump_path:
+            atexit.register(METRICS.dump, config.metrics_dump_path)
+        
         # Process images
-        with ImageCaptioner(config) as captioner:
-            captioner.process_dataset()
+        if config.workers > 1:
+            counts = run_workers(config, config.workers)
+            if counts.get("failed_workers"):
+                sys.exit(1)
+        else:
+            with ImageCaptioner(config) as captioner:
+                counts = captioner.process_dataset()
+            logger.info(f"Processed images: {counts}")
             
         logger.info("Processing completed successfully")
         
@@ -1,10 +1,20 @@
 #!/usr/bin/env python3
 import argparse
+import hashlib
+import io
+import json
 import logging
+import os
+import random
 import sys
-from typing import List, Optional, Dict
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, List, Optional, Dict, Tuple
 import requests
-from pymongo import MongoClient
+from pymongo import ASCENDING, IndexModel, MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
 from PIL import Image
 import torch
 from transformers import BlipProcessor, BlipForConditionalGeneration
@@ -17,9 +27,183 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+class BulkWriter:
+    """Buffers update_one operations and flushes them as unordered bulk writes"""
+    def __init__(self, collection, batch_size: int = 100, flush_interval: float = 1.0):
+        """Start the background flusher"""
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.failures: List[Dict] = []
+        self._ops: List[Tuple[Dict, Dict]] = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._flush_periodically, daemon=True)
+        self._thread.start()
+
+    @property
+    def pending(self) -> int:
+        """Number of buffered updates, including failed ones awaiting a retry"""
+        with self._lock:
+            return len(self._ops)
+
+    def update_one(self, filter: Dict, update: Dict) -> None:
+        """Queue an update, flushing once batch_size updates are buffered"""
+        with self._lock:
+            self._ops.append((filter, update))
+            full = len(self._ops) >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write buffered updates, recording any per-document failures"""
+        with self._flush_lock:
+            with self._lock:
+                ops, self._ops = self._ops, []
+                self._last_flush = time.monotonic()
+            if not ops:
+                return
+            try:
+                self.collection.bulk_write([UpdateOne(f, u) for f, u in ops], ordered=False)
+            except BulkWriteError as e:
+                for error in e.details.get("writeErrors", []):
+                    self._record_failure(ops[error["index"]][0], error.get("errmsg", "unknown error"))
+            except PyMongoError as e:
+                if self._closed.is_set():
+                    for f, _ in ops:
+                        self._record_failure(f, str(e))
+                    return
+                logger.warning(f"Bulk write of {len(ops)} updates failed, will retry: {e}")
+                with self._lock:
+                    self._ops[:0] = ops
+
+    def _record_failure(self, filter: Dict, error: str) -> None:
+        """Log and keep a document whose update was not written"""
+        logger.error(f"Failed to update document {filter.get('_id')}: {error}")
+        self.failures.append({"filter": filter, "error": error})
+
+    def _flush_periodically(self) -> None:
+        """Flush updates that have been buffered longer than flush_interval"""
+        while not self._closed.wait(self.flush_interval):
+            if time.monotonic() - self._last_flush >= self.flush_interval:
+                try:
+                    self.flush()
+                except Exception as e:
+                    logger.error(f"Background flush failed: {e}")
+
+    def close(self) -> None:
+        """Stop the background flusher and write remaining updates"""
+        self._closed.set()
+        self._thread.join()
+        self.flush()
+
+def perceptual_hash(image: Image.Image, hash_size: int = 8) -> str:
+    """Difference hash of an image as hex, stable across re-encoding and resizing"""
+    grey = image.convert('L').resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = list(grey.getdata())
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            i = row * (hash_size + 1) + col
+            value = (value << 1) | (pixels[i] > pixels[i + 1])
+    return f"{value:0{hash_size * hash_size // 4}x}"
+
+def hash_detail(phash: str) -> int:
+    """Informative bits of a dHash; flat images hash to all zeros and smooth gradients to all ones"""
+    ones = bin(int(phash, 16)).count("1")
+    return min(ones, len(phash) * 4 - ones)
+
+class CaptionCache:
+    """Captions of already seen images, found by content hash or near-identical perceptual hash
+
+    Hashes with fewer than min_detail informative bits, such as those of blank or
+    solid-colour images, only match exact copies, and a lookup compares at most
+    max_candidates stored images.
+    """
+    def __init__(self, collection, namespace: str, max_distance: int = 3, bands: int = 4,
+                 ttl_seconds: int = 30 * 24 * 3600, max_entries: int = 1_000_000,
+                 min_detail: int = 8, max_candidates: int = 100):
+        """Create the band lookup and expiry indexes"""
+        self.collection = collection
+        self.namespace = namespace
+        self.max_distance = max_distance
+        self.bands = bands
+        self.max_entries = max_entries
+        self.min_detail = min_detail
+        self.max_candidates = max_candidates
+        self.hits = 0
+        self.misses = 0
+        self._stores = 0
+        last_used = {"expireAfterSeconds": ttl_seconds} if ttl_seconds > 0 else {}
+        collection.create_indexes([
+            IndexModel([("namespace", ASCENDING), ("bands", ASCENDING)], name="namespace_bands"),
+            IndexModel([("last_used_at", ASCENDING)], name="last_used_at", **last_used),
+        ])
+
+    def _bands(self, phash: str) -> List[str]:
+        """Split a perceptual hash into position-tagged LSH bands"""
+        width = len(phash) // self.bands
+        return [f"{i}:{phash[i * width:(i + 1) * width]}" for i in range(self.bands)]
+
+    def _matchable(self, phash: Optional[str]) -> bool:
+        """Whether a perceptual hash carries enough detail for near-duplicate matching"""
+        return bool(phash) and hash_detail(phash) >= self.min_detail
+
+    def lookup(self, sha256: str, phash: str) -> Optional[Dict]:
+        """Return the cached entry of an identical or near-identical image, if any"""
+        entry = self.collection.find_one({"_id": f"{self.namespace}:{sha256}"})
+        if entry is None and self.max_distance > 0 and self._matchable(phash):
+            best_distance = self.max_distance + 1
+            candidates = self.collection.find(
+                {"namespace": self.namespace, "bands": {"$in": self._bands(phash)}}
+            ).limit(self.max_candidates)
+            for candidate in candidates:
+                distance = bin(int(phash, 16) ^ int(candidate["phash"], 16)).count("1")
+                if distance < best_distance:
+                    entry, best_distance = candidate, distance
+
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.collection.update_one(
+            {"_id": entry["_id"]},
+            {"$set": {"last_used_at": datetime.datetime.utcnow()}, "$inc": {"hits": 1}}
+        )
+        return entry
+
+    def store(self, sha256: str, phash: str, caption: str, confidence: float = None) -> None:
+        """Record the caption of a newly captioned image, evicting old entries now and then"""
+        now = datetime.datetime.utcnow()
+        fields = {"namespace": self.namespace, "caption": caption, "confidence": confidence,
+                  "last_used_at": now}
+        if self._matchable(phash):
+            # Low-detail hashes get no bands, so they never become candidates
+            fields.update(phash=phash, bands=self._bands(phash))
+        self.collection.update_one(
+            {"_id": f"{self.namespace}:{sha256}"},
+            {"$set": fields, "$setOnInsert": {"created_at": now, "hits": 0}},
+            upsert=True
+        )
+        self._stores += 1
+        if self._stores % 1000 == 0:
+            self.evict()
+
+    def evict(self) -> int:
+        """Remove least recently used entries above max_entries"""
+        excess = self.collection.estimated_document_count() - self.max_entries
+        if excess <= 0:
+            return 0
+        oldest = self.collection.find({}, {"_id": 1}).sort("last_used_at", ASCENDING).limit(excess)
+        result = self.collection.delete_many({"_id": {"$in": [entry["_id"] for entry in oldest]}})
+        logger.info(f"Evicted {result.deleted_count} caption cache entries")
+        return result.deleted_count
+
 class MongoDBHandler:
     """Handles all MongoDB operations"""
-    def __init__(self, mongo_uri: str):
+    def __init__(self, mongo_uri: str, write_batch_size: int = 100, write_flush_interval: float = 1.0):
         """Initialize MongoDB connection"""
         try:
             self.client = MongoClient(mongo_uri)
@@ -29,6 +213,11 @@ class MongoDBHandler:
         except Exception as e:
             logger.error(f"Failed to connect to MongoDB: {e}")
             raise
+        self.caption_writer = BulkWriter(
+            self.client.img2text.images,
+            batch_size=write_batch_size,
+            flush_interval=write_flush_interval
+        )
 
     def get_model_config(self, config_id: Optional[str] = None) -> Dict:
         """Retrieve model configuration from MongoDB"""
@@ -43,36 +232,116 @@ class MongoDBHandler:
                 return {
                     "model_name": "Salesforce/blip-image-captioning-base",
                     "use_gpu": torch.cuda.is_available(),
-                    "batch_size": 1
+                    "batch_size": 1,
+                    "prefetch_workers": 4,
+                    "prefetch_queue_size": 16,
+                    "dedup": True,
+                    "dedup_max_distance": 3
                 }
             return config
         except Exception as e:
             logger.error(f"Failed to retrieve model configuration: {e}")
             raise
 
-    def get_images(self, dataset_id: Optional[str] = None) -> List[dict]:
-        """Retrieve image references from MongoDB"""
+    @staticmethod
+    def _images_query(dataset_id: Optional[str] = None, after_id=None) -> Dict:
+        """Build the query for uncaptioned images, optionally after a given _id"""
+        query = {}
+        if dataset_id:
+            query["dataset_id"] = dataset_id
+        
+        # Only get images without captions
+        query["caption"] = {"$exists": False}
+        
+        if after_id is not None:
+            query["_id"] = {"$gt": after_id}
+        return query
+
+    def count_images(self, dataset_id: Optional[str] = None, after_id=None) -> int:
+        """Count uncaptioned images, optionally after a given _id"""
+        return self.client.img2text.images.count_documents(self._images_query(dataset_id, after_id))
+
+    def get_images(self, dataset_id: Optional[str] = None, page_size: int = 500,
+                   after_id=None) -> Iterator[dict]:
+        """Stream uncaptioned image references from MongoDB in _id order.
+
+        Each page is a separate short query resuming after the last _id seen,
+        so no cursor is held open during inference and only page_size
+        documents are in memory at a time.
+        """
         try:
             collection = self.client.img2text.images
-            query = {}
-            
-            if dataset_id:
-                query["dataset_id"] = dataset_id
-            
-            # Only get images without captions
-            query["caption"] = {"$exists": False}
-            
-            images = list(collection.find(query))
-            logger.info(f"Retrieved {len(images)} images for processing")
-            return images
+            while True:
+                page = list(
+                    collection.find(self._images_query(dataset_id, after_id), {"_id": 1, "path": 1})
+                    .sort("_id", ASCENDING)
+                    .limit(page_size)
+                )
+                if not page:
+                    return
+                logger.debug(f"Retrieved page of {len(page)} images for processing")
+                yield from page
+                after_id = page[-1]["_id"]
         except Exception as e:
             logger.error(f"Failed to retrieve images: {e}")
             raise
 
+    def ensure_indexes(self, dataset_id: Optional[str] = None) -> bool:
+        """Create indexes for the uncaptioned-image query and check it avoids a collection scan"""
+        images = self.client.img2text.images
+        images.create_indexes([
+            IndexModel([("dataset_id", ASCENDING), ("caption", ASCENDING), ("_id", ASCENDING)],
+                       name="dataset_id_caption_id"),
+            IndexModel([("caption", ASCENDING), ("_id", ASCENDING)], name="caption_id"),
+        ])
+        self.client.img2text.model_configs.create_index([("is_default", ASCENDING)], name="is_default")
+        logger.info("Ensured MongoDB indexes")
+
+        try:
+            plan = images.find(self._images_query(dataset_id)).sort("_id", ASCENDING).explain()
+            plan = plan["queryPlanner"]["winningPlan"]
+            plan = plan.get("queryPlan", plan)
+        except (PyMongoError, KeyError) as e:
+            logger.warning(f"Could not explain image query: {e}")
+            return True
+
+        stages = []
+        while plan:
+            stages.append(plan.get("stage"))
+            plan = plan.get("inputStage")
+        if "COLLSCAN" in stages:
+            logger.warning("Uncaptioned-image query is not covered by an index")
+            return False
+        return True
+
+    def load_checkpoint(self, key: str):
+        """Return the last processed image _id recorded under key, if any"""
+        checkpoint = self.client.img2text.checkpoints.find_one({"_id": key})
+        return checkpoint["last_id"] if checkpoint else None
+
+    def save_checkpoint(self, key: str, last_id) -> None:
+        """Flush pending captions, then record last_id as processed
+
+        The checkpoint is left where it was while any caption write is still
+        waiting for a retry, so a restart never skips uncommitted images.
+        """
+        self.caption_writer.flush()
+        if self.caption_writer.pending:
+            logger.warning(f"{self.caption_writer.pending} caption writes pending, keeping the previous checkpoint")
+            return
+        self.client.img2text.checkpoints.update_one(
+            {"_id": key},
+            {"$set": {"last_id": last_id, "updated_at": datetime.datetime.utcnow()}},
+            upsert=True
+        )
+
+    def clear_checkpoint(self, key: str) -> None:
+        """Remove the checkpoint after a complete run"""
+        self.client.img2text.checkpoints.delete_one({"_id": key})
+
     def save_caption(self, image_id: str, caption: str, confidence: float = None) -> None:
-        """Save generated caption back to MongoDB"""
+        """Queue a generated caption for bulk write-back to MongoDB"""
         try:
-            collection = self.client.img2text.images
             update_data = {
                 "caption": caption,
                 "processed_at": datetime.datetime.utcnow()
@@ -80,27 +349,176 @@ class MongoDBHandler:
             if confidence is not None:
                 update_data["confidence"] = confidence
 
-            collection.update_one(
+            self.caption_writer.update_one(
                 {"_id": image_id},
                 {"$set": update_data}
             )
-            logger.debug(f"Saved caption for image {image_id}")
+            logger.debug(f"Queued caption for image {image_id}")
         except Exception as e:
             logger.error(f"Failed to save caption for image {image_id}: {e}")
             raise
 
+    def close(self) -> None:
+        """Flush pending caption writes and close the connection"""
+        try:
+            self.caption_writer.close()
+        finally:
+            self.client.close()
+
+class VisionHiddenStates(torch.nn.Module):
+    """Adapter returning only the last hidden state of a vision model, for tracing"""
+    def __init__(self, vision_model):
+        super().__init__()
+        self.vision_model = vision_model
+
+    def forward(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        return self.vision_model(pixel_values=pixel_values, return_dict=False)[0]
+
+class TracedVisionEncoder(torch.nn.Module):
+    """TorchScript trace of a BLIP vision encoder, returning (last_hidden_state,) like the original"""
+    def __init__(self, vision_model, example: torch.Tensor):
+        """Trace the vision model on example pixel values"""
+        super().__init__()
+        self.config = vision_model.config
+        self.traced = torch.jit.trace(VisionHiddenStates(vision_model), example)
+
+    def forward(self, pixel_values: torch.Tensor, **kwargs) -> Tuple[torch.Tensor]:
+        """Encode pixel values, ignoring extra generate() arguments"""
+        return (self.traced(pixel_values),)
+
+def optimize_vision_encoder(model, mode: str):
+    """Compile (torch.compile) or trace (TorchScript) the vision encoder of a BLIP model in place"""
+    if mode == "compile":
+        model.vision_model = torch.compile(model.vision_model)
+    elif mode == "trace":
+        size = model.config.vision_config.image_size
+        with torch.no_grad():
+            model.vision_model = TracedVisionEncoder(model.vision_model, torch.zeros(2, 3, size, size))
+    elif mode != "eager":
+        raise ValueError(f"Unknown vision encoder mode: {mode}")
+    return model
+
+def caption_agreement(reference: List[str], candidate: List[str]) -> float:
+    """Mean token-level F1 of candidate captions against reference captions"""
+    scores = []
+    for ref, cand in zip(reference, candidate):
+        ref_tokens, cand_tokens = ref.split(), cand.split()
+        common = sum(min(ref_tokens.count(t), cand_tokens.count(t)) for t in set(cand_tokens))
+        if not ref_tokens and not cand_tokens:
+            scores.append(1.0)
+        elif common == 0:
+            scores.append(0.0)
+        else:
+            precision, recall = common / len(cand_tokens), common / len(ref_tokens)
+            scores.append(2 * precision * recall / (precision + recall))
+    return sum(scores) / len(scores) if scores else 1.0
+
+def decoding_kwargs(decoding: Dict) -> Dict:
+    """generate() arguments for a model config's "decoding" settings (greedy, beam or sample)"""
+    strategy = decoding.get('strategy', 'greedy')
+    kwargs = {"max_new_tokens": decoding.get('max_new_tokens', 50)}
+    if strategy == "beam":
+        kwargs.update(num_beams=decoding.get('num_beams', 3),
+                      early_stopping=decoding.get('early_stopping', True))
+    elif strategy == "sample":
+        kwargs.update(do_sample=True, temperature=decoding.get('temperature', 1.0),
+                      top_p=decoding.get('top_p', 0.9), top_k=decoding.get('top_k', 50))
+    elif strategy == "greedy":
+        kwargs.update(num_beams=1, do_sample=False)
+    else:
+        raise ValueError(f"Unknown decoding strategy: {strategy}")
+    return kwargs
+
+class ModelPool:
+    """Keeps loaded BLIP models keyed by (model_name, device, dtype) within a memory budget
+
+    A dtype of torch.qint8 selects the fp32 model with int8 dynamically
+    quantized linear layers, for CPU inference.
+    """
+    def __init__(self, memory_budget_mb: Optional[int] = None):
+        """Initialize an empty pool; a budget of None keeps every model loaded"""
+        self.memory_budget = memory_budget_mb * 1024**2 if memory_budget_mb else None
+        self.loads = 0
+        self.hits = 0
+        self._models: OrderedDict = OrderedDict()
+
+    @staticmethod
+    def _model_bytes(model) -> int:
+        """Memory held by a model's weights, counting shared tensors once
+
+        Measured from the state dict rather than parameters() and buffers(),
+        which leave out the packed weights of dynamically quantized layers.
+        """
+        seen = set()
+        total = 0
+        values = list(model.state_dict().values())
+        while values:
+            value = values.pop()
+            if isinstance(value, (tuple, list)):
+                # Packed params of quantized layers are (weight, bias) tuples
+                values.extend(value)
+            elif isinstance(value, torch.Tensor) and value.data_ptr() not in seen:
+                seen.add(value.data_ptr())
+                total += value.numel() * value.element_size()
+        return total
+
+    @property
+    def used_bytes(self) -> int:
+        """Memory held by all pooled models"""
+        return sum(size for _, _, size in self._models.values())
+
+    def get(self, model_name: str, device: str = "cpu", dtype: torch.dtype = torch.float32,
+            vision_encoder_mode: str = "eager") -> Tuple[BlipProcessor, BlipForConditionalGeneration]:
+        """Return a loaded (processor, model), loading it and evicting least recently used models if needed"""
+        key = (model_name, device, str(dtype), vision_encoder_mode)
+        if key in self._models:
+            self._models.move_to_end(key)
+            self.hits += 1
+            processor, model, _ = self._models[key]
+            logger.info(f"Reusing loaded model: {model_name} ({device}, {dtype})")
+            return processor, model
+
+        logger.info(f"Loading model: {model_name} ({device}, {dtype})")
+        processor = BlipProcessor.from_pretrained(model_name)
+        quantized = dtype == torch.qint8
+        model = BlipForConditionalGeneration.from_pretrained(
+            model_name,
+            torch_dtype=torch.float32 if quantized else dtype
+        )
+        model.to(device).eval()
+        if quantized:
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        model = optimize_vision_encoder(model, vision_encoder_mode)
+        size = self._model_bytes(model)
+        self.loads += 1
+
+        self._evict(size)
+        self._models[key] = (processor, model, size)
+        logger.info(f"Model pool holds {len(self._models)} models, {self.used_bytes / 1024**2:.0f}MB")
+        return processor, model
+
+    def _evict(self, needed: int) -> None:
+        """Drop least recently used models until needed bytes fit in the budget"""
+        if self.memory_budget is None:
+            return
+        evicted = False
+        while self._models and self.used_bytes + needed > self.memory_budget:
+            (model_name, device, dtype, _), _ = self._models.popitem(last=False)
+            logger.info(f"Evicted model from pool: {model_name} ({device}, {dtype})")
+            evicted = True
+        if needed > self.memory_budget:
+            logger.warning(f"Model needs {needed / 1024**2:.0f}MB, more than the whole pool budget")
+        if evicted and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
 class ImageProcessor:
     """Handles image processing and caption generation"""
-    def __init__(self, model_config: Dict):
-        """Initialize the model based on configuration"""
+    def __init__(self, model_config: Dict, model_pool: Optional[ModelPool] = None):
+        """Initialize the model based on configuration, reusing pooled weights when possible"""
         try:
-            logger.info(f"Loading model: {model_config['model_name']}")
-            self.processor = BlipProcessor.from_pretrained(model_config['model_name'])
-            self.model = BlipForConditionalGeneration.from_pretrained(model_config['model_name'])
-            
             self.use_gpu = model_config.get('use_gpu', torch.cuda.is_available())
             if self.use_gpu and torch.cuda.is_available():
-                self.model.to("cuda")
+                self.device = "cuda"
                 logger.info("Using GPU for inference")
                 # Log GPU information
                 logger.info(f"GPU Device: {torch.cuda.get_device_name(0)}")
@@ -108,87 +526,340 @@ class ImageProcessor:
             else:
                 if self.use_gpu and not torch.cuda.is_available():
                     logger.warning("GPU requested but not available, falling back to CPU")
+                self.device = "cpu"
                 logger.info("Using CPU for inference")
+
+            if model_config.get('intra_op_threads'):
+                torch.set_num_threads(model_config['intra_op_threads'])
+            if model_config.get('inter_op_threads'):
+                try:
+                    torch.set_num_interop_threads(model_config['inter_op_threads'])
+                except RuntimeError as e:
+                    logger.warning(f"Could not set inter-op threads: {e}")
+
+            # cpu_optimize selects the int8 dynamically quantized model on CPU
+            self.dtype = getattr(torch, model_config.get('torch_dtype', 'float32'))
+            model_dtype = self.dtype
+            if model_config.get('cpu_optimize') and self.device == "cpu":
+                model_dtype = torch.qint8
+                self.dtype = torch.float32
+            model_pool = model_pool or ModelPool()
+            self.processor, self.model = model_pool.get(
+                model_config['model_name'],
+                self.device,
+                model_dtype,
+                model_config.get('vision_encoder_mode', 'eager')
+            )
+
+            # Scores are only kept by generate() when a confidence is requested
+            self.generate_kwargs = decoding_kwargs(model_config.get('decoding', {}))
+            self.compute_confidence = model_config.get('compute_confidence', False)
         except Exception as e:
             logger.error(f"Failed to initialize model: {e}")
             raise
 
-    def generate_caption(self, image_path: str) -> tuple[str, float]:
+    def preprocess(self, image_path: str) -> Dict:
+        """Load an image and run BLIP preprocessing on it"""
+        with Image.open(image_path) as image:
+            return self.processor(image.convert('RGB'), return_tensors="pt")
+
+    def preprocess_with_hashes(self, image_path: str) -> Tuple[Dict, Tuple[str, str]]:
+        """Preprocess an image and compute its content and perceptual hashes from the same read"""
+        with open(image_path, 'rb') as f:
+            data = f.read()
+        with Image.open(io.BytesIO(data)) as image:
+            rgb = image.convert('RGB')
+        inputs = self.processor(rgb, return_tensors="pt")
+        return inputs, (hashlib.sha256(data).hexdigest(), perceptual_hash(rgb))
+
+    def generate_caption(self, image_path: str) -> Tuple[str, Optional[float]]:
         """Generate caption for a given image"""
         try:
-            # Load and process image
-            image = Image.open(image_path).convert('RGB')
-            inputs = self.processor(image, return_tensors="pt")
-            
-            if self.use_gpu and torch.cuda.is_available():
-                inputs = {k: v.to("cuda") for k, v in inputs.items()}
+            return self.generate_caption_from_inputs(self.preprocess(image_path))
+        except Exception as e:
+            logger.error(f"Failed to generate caption for {image_path}: {e}")
+            raise
+
+    def generate_caption_from_inputs(self, inputs: Dict) -> Tuple[str, Optional[float]]:
+        """Generate caption for an already preprocessed image, with its confidence if configured"""
+        inputs = {
+            k: v.to(self.device, self.dtype) if v.is_floating_point() else v.to(self.device)
+            for k, v in inputs.items()
+        }
+
+        with torch.inference_mode():
+            if not self.compute_confidence:
+                sequences = self.model.generate(**inputs, **self.generate_kwargs)
+                return self.processor.decode(sequences[0], skip_special_tokens=True), None
 
-            # Generate caption with confidence score
             outputs = self.model.generate(
                 **inputs,
-                max_length=50,
-                num_return_sequences=1,
+                **self.generate_kwargs,
                 output_scores=True,
                 return_dict_in_generate=True
             )
-            
-            caption = self.processor.decode(outputs.sequences[0], skip_special_tokens=True)
-            confidence = float(torch.mean(outputs.scores[0]).item())
-            
-            return caption, confidence
+            # Log-probabilities of the chosen tokens, following beams for beam search
+            beam_indices = getattr(outputs, 'beam_indices', None)
+            transition = self.model.text_decoder.compute_transition_scores(
+                outputs.sequences, outputs.scores, beam_indices, normalize_logits=beam_indices is None
+            )[0]
+            generated = outputs.sequences[0, -transition.shape[0]:]
+            log_probs = transition[generated != self.model.config.text_config.pad_token_id]
+
+        caption = self.processor.decode(outputs.sequences[0], skip_special_tokens=True)
+        # Geometric mean of the token probabilities
+        confidence = float(torch.exp(log_probs.mean()).item()) if len(log_probs) else 0.0
+
+        return caption, confidence
+
+class ImagePrefetcher:
+    """Decodes and preprocesses images on a worker pool ahead of inference"""
+    def __init__(self, image_processor: ImageProcessor, num_workers: int = 4, queue_size: int = 16,
+                 compute_hashes: bool = False):
+        """Initialize the decode worker pool"""
+        self.image_processor = image_processor
+        self.queue_size = max(1, queue_size)
+        self.compute_hashes = compute_hashes
+        self.executor = ThreadPoolExecutor(max_workers=max(1, num_workers))
+
+    def _prepare(self, image: dict) -> Tuple[dict, Optional[Dict], Optional[Exception], Optional[Tuple[str, str]]]:
+        """Preprocess (and optionally hash) one image document, capturing any error"""
+        try:
+            if self.compute_hashes:
+                inputs, hashes = self.image_processor.preprocess_with_hashes(image['path'])
+                return image, inputs, None, hashes
+            return image, self.image_processor.preprocess(image['path']), None, None
         except Exception as e:
-            logger.error(f"Failed to generate caption for {image_path}: {e}")
-            raise
+            return image, None, e, None
+
+    def iter_prepared(self, images: Iterable[dict]) -> Iterator[Tuple[dict, Optional[Dict], Optional[Exception], Optional[Tuple[str, str]]]]:
+        """Yield (image, inputs, error, hashes) in order, keeping at most queue_size images in flight"""
+        pending = deque()
+        for image in images:
+            pending.append(self.executor.submit(self._prepare, image))
+            if len(pending) >= self.queue_size:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def close(self) -> None:
+        """Shut down the worker pool"""
+        self.executor.shutdown(wait=True, cancel_futures=True)
 
 class CallbackNotifier:
-    """Handles callback notifications"""
-    @staticmethod
-    def send_notification(callback_url: str, status: str, message: str, details: Optional[Dict] = None) -> None:
-        """Send callback notification"""
-        if not callback_url:
+    """Delivers callback notifications from a background thread, in batches
+
+    Notifications are queued and posted together as {"results": [...]} once
+    batch_size are waiting or every flush_interval seconds, over a pooled
+    session. Connection errors, timeouts, 429 and 5xx responses are retried
+    with exponential backoff and full jitter. A batch that still fails is
+    appended to a JSON-lines spill file and later batches go straight there
+    until a replay of the file succeeds. Replays run at startup and then at
+    most every backoff_max seconds, so an outage never loses notifications.
+    """
+    def __init__(self, url: str, spill_path: Optional[str] = "callback_spill.jsonl",
+                 batch_size: int = 50, flush_interval: float = 1.0, timeout: float = 10.0,
+                 max_retries: int = 5, backoff_base: float = 0.5, backoff_max: float = 30.0):
+        """Start the delivery thread"""
+        self.url = url
+        self.spill_path = spill_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.session = requests.Session()
+        self._pending: deque = deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = threading.Event()
+        self._down = False
+        self._last_probe = float("-inf")
+        self._thread = threading.Thread(target=self._run, name="callbacks", daemon=True)
+        self._thread.start()
+
+    def send_notification(self, status: str, message: str, details: Optional[Dict] = None) -> None:
+        """Queue a callback notification; never blocks on the network"""
+        payload = {
+            "status": status,
+            "message": message,
+            "timestamp": datetime.datetime.utcnow().isoformat()
+        }
+        if details:
+            payload.update(details)
+        with self._lock:
+            self._pending.append(payload)
+            full = len(self._pending) >= self.batch_size
+        if full:
+            self._wakeup.set()
+
+    def _run(self) -> None:
+        """Send queued notifications and replay spilled ones until closed"""
+        while True:
+            closing = self._closed.is_set()
+            if time.monotonic() - self._last_probe >= self.backoff_max:
+                try:
+                    if self.spill_path and (os.path.exists(self.spill_path)
+                                            or os.path.exists(self.spill_path + ".replay")):
+                        self._replay()
+                    else:
+                        self._down = False
+                except Exception as e:
+                    self._last_probe = time.monotonic()
+                    logger.error(f"Replaying spilled callback notifications failed: {e}")
+
+            while True:
+                with self._lock:
+                    batch = [self._pending.popleft() for _ in range(min(self.batch_size, len(self._pending)))]
+                if not batch:
+                    break
+                try:
+                    if self._down or not self._post(batch):
+                        self._mark_down()
+                        self._spill(batch)
+                except Exception as e:
+                    logger.error(f"Dropping {len(batch)} callback notifications: {e}")
+
+            if closing:
+                return
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+
+    def _post(self, batch: List[Dict]) -> bool:
+        """POST a batch with retries; False if the endpoint could not be reached"""
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.post(self.url, json={"results": batch}, timeout=self.timeout)
+                if response.status_code < 400:
+                    logger.info(f"Callback sent with {len(batch)} notifications to {self.url}")
+                    return True
+                if response.status_code < 500 and response.status_code != 429:
+                    logger.error(f"Callback rejected with HTTP {response.status_code}, dropping {len(batch)} notifications")
+                    return True
+                error = f"HTTP {response.status_code}"
+            except requests.RequestException as e:
+                error = str(e)
+            if attempt < self.max_retries:
+                # Stop retrying on close; the batch is spilled instead
+                if self._closed.wait(random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))):
+                    break
+        logger.error(f"Callback failed after {attempt + 1} attempts: {error}")
+        return False
+
+    def _mark_down(self) -> None:
+        """Spill new batches without sending them until the next probe"""
+        if not self._down:
+            self._down = True
+            self._last_probe = time.monotonic()
+
+    def _spill(self, batch: List[Dict]) -> None:
+        """Append undeliverable notifications to the spill file"""
+        if not self.spill_path:
+            logger.error(f"Dropping {len(batch)} callback notifications, no spill file configured")
             return
+        with open(self.spill_path, "a") as f:
+            f.write("".join(json.dumps(payload, default=str) + "\n" for payload in batch))
+            f.flush()
+            os.fsync(f.fileno())
 
-        try:
-            payload = {
-                "status": status,
-                "message": message,
-                "timestamp": datetime.datetime.utcnow().isoformat()
-            }
-            if details:
-                payload.update(details)
+    def _replay(self) -> None:
+        """Resend spilled notifications, moving undecodable lines to a .corrupt file"""
+        self._last_probe = time.monotonic()
+        replay_path = self.spill_path + ".replay"
+        if not os.path.exists(replay_path):
+            os.replace(self.spill_path, replay_path)
 
-            response = requests.post(callback_url, json=payload)
-            response.raise_for_status()
-            logger.info(f"Callback notification sent successfully to {callback_url}")
-        except Exception as e:
-            logger.error(f"Failed to send callback notification: {e}")
-            # Don't raise the error - callback failures shouldn't stop processing
+        payloads, corrupt = [], []
+        with open(replay_path) as f:
+            for line in filter(str.strip, f):
+                try:
+                    payloads.append(json.loads(line))
+                except ValueError:
+                    corrupt.append(line if line.endswith("\n") else line + "\n")
+        if corrupt:
+            with open(self.spill_path + ".corrupt", "a") as f:
+                f.writelines(corrupt)
+            logger.error(f"Moved {len(corrupt)} undecodable callback notifications to {self.spill_path}.corrupt")
+        logger.info(f"Replaying {len(payloads)} spilled callback notifications")
 
-def main(mongo_uri: str, dataset_id: Optional[str] = None, 
-         model_config_id: Optional[str] = None, callback_url: Optional[str] = None):
-    """Main execution flow"""
-    try:
-        # Initialize MongoDB handler
-        mongo_handler = MongoDBHandler(mongo_uri)
-        
-        # Get model configuration
-        model_config = mongo_handler.get_model_config(model_config_id)
-        
-        # Initialize image processor with configuration
-        image_processor = ImageProcessor(model_config)
-        
-        # Get images that need processing
-        images = mongo_handler.get_images(dataset_id)
-        logger.info(f"Found {len(images)} images to process")
+        for start in range(0, len(payloads), self.batch_size):
+            if not self._post(payloads[start:start + self.batch_size]):
+                self._mark_down()
+                self._spill(payloads[start:])
+                break
+        else:
+            self._down = False
+        os.remove(replay_path)
 
-        # Process each image
-        processed_count = 0
-        error_count = 0
-        
-        for image in tqdm(images, desc="Processing images"):
+    def close(self) -> None:
+        """Send what is queued, spilling it if the endpoint is down, and stop"""
+        self._closed.set()
+        self._wakeup.set()
+        self._thread.join()
+        self.session.close()
+
+def process_job(mongo_handler: MongoDBHandler, model_pool: ModelPool,
+                dataset_id: Optional[str] = None, model_config_id: Optional[str] = None,
+                notifier: Optional[CallbackNotifier] = None, page_size: int = 500,
+                restart: bool = False) -> Tuple[int, int]:
+    """Caption the uncaptioned images of one dataset with one model configuration"""
+    # Get model configuration
+    model_config = mongo_handler.get_model_config(model_config_id)
+    
+    # Initialize image processor with configuration
+    image_processor = ImageProcessor(model_config, model_pool)
+    if model_config.get('cpu_optimize') and image_processor.device == "cpu":
+        image_processor = check_cpu_optimization(mongo_handler, model_pool, model_config,
+                                                 image_processor, dataset_id)
+
+    # Reuse captions of duplicate images across runs
+    caption_cache = None
+    if model_config.get('dedup', True):
+        caption_cache = CaptionCache(
+            mongo_handler.client.img2text.caption_cache,
+            namespace=f"{model_config['model_name']}:{json.dumps(image_processor.generate_kwargs, sort_keys=True)}",
+            max_distance=model_config.get('dedup_max_distance', 3)
+        )
+    
+    # Resume after the last checkpointed image unless asked to restart
+    checkpoint_key = f"main:{dataset_id or '*'}"
+    after_id = None if restart else mongo_handler.load_checkpoint(checkpoint_key)
+    if after_id is not None:
+        logger.info(f"Resuming after checkpointed image {after_id}")
+
+    # Stream images that need processing
+    total_images = mongo_handler.count_images(dataset_id, after_id)
+    images = mongo_handler.get_images(dataset_id, page_size=page_size, after_id=after_id)
+    logger.info(f"Found {total_images} images to process")
+
+    # Process each image
+    processed_count = 0
+    error_count = 0
+    write_failures_before = len(mongo_handler.caption_writer.failures)
+    
+    prefetcher = ImagePrefetcher(
+        image_processor,
+        num_workers=model_config.get('prefetch_workers', 4),
+        queue_size=model_config.get('prefetch_queue_size', 16),
+        compute_hashes=caption_cache is not None
+    )
+    since_checkpoint = 0
+    try:
+        prepared_images = prefetcher.iter_prepared(images)
+        for image, inputs, error, hashes in tqdm(prepared_images, total=total_images, desc="Processing images"):
             try:
-                # Generate caption with confidence score
-                caption, confidence = image_processor.generate_caption(image['path'])
+                if error is not None:
+                    raise error
+
+                cached = caption_cache.lookup(*hashes) if caption_cache else None
+                if cached:
+                    caption, confidence = cached['caption'], cached.get('confidence')
+                    logger.debug(f"Reusing caption of duplicate image for {image['_id']}")
+                else:
+                    caption, confidence = image_processor.generate_caption_from_inputs(inputs)
+                    if caption_cache:
+                        caption_cache.store(*hashes, caption, confidence)
                 
                 # Save caption with metadata
                 mongo_handler.save_caption(image['_id'], caption, confidence)
@@ -198,31 +869,128 @@ def main(mongo_uri: str, dataset_id: Optional[str] = None,
             except Exception as e:
                 error_count += 1
                 logger.error(f"Failed to process image {image['_id']}: {e}")
-                continue
-
-        # Send completion notification with detailed status
-        if callback_url:
-            CallbackNotifier.send_notification(
-                callback_url,
-                "completed",
-                f"Processed {processed_count} images ({error_count} errors)",
-                {
-                    "total_images": len(images),
-                    "processed_count": processed_count,
-                    "error_count": error_count,
-                    "dataset_id": dataset_id,
-                    "model_config_id": model_config_id
-                }
-            )
+            finally:
+                since_checkpoint += 1
+                if since_checkpoint >= page_size:
+                    mongo_handler.save_checkpoint(checkpoint_key, image['_id'])
+                    since_checkpoint = 0
+    finally:
+        prefetcher.close()
+    mongo_handler.clear_checkpoint(checkpoint_key)
+    if caption_cache:
+        logger.info(f"Caption cache: {caption_cache.hits} duplicates reused, {caption_cache.misses} captioned")
+
+    # Flush buffered captions so failed writes are counted before reporting
+    mongo_handler.caption_writer.flush()
+    write_error_count = len(mongo_handler.caption_writer.failures) - write_failures_before
+    processed_count -= write_error_count
+    error_count += write_error_count
+
+    # Send completion notification with detailed status
+    if notifier:
+        notifier.send_notification(
+            "completed",
+            f"Processed {processed_count} images ({error_count} errors)",
+            {
+                "total_images": total_images,
+                "processed_count": processed_count,
+                "error_count": error_count,
+                "dataset_id": dataset_id,
+                "model_config_id": model_config_id
+            }
+        )
+    return processed_count, error_count
+
+def check_cpu_optimization(mongo_handler: MongoDBHandler, model_pool: ModelPool, model_config: Dict,
+                           optimized: ImageProcessor, dataset_id: Optional[str] = None) -> ImageProcessor:
+    """Caption sample images with the optimized and the fp32 model, keeping the fp32 model if they disagree"""
+    sample = [
+        image['path'] for image in mongo_handler.client.img2text.images.find(
+            {"dataset_id": dataset_id} if dataset_id else {}, {"path": 1}
+        ).limit(model_config.get('accuracy_check_samples', 16))
+    ]
+    if not sample:
+        return optimized
+
+    reference = ImageProcessor({**model_config, 'cpu_optimize': False, 'vision_encoder_mode': 'eager'}, model_pool)
+    captions = {}
+    durations = {}
+    for name, processor in (("reference", reference), ("optimized", optimized)):
+        started = time.perf_counter()
+        captions[name] = []
+        for path in sample:
+            try:
+                captions[name].append(processor.generate_caption(path)[0])
+            except Exception:
+                captions[name].append("")
+        durations[name] = time.perf_counter() - started
+
+    f1 = caption_agreement(captions["reference"], captions["optimized"])
+    logger.info(f"CPU optimization on {len(sample)} images: token F1 {f1:.3f}, "
+                f"{durations['reference'] / durations['optimized']:.2f}x speedup")
+    if f1 < model_config.get('min_caption_agreement', 0.9):
+        logger.error("Optimized captions disagree with the fp32 model, keeping the fp32 model")
+        return reference
+    return optimized
+
+def parse_job(spec: str) -> Tuple[Optional[str], Optional[str]]:
+    """Parse a "dataset_id[:model_config_id]" job spec; "*" selects all datasets"""
+    dataset_id, _, model_config_id = spec.partition(':')
+    return (None if dataset_id in ('', '*') else dataset_id), (model_config_id or None)
+
+def main(mongo_uri: str, dataset_id: Optional[str] = None, 
+         model_config_id: Optional[str] = None, callback_url: Optional[str] = None,
+         callback_spill_path: Optional[str] = "callback_spill.jsonl", page_size: int = 500, restart: bool = False, ensure_indexes: bool = False,
+         jobs: Optional[List[Tuple[Optional[str], Optional[str]]]] = None,
+         model_memory_budget_mb: Optional[int] = None):
+    """Main execution flow
+
+    Runs one job per (dataset_id, model_config_id) pair in jobs, or a single
+    job for dataset_id and model_config_id. Loaded models are shared between
+    jobs through a ModelPool, so jobs using the same model do not reload it.
+    """
+    jobs = jobs or [(dataset_id, model_config_id)]
+    mongo_handler = None
+    notifier = CallbackNotifier(callback_url, spill_path=callback_spill_path) if callback_url else None
+    failed = False
+    try:
+        # Initialize MongoDB handler
+        mongo_handler = MongoDBHandler(mongo_uri)
+        if ensure_indexes:
+            for job_dataset_id in dict.fromkeys(job[0] for job in jobs):
+                mongo_handler.ensure_indexes(job_dataset_id)
+        
+        model_pool = ModelPool(model_memory_budget_mb)
+        for job_dataset_id, job_model_config_id in jobs:
+            logger.info(f"Starting job: dataset {job_dataset_id or '*'}, model config {job_model_config_id or 'default'}")
+            try:
+                process_job(mongo_handler, model_pool, job_dataset_id, job_model_config_id,
+                            notifier, page_size=page_size, restart=restart)
+            except Exception as e:
+                failed = True
+                logger.error(f"Job for dataset {job_dataset_id or '*'} failed: {e}")
+                if notifier:
+                    notifier.send_notification(
+                        "error",
+                        f"Application error: {str(e)}",
+                        {"dataset_id": job_dataset_id, "model_config_id": job_model_config_id}
+                    )
+        logger.info(f"Model pool: {model_pool.loads} loads, {model_pool.hits} reuses")
 
     except Exception as e:
+        failed = True
         logger.error(f"Application error: {e}")
-        if callback_url:
-            CallbackNotifier.send_notification(
-                callback_url,
+        if notifier:
+            notifier.send_notification(
                 "error",
                 f"Application error: {str(e)}"
             )
+    finally:
+        if mongo_handler:
+            mongo_handler.close()
+        if notifier:
+            notifier.close()
+    if failed:
         sys.exit(1)
 
 if __name__ == "__main__":
@@ -247,6 +1015,42 @@ if __name__ == "__main__":
         "--callback_url",
         help="Optional callback URL for completion notification"
     )
+    parser.add_argument(
+        "--callback_spill_path",
+        default="callback_spill.jsonl",
+        help="File holding callback notifications until the endpoint is reachable again (empty disables)"
+    )
+    parser.add_argument(
+        "--page_size",
+        type=int,
+        default=500,
+        help="Images fetched per MongoDB query and checkpoint interval"
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="Ignore any checkpoint left by an interrupted run"
+    )
+    parser.add_argument(
+        "--job",
+        action="append",
+        dest="jobs",
+        metavar="DATASET_ID[:MODEL_CONFIG_ID]",
+        help="Dataset and model configuration to process; repeat to run several jobs with one model pool"
+    )
+    parser.add_argument(
+        "--model_memory_budget_mb",
+        type=int,
+        help="Memory budget of loaded models; least recently used models are evicted beyond it"
+    )
+    parser.add_argument(
+        "--ensure_indexes",
+        action="store_true",
+        help="Create MongoDB indexes for the image query before processing"
+    )
 
     args = parser.parse_args()
-    main(args.mongo_uri, args.dataset_id, args.model_config_id, args.callback_url)
\ No newline at end of file
+    main(args.mongo_uri, args.dataset_id, args.model_config_id, args.callback_url,
+         callback_spill_path=args.callback_spill_path or None, page_size=args.page_size, restart=args.restart, ensure_indexes=args.ensure_indexes,
+         jobs=[parse_job(spec) for spec in args.jobs or []],
+         model_memory_budget_mb=args.model_memory_budget_mb)
\ No newline at end of file
@@ -1,6 +1,7 @@
 """Text-to-Image Generation package."""
 from .config import Config
 from .core import ImageGenerator, GenerationResult
+from .service import GenerationService
 from .storage import StorageManager
 from .utils import setup_logging, BatchProcessor
 
@@ -10,6 +11,7 @@ __all__ = [
     "Config",
     "ImageGenerator",
     "GenerationResult",
+    "GenerationService",
     "StorageManager",
     "setup_logging",
     "BatchProcessor"
@@ -0,0 +1,121 @@
+"""Content-addressed cache of generated images."""
+import hashlib
+import json
+import logging
+import threading
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from pymongo import ASCENDING
+from pymongo.collection import Collection
+
+logger = logging.getLogger(__name__)
+
+def cache_key(**inputs: Any) -> str:
+    """
+    Hash the inputs that determine a generated image.
+
+    Args:
+        **inputs: Model ID, prompt, seed and generation parameters
+
+    Returns:
+        Hex digest identifying the result
+    """
+    payload = json.dumps(inputs, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+class ResultCache:
+    """
+    MongoDB index from generation inputs to already stored image URLs.
+
+    Entries expire ``ttl_seconds`` after their last use through a TTL index,
+    and the least recently used entries are evicted once the cache holds
+    more than ``max_entries``.
+    """
+
+    def __init__(self, collection: Collection, ttl_seconds: int = 7 * 24 * 3600,
+                 max_entries: int = 100_000):
+        """Initialize the cache and its indexes."""
+        self.collection = collection
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._lock = threading.Lock()
+
+        if ttl_seconds > 0:
+            collection.create_index(
+                [("last_used_at", ASCENDING)],
+                name="last_used_at_ttl",
+                expireAfterSeconds=ttl_seconds
+            )
+        else:
+            collection.create_index([("last_used_at", ASCENDING)], name="last_used_at")
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Look up a stored image URL, refreshing its last-used time on a hit.
+
+        Args:
+            key: Result key from ``cache_key``
+
+        Returns:
+            Stored image URL, or None on a miss
+        """
+        entry = self.collection.find_one_and_update(
+            {"_id": key},
+            {"$set": {"last_used_at": datetime.utcnow()}, "$inc": {"hits": 1}},
+            projection={"url": 1}
+        )
+        with self._lock:
+            if entry:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return entry["url"] if entry else None
+
+    def put(self, key: str, url: str) -> None:
+        """
+        Record the stored image URL for a result key.
+
+        Args:
+            key: Result key from ``cache_key``
+            url: URL returned by the storage backend
+        """
+        now = datetime.utcnow()
+        self.collection.update_one(
+            {"_id": key},
+            {"$set": {"url": url, "last_used_at": now}, "$setOnInsert": {"created_at": now, "hits": 0}},
+            upsert=True
+        )
+        with self._lock:
+            self._puts += 1
+            evict = self._puts % 100 == 0
+        if evict:
+            self.evict()
+
+    def evict(self) -> int:
+        """
+        Remove least recently used entries above ``max_entries``.
+
+        Returns:
+            Number of evicted entries
+        """
+        excess = self.collection.estimated_document_count() - self.max_entries
+        if excess <= 0:
+            return 0
+
+        oldest = self.collection.find({}, {"_id": 1}).sort("last_used_at", ASCENDING).limit(excess)
+        result = self.collection.delete_many({"_id": {"$in": [entry["_id"] for entry in oldest]}})
+        logger.info(f"Evicted {result.deleted_count} result cache entries")
+        return result.deleted_count
+
+    def stats(self) -> Dict[str, Any]:
+        """Return hit/miss counters for this process."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0
+        }
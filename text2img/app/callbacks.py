@@ -0,0 +1,264 @@
+"""Background delivery of webhook callbacks with batching, retries and a spill file."""
+import fcntl
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .metrics import METRICS
+
+logger = logging.getLogger(__name__)
+
+class CallbackDispatcher:
+    """Delivers callback results from a background thread.
+
+    ``send`` only queues a result, so a slow or unreachable webhook never
+    holds up generation. Queued results are posted together as
+    ``{"results": [...]}`` once ``batch_size`` are waiting or every
+    ``flush_interval`` seconds, over a pooled keep-alive session.
+
+    Connection errors, timeouts, 429 and 5xx responses are retried with
+    exponential backoff and full jitter. A batch that still fails is
+    appended to a JSON-lines spill file, and the endpoint is treated as
+    down: later batches go straight to the spill file until a replay of
+    the spill file succeeds. Replays are attempted at startup and then at
+    most every ``backoff_max`` seconds, so results spilled by a previous
+    run are delivered too. Delivery is at-least-once: a crash during a
+    replay can resend part of it.
+    """
+
+    def __init__(self, url: str, batch_size: int = 50, flush_interval: float = 1.0,
+                 timeout: float = 10.0, max_retries: int = 5, backoff_base: float = 0.5,
+                 backoff_max: float = 30.0, spill_path: Optional[str] = None,
+                 max_pending: int = 10_000):
+        """Start the dispatcher.
+
+        Args:
+            url: Webhook URL
+            batch_size: Results per request
+            flush_interval: Maximum seconds a result waits before it is sent
+            timeout: Per-request timeout in seconds
+            max_retries: Retries of a failed request before the batch is spilled
+            backoff_base: First retry delay in seconds, doubled on every retry
+            backoff_max: Upper bound of the retry delay and replay interval
+            spill_path: JSON-lines file for undeliverable results (``None``
+                drops them after logging)
+            max_pending: Queued results above which new results are spilled
+                directly instead of kept in memory
+        """
+        self.url = url
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.spill_path = spill_path
+        self.max_pending = max_pending
+        self.counts = {"sent": 0, "spilled": 0, "rejected": 0, "dropped": 0}
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=2)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._pending: Deque[Dict[str, Any]] = deque()
+        self._lock = threading.Lock()
+        self._spill_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = threading.Event()
+        self._down = False
+        self._last_probe = float("-inf")
+
+        self._thread = threading.Thread(target=self._run, name="text2img-callbacks", daemon=True)
+        self._thread.start()
+
+    def send(self, result: Dict[str, Any]) -> None:
+        """Queue a result for delivery; never blocks on the network.
+
+        Args:
+            result: JSON-serialisable result
+        """
+        with self._lock:
+            overflow = len(self._pending) >= self.max_pending
+            if not overflow:
+                self._pending.append(result)
+            full = len(self._pending) >= self.batch_size
+
+        if overflow:
+            self._spill([result])
+        elif full:
+            self._wakeup.set()
+
+    def _run(self) -> None:
+        """Background loop sending queued results and replaying spilled ones."""
+        while True:
+            closing = self._closed.is_set()
+            if time.monotonic() - self._last_probe >= self.backoff_max:
+                try:
+                    if self._spill_exists():
+                        self._replay()
+                    else:
+                        # Probe the endpoint again with the next batch
+                        self._down = False
+                except Exception as e:
+                    # Retried at the next probe; the thread must keep running
+                    self._last_probe = time.monotonic()
+                    logger.error(f"Replaying spilled callback results failed: {str(e)}", exc_info=True)
+
+            while batch := self._take():
+                try:
+                    self._deliver(batch)
+                except Exception as e:
+                    logger.error(f"Dropping {len(batch)} callback results: {str(e)}", exc_info=True)
+                    self.counts["dropped"] += len(batch)
+                    METRICS.inc("callback_results_total", len(batch), outcome="dropped")
+
+            if closing:
+                return
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+
+    def _take(self) -> List[Dict[str, Any]]:
+        """Dequeue up to ``batch_size`` results."""
+        with self._lock:
+            count = min(self.batch_size, len(self._pending))
+            return [self._pending.popleft() for _ in range(count)]
+
+    def _deliver(self, batch: List[Dict[str, Any]]) -> None:
+        """Send a batch, spilling it if the endpoint is unreachable."""
+        if self._down or not self._post(batch):
+            self._mark_down()
+            self._spill(batch)
+
+    def _post(self, batch: List[Dict[str, Any]]) -> bool:
+        """POST one batch with retries.
+
+        Returns:
+            False if the endpoint could not be reached; True if the batch
+            was accepted or permanently rejected (4xx other than 429)
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                with METRICS.timer("callback"):
+                    response = self.session.post(self.url, json={"results": batch}, timeout=self.timeout)
+                if response.status_code < 400:
+                    self.counts["sent"] += len(batch)
+                    METRICS.inc("callback_results_total", len(batch), outcome="sent")
+                    logger.debug(f"Callback sent with {len(batch)} results")
+                    return True
+                if response.status_code < 500 and response.status_code != 429:
+                    logger.error(f"Callback rejected with HTTP {response.status_code}, dropping {len(batch)} results")
+                    self.counts["rejected"] += len(batch)
+                    METRICS.inc("callback_results_total", len(batch), outcome="rejected")
+                    return True
+                error = f"HTTP {response.status_code}"
+            except requests.RequestException as e:
+                error = str(e)
+
+            if attempt == self.max_retries:
+                break
+            delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+            logger.warning(f"Callback failed ({error}), retrying in {delay:.1f}s")
+            # Stop retrying on close; the batch is spilled instead
+            if self._closed.wait(delay):
+                break
+
+        logger.error(f"Callback failed after {attempt + 1} attempts: {error}")
+        return False
+
+    def _mark_down(self) -> None:
+        """Spill new batches without trying to send them until the next probe."""
+        if not self._down:
+            self._down = True
+            self._last_probe = time.monotonic()
+
+    def _spill(self, results: List[Dict[str, Any]]) -> None:
+        """Append undeliverable results to the spill file."""
+        if not self.spill_path:
+            logger.error(f"Dropping {len(results)} callback results, no spill file configured")
+            self.counts["dropped"] += len(results)
+            METRICS.inc("callback_results_total", len(results), outcome="dropped")
+            return
+
+        lines = "".join(json.dumps(result, default=str) + "\n" for result in results)
+        with self._spill_lock, open(self.spill_path, "a") as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                f.write(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        self.counts["spilled"] += len(results)
+        METRICS.inc("callback_results_total", len(results), outcome="spilled")
+
+    def _spill_exists(self) -> bool:
+        """Check whether there are spilled results to replay."""
+        return bool(self.spill_path) and (
+            os.path.exists(self.spill_path) or os.path.exists(self.spill_path + ".replay")
+        )
+
+    def _replay(self) -> None:
+        """Resend spilled results, re-spilling whatever still cannot be delivered.
+
+        The spill file is renamed before it is read, so results spilled
+        during the replay go to a fresh file. A leftover ``.replay`` file
+        from an interrupted replay is resumed first. Lines that are not
+        valid JSON are moved to a ``.corrupt`` file instead of replayed.
+        """
+        self._last_probe = time.monotonic()
+        replay_path = self.spill_path + ".replay"
+        with self._spill_lock:
+            if not os.path.exists(replay_path):
+                os.replace(self.spill_path, replay_path)
+
+        results = []
+        corrupt = []
+        with open(replay_path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    results.append(json.loads(line))
+                except ValueError:
+                    # E.g. the last line of a spill file cut short by a crash
+                    corrupt.append(line if line.endswith("\n") else line + "\n")
+        if corrupt:
+            with open(self.spill_path + ".corrupt", "a") as f:
+                f.writelines(corrupt)
+            logger.error(
+                f"Moved {len(corrupt)} undecodable spilled callback results to "
+                f"{self.spill_path}.corrupt"
+            )
+        logger.info(f"Replaying {len(results)} spilled callback results")
+
+        for start in range(0, len(results), self.batch_size):
+            batch = results[start:start + self.batch_size]
+            if not self._post(batch):
+                self._mark_down()
+                self._spill(results[start:])
+                break
+        else:
+            self._down = False
+        os.remove(replay_path)
+
+    def stats(self) -> Dict[str, int]:
+        """Return delivery counters, plus the number of queued results."""
+        with self._lock:
+            return {**self.counts, "pending": len(self._pending)}
+
+    def close(self) -> None:
+        """Send what is queued, spilling it if the endpoint is down, and stop."""
+        self._closed.set()
+        self._wakeup.set()
+        self._thread.join()
+        self.session.close()
+        logger.info(f"Callbacks: {self.stats()}")
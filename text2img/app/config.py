@@ -1,8 +1,11 @@
 """Configuration management for the text-to-image processor."""
-from dataclasses import dataclass
-from typing import Optional
+from dataclasses import dataclass, field, replace
+from typing import Any, Dict, Optional
 import os
 
+from .generation_profiles import check_scheduler, get_profile
+from .scheduler import parse_weights
+
 @dataclass
 class Config:
     """Application configuration settings."""
@@ -12,52 +15,212 @@ class Config:
     database_name: str
     collection_name: str = "prompts"
     
-    # Google Cloud Storage settings
-    gcs_bucket: str
+    # Storage settings
+    storage_backend: str = "gcs"
+    gcs_bucket: str = ""
     gcs_prefix: str = "generated"
+    local_output_dir: str = "output"
+    s3_bucket: str = ""
+    s3_endpoint_url: Optional[str] = None
     
     # Model settings
     model_id: str = "runwayml/stable-diffusion-v1-5"
     num_inference_steps: int = 50
+    width: int = 512
+    height: int = 512
+    guidance_scale: float = 7.5
+    scheduler: str = "default"
+    generation_profile: Optional[str] = None
+    generation_batch_size: int = 4
+    max_batch_pixels: int = 4 * 512 * 512
     device: str = "cuda" if os.environ.get("USE_GPU", "true").lower() == "true" else "cpu"
     
+    # CPU performance settings
+    cpu_optimize: bool = False
+    cpu_dtype: str = "float32"
+    vae_tiling: bool = False
+    intra_op_threads: Optional[int] = None
+    inter_op_threads: Optional[int] = None
+    
+    # Model loading settings
+    model_cache_dir: Optional[str] = None
+    model_snapshot_dir: Optional[str] = None
+    offline: bool = False
+    
+    # Pipeline settings
+    image_format: str = "PNG"
+    encode_workers: int = 2
+    upload_concurrency: int = 4
+    pipeline_queue_size: int = 8
+    
     # Optional settings
     callback_url: Optional[str] = None
-    callback_timeout: int = 10
+    callback_timeout: float = 10.0
+    callback_batch_size: int = 50
+    callback_flush_interval: float = 1.0
+    callback_max_retries: int = 5
+    callback_spill_path: Optional[str] = "callback_spill.jsonl"
     batch_size: int = 10
     
+    # Result cache settings
+    cache_enabled: bool = True
+    cache_collection_name: str = "result_cache"
+    cache_ttl_seconds: int = 7 * 24 * 3600
+    cache_max_entries: int = 100_000
+    
+    # Service mode settings
+    use_change_streams: bool = True
+    poll_interval_min: float = 1.0
+    poll_interval_max: float = 30.0
+    
+    # Work leasing settings
+    use_leases: bool = True
+    lease_seconds: int = 900
+    worker_id: Optional[str] = None
+    
+    # Priority and fair-share scheduling settings
+    priority_scheduling: bool = False
+    fair_share_field: str = "dataset_id"
+    fair_share_weights: Dict[str, float] = field(default_factory=dict)
+    priority_age_boost_seconds: float = 600.0
+    
+    # Create indexes for the pending-prompt queries at startup
+    ensure_indexes: bool = True
+    
+    # Metrics settings
+    metrics_port: Optional[int] = None
+    metrics_dump_path: Optional[str] = None
+    
+    # Profiling settings; 0 batches disables the profiler
+    profile_batches: int = 0
+    profile_dir: str = "profiles"
+    
+    # MongoDB write-back settings
+    write_batch_size: int = 100
+    write_flush_interval: float = 1.0
+    
     @classmethod
     def from_env(cls) -> 'Config':
         """Create configuration from environment variables."""
         return cls(
-            mongo_uri=os.environ["MONGO_URI"],
+            mongo_uri=os.environ.get("MONGO_URI", ""),
             database_name=os.environ.get("MONGO_DB", "text2img"),
             collection_name=os.environ.get("MONGO_COLLECTION", "prompts"),
-            gcs_bucket=os.environ["GCS_BUCKET"],
+            storage_backend=os.environ.get("STORAGE_BACKEND", "gcs"),
+            gcs_bucket=os.environ.get("GCS_BUCKET", ""),
             gcs_prefix=os.environ.get("GCS_PREFIX", "generated"),
+            local_output_dir=os.environ.get("LOCAL_OUTPUT_DIR", "output"),
+            s3_bucket=os.environ.get("S3_BUCKET", ""),
+            s3_endpoint_url=os.environ.get("S3_ENDPOINT_URL"),
             model_id=os.environ.get("MODEL_ID", "runwayml/stable-diffusion-v1-5"),
+            model_cache_dir=os.environ.get("MODEL_CACHE_DIR"),
+            model_snapshot_dir=os.environ.get("MODEL_SNAPSHOT_DIR"),
+            offline=os.environ.get("HF_HUB_OFFLINE", "false").lower() in ("1", "true"),
             callback_url=os.environ.get("CALLBACK_URL"),
+            callback_timeout=float(os.environ.get("CALLBACK_TIMEOUT", "10")),
+            callback_batch_size=int(os.environ.get("CALLBACK_BATCH_SIZE", "50")),
+            callback_flush_interval=float(os.environ.get("CALLBACK_FLUSH_INTERVAL", "1.0")),
+            callback_max_retries=int(os.environ.get("CALLBACK_MAX_RETRIES", "5")),
+            callback_spill_path=os.environ.get("CALLBACK_SPILL_PATH", "callback_spill.jsonl") or None,
             num_inference_steps=int(os.environ.get("NUM_INFERENCE_STEPS", "50")),
-            batch_size=int(os.environ.get("BATCH_SIZE", "10"))
+            width=int(os.environ.get("IMAGE_WIDTH", "512")),
+            height=int(os.environ.get("IMAGE_HEIGHT", "512")),
+            guidance_scale=float(os.environ.get("GUIDANCE_SCALE", "7.5")),
+            scheduler=os.environ.get("SCHEDULER", "default"),
+            generation_profile=os.environ.get("GENERATION_PROFILE") or None,
+            cpu_optimize=os.environ.get("CPU_OPTIMIZE", "false").lower() == "true",
+            cpu_dtype=os.environ.get("CPU_DTYPE", "float32"),
+            vae_tiling=os.environ.get("VAE_TILING", "false").lower() == "true",
+            intra_op_threads=int(os.environ.get("INTRA_OP_THREADS", "0")) or None,
+            inter_op_threads=int(os.environ.get("INTER_OP_THREADS", "0")) or None,
+            generation_batch_size=int(os.environ.get("GENERATION_BATCH_SIZE", "4")),
+            max_batch_pixels=int(os.environ.get("MAX_BATCH_PIXELS", str(4 * 512 * 512))),
+            batch_size=int(os.environ.get("BATCH_SIZE", "10")),
+            image_format=os.environ.get("IMAGE_FORMAT", "PNG").upper(),
+            encode_workers=int(os.environ.get("ENCODE_WORKERS", "2")),
+            upload_concurrency=int(os.environ.get("UPLOAD_CONCURRENCY", "4")),
+            pipeline_queue_size=int(os.environ.get("PIPELINE_QUEUE_SIZE", "8")),
+            cache_enabled=os.environ.get("RESULT_CACHE", "true").lower() == "true",
+            cache_ttl_seconds=int(os.environ.get("RESULT_CACHE_TTL", str(7 * 24 * 3600))),
+            cache_max_entries=int(os.environ.get("RESULT_CACHE_MAX_ENTRIES", "100000")),
+            use_change_streams=os.environ.get("USE_CHANGE_STREAMS", "true").lower() == "true",
+            poll_interval_min=float(os.environ.get("POLL_INTERVAL_MIN", "1.0")),
+            poll_interval_max=float(os.environ.get("POLL_INTERVAL_MAX", "30.0")),
+            use_leases=os.environ.get("USE_LEASES", "true").lower() == "true",
+            lease_seconds=int(os.environ.get("LEASE_SECONDS", "900")),
+            worker_id=os.environ.get("WORKER_ID"),
+            priority_scheduling=os.environ.get("PRIORITY_SCHEDULING", "false").lower() == "true",
+            fair_share_field=os.environ.get("FAIR_SHARE_FIELD", "dataset_id"),
+            fair_share_weights=parse_weights(os.environ.get("FAIR_SHARE_WEIGHTS")),
+            priority_age_boost_seconds=float(os.environ.get("PRIORITY_AGE_BOOST", "600")),
+            ensure_indexes=os.environ.get("ENSURE_INDEXES", "true").lower() == "true",
+            write_batch_size=int(os.environ.get("WRITE_BATCH_SIZE", "100")),
+            write_flush_interval=float(os.environ.get("WRITE_FLUSH_INTERVAL", "1.0")),
+            metrics_port=int(os.environ.get("METRICS_PORT", "0")) or None,
+            metrics_dump_path=os.environ.get("METRICS_DUMP"),
+            profile_batches=int(os.environ.get("PROFILE_BATCHES", "0")),
+            profile_dir=os.environ.get("PROFILE_DIR", "profiles")
         )
     
     @classmethod
-    def from_args(cls, mongo_uri: str, gcs_bucket: str, callback_url: Optional[str] = None) -> 'Config':
-        """Create configuration from command line arguments."""
-        return cls(
+    def from_args(cls, mongo_uri: str, **overrides: Any) -> 'Config':
+        """
+        Create configuration from environment variables and command line arguments.
+        
+        Arguments override the environment; arguments that are None keep
+        the environment value.
+        
+        Args:
+            mongo_uri: MongoDB connection URI including the database name
+            **overrides: Config fields set on the command line
+        """
+        return replace(
+            cls.from_env(),
             mongo_uri=mongo_uri,
             database_name=mongo_uri.split("/")[-1],  # Extract DB name from URI
-            gcs_bucket=gcs_bucket,
-            callback_url=callback_url
+            **{name: value for name, value in overrides.items() if value is not None}
         )
     
     def validate(self) -> None:
         """Validate the configuration settings."""
         if not self.mongo_uri:
             raise ValueError("MongoDB URI is required")
-        if not self.gcs_bucket:
+        if self.storage_backend not in ("gcs", "local", "s3"):
+            raise ValueError("storage_backend must be gcs, local or s3")
+        if self.storage_backend == "gcs" and not self.gcs_bucket:
             raise ValueError("GCS bucket name is required")
+        if self.storage_backend == "s3" and not self.s3_bucket:
+            raise ValueError("S3 bucket name is required")
         if self.num_inference_steps < 1:
             raise ValueError("num_inference_steps must be positive")
         if self.batch_size < 1:
-            raise ValueError("batch_size must be positive")
\ No newline at end of file
+            raise ValueError("batch_size must be positive")
+        check_scheduler(self.scheduler)
+        if self.generation_profile:
+            get_profile(self.generation_profile)
+        if self.cpu_dtype not in ("float32", "bfloat16"):
+            raise ValueError("cpu_dtype must be float32 or bfloat16")
+        if self.generation_batch_size < 1:
+            raise ValueError("generation_batch_size must be positive")
+        if self.image_format not in ("PNG", "WEBP"):
+            raise ValueError("image_format must be PNG or WEBP")
+        if self.encode_workers < 1 or self.upload_concurrency < 1:
+            raise ValueError("encode_workers and upload_concurrency must be positive")
+        if self.pipeline_queue_size < 1:
+            raise ValueError("pipeline_queue_size must be positive")
+        if self.cache_max_entries < 1:
+            raise ValueError("cache_max_entries must be positive")
+        if not 0 < self.poll_interval_min <= self.poll_interval_max:
+            raise ValueError("poll intervals must satisfy 0 < min <= max")
+        if self.lease_seconds < 1:
+            raise ValueError("lease_seconds must be positive")
+        if self.write_batch_size < 1:
+            raise ValueError("write_batch_size must be positive")
+        if self.callback_batch_size < 1:
+            raise ValueError("callback_batch_size must be positive")
+        if self.callback_max_retries < 0:
+            raise ValueError("callback_max_retries must not be negative")
+        if any(weight <= 0 for weight in self.fair_share_weights.values()):
+            raise ValueError("fair_share_weights must be positive")
+        if self.profile_batches < 0:
+            raise ValueError("profile_batches must not be negative")
\ No newline at end of file
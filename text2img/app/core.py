@@ -1,19 +1,31 @@
 """Core functionality for text-to-image generation."""
 import asyncio
 import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
-from typing import Dict, List, Optional
-from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Set
+from dataclasses import asdict, dataclass
 
 import torch
-from diffusers import StableDiffusionPipeline
 from pymongo import MongoClient
 from pymongo.database import Database
-import requests
+from pymongo.errors import PyMongoError
 from PIL import Image
 
+from .cache import ResultCache, cache_key
+from .callbacks import CallbackDispatcher
 from .config import Config
-from .storage import StorageManager
+from .generation_profiles import build_scheduler, check_scheduler, get_profile
+from .indexes import check_pending_queries, ensure_indexes
+from .lease import LEASE_FIELDS, WorkLease, owned_filter
+from .metrics import METRICS
+from .models import load_pipeline
+from .optimize import StepTimer, bf16_supported, configure_threads, optimize_for_cpu
+from .profiling import BatchProfiler
+from .scheduler import FairShareScheduler
+from .storage import CONTENT_TYPES, StorageManager, encode_image
+from .writer import BulkWriter
 
 logger = logging.getLogger(__name__)
 
@@ -24,6 +36,48 @@ class GenerationResult:
     prompt: str
     image_url: str
 
+@dataclass(frozen=True)
+class GenerationParams:
+    """Pipeline parameters shared by all prompts in one generation batch."""
+    num_inference_steps: int
+    width: int
+    height: int
+    guidance_scale: float
+    scheduler: str = "default"
+    
+    @classmethod
+    def from_document(cls, prompt_doc: Dict, config: Config) -> 'GenerationParams':
+        """Read per-prompt overrides from a prompt document.
+        
+        Fields set on the document take precedence over the document's
+        ``profile``, which takes precedence over the configured
+        ``generation_profile`` and then the configured defaults.
+        """
+        values = {
+            "num_inference_steps": config.num_inference_steps,
+            "width": config.width,
+            "height": config.height,
+            "guidance_scale": config.guidance_scale,
+            "scheduler": config.scheduler
+        }
+        for profile in (config.generation_profile, prompt_doc.get("profile")):
+            if profile:
+                values.update(get_profile(profile))
+        values.update({key: prompt_doc[key] for key in values if key in prompt_doc})
+        
+        params = cls(
+            num_inference_steps=int(values["num_inference_steps"]),
+            width=int(values["width"]),
+            height=int(values["height"]),
+            guidance_scale=float(values["guidance_scale"]),
+            scheduler=check_scheduler(str(values["scheduler"]))
+        )
+        if params.num_inference_steps < 1:
+            raise ValueError("num_inference_steps must be positive")
+        if params.width % 8 or params.height % 8 or params.width < 8 or params.height < 8:
+            raise ValueError("width and height must be positive multiples of 8")
+        return params
+
 class ImageGenerator:
     """Handles text-to-image generation workflow."""
 
@@ -35,73 +89,447 @@ class ImageGenerator:
         self.mongo_client = MongoClient(config.mongo_uri)
         self.db: Database = self.mongo_client[config.database_name]
         logger.info(f"Connected to MongoDB: {config.database_name}")
+        if config.ensure_indexes:
+            ensure_indexes(self.db[config.collection_name])
+            check_pending_queries(self.db[config.collection_name])
+        self.writer = BulkWriter(
+            self.db[config.collection_name],
+            batch_size=config.write_batch_size,
+            flush_interval=config.write_flush_interval
+        )
+        
+        self.lease = None
+        if config.use_leases:
+            self.lease = WorkLease(
+                self.db[config.collection_name],
+                worker_id=config.worker_id,
+                lease_seconds=config.lease_seconds
+            )
+        
+        self.scheduler = None
+        if config.priority_scheduling:
+            self.scheduler = FairShareScheduler(
+                self.db[config.collection_name],
+                weights=config.fair_share_weights,
+                flow_field=config.fair_share_field,
+                age_boost_seconds=config.priority_age_boost_seconds
+            )
         
         # Initialize storage
         self.storage = StorageManager(config)
+        self.cache = None
+        if config.cache_enabled:
+            self.cache = ResultCache(
+                self.db[config.cache_collection_name],
+                ttl_seconds=config.cache_ttl_seconds,
+                max_entries=config.cache_max_entries
+            )
+        
+        self.callbacks = None
+        if config.callback_url:
+            self.callbacks = CallbackDispatcher(
+                config.callback_url,
+                batch_size=config.callback_batch_size,
+                flush_interval=config.callback_flush_interval,
+                timeout=config.callback_timeout,
+                max_retries=config.callback_max_retries,
+                spill_path=config.callback_spill_path
+            )
+        
+        # Profiles pipeline calls on the generation thread, where they run
+        self.profiler = None
+        if config.profile_batches:
+            self.profiler = BatchProfiler(config.profile_batches, config.profile_dir, "text2img")
+        
+        # Executors for the generate -> encode -> upload pipeline
+        self._generation_executor = ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix="text2img-generate"
+        )
+        self._encode_executor = ProcessPoolExecutor(
+            max_workers=config.encode_workers,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+        self._upload_executor = ThreadPoolExecutor(
+            max_workers=config.upload_concurrency,
+            thread_name_prefix="text2img-upload"
+        )
         
         # Initialize model
         self._initialize_model()
     
     def _initialize_model(self) -> None:
-        """Initialize the Stable Diffusion model."""
+        """Initialize the Stable Diffusion model.
+        
+        With ``cpu_optimize`` on a CPU device, torch thread pools are pinned
+        first, the pipeline is loaded in ``cpu_dtype`` (bfloat16 only where
+        the CPU has native support) and CPU memory and layout settings are
+        applied.
+        """
+        cpu_optimize = self.config.cpu_optimize and self.config.device == "cpu"
+        if self.config.cpu_optimize and not cpu_optimize:
+            logger.warning("CPU optimization requested but running on GPU, ignoring")
+        
+        dtype = None
+        if cpu_optimize:
+            # Pin thread pools before torch starts using them
+            configure_threads(self.config.intra_op_threads, self.config.inter_op_threads)
+            if self.config.cpu_dtype == "bfloat16":
+                if bf16_supported():
+                    dtype = torch.bfloat16
+                else:
+                    logger.warning("CPU has no native bfloat16 support, using float32")
+        
         try:
-            logger.info(f"Loading model: {self.config.model_id}")
-            self.model = StableDiffusionPipeline.from_pretrained(
+            self.model = load_pipeline(
                 self.config.model_id,
-                torch_dtype=torch.float16 if self.config.device == "cuda" else torch.float32
+                device=self.config.device,
+                cache_dir=self.config.model_cache_dir,
+                offline=self.config.offline,
+                snapshot_dir=self.config.model_snapshot_dir,
+                dtype=dtype
             )
-            self.model.to(self.config.device)
-            logger.info(f"Model loaded successfully on {self.config.device}")
+            if cpu_optimize:
+                optimize_for_cpu(self.model, vae_tiling=self.config.vae_tiling)
+            # Settings in effect, which change the generated pixels
+            self._cpu_optimize = cpu_optimize
+            # Schedulers selected by generation parameters, built on first use
+            self._schedulers = {"default": self.model.scheduler}
             
         except Exception as e:
             logger.error(f"Failed to load model: {str(e)}")
             raise
     
     async def process_pending_prompts(self) -> List[GenerationResult]:
-        """Process all pending prompts from MongoDB."""
-        results = []
-        
+        """Process one batch of pending prompts from MongoDB."""
         try:
-            # Find pending prompts
-            pending = self.db[self.config.collection_name].find(
-                {"status": "pending"}
-            ).limit(self.config.batch_size)
+            # Claim pending prompts for this worker
+            pending = self.claim_pending()
+            return await self.process_prompts(pending)
             
-            for prompt_doc in pending:
+        except Exception as e:
+            logger.error(f"Error processing prompts: {str(e)}")
+            raise
+    
+    async def process_prompts(self, pending: List[Dict]) -> List[GenerationResult]:
+        """Generate images for already claimed prompt documents.
+        
+        Prompts sharing the same generation parameters are generated together,
+        ``generation_batch_size`` at a time, in a single pipeline call. Work
+        then flows through bounded queues: generation runs on a dedicated
+        executor, encoding on a process pool and uploads run concurrently, so
+        the model starts on the next batch while earlier images are stored.
+        
+        Every prompt ends up completed or marked as an error: if a stage
+        fails unexpectedly, the prompts it had not finished are marked as
+        errors once the other stages have drained.
+        """
+        results: List[GenerationResult] = []
+        encode_queue: asyncio.Queue = asyncio.Queue(maxsize=self.config.pipeline_queue_size)
+        upload_queue: asyncio.Queue = asyncio.Queue(maxsize=self.config.pipeline_queue_size)
+        
+        # Result cache keys of generated prompts, and identical prompts in this
+        # batch that reuse the image of the first one
+        keys: Dict[Any, str] = {}
+        followers: Dict[str, List[Dict]] = {}
+        failed: Set[Any] = set()
+        
+        def fail(prompt_doc: Dict, error: str) -> None:
+            for doc in [prompt_doc, *followers.pop(keys.get(prompt_doc['_id']), [])]:
+                if doc['_id'] not in failed:
+                    failed.add(doc['_id'])
+                    self._update_error_status(doc, error)
+        
+        groups = self._group_by_params(pending)
+        
+        async def generate_stage() -> None:
+            try:
+                for params, prompt_docs in groups.items():
+                    misses = self._resolve_cached(prompt_docs, params, keys, followers, results)
+                    for chunk in self._chunk(misses, self._sub_batch_size(params)):
+                        try:
+                            images = await self._generate_images(
+                                [doc['text'] for doc in chunk],
+                                params,
+                                [self._seed(doc) for doc in chunk]
+                            )
+                        except Exception as e:
+                            logger.error(f"Error generating batch of {len(chunk)} prompts: {str(e)}")
+                            for prompt_doc in chunk:
+                                fail(prompt_doc, str(e))
+                            continue
+                        
+                        for prompt_doc, image in zip(chunk, images):
+                            await encode_queue.put((prompt_doc, image))
+            finally:
+                # Let the encoders finish even when generation failed
+                for _ in range(self.config.encode_workers):
+                    await encode_queue.put(None)
+        
+        async def encode_worker() -> None:
+            while (item := await encode_queue.get()) is not None:
+                prompt_doc, image = item
                 try:
-                    result = await self._process_single_prompt(prompt_doc)
-                    if result:
-                        results.append(result)
+                    data = await self._encode(image)
                 except Exception as e:
-                    logger.error(f"Error processing prompt {prompt_doc['_id']}: {str(e)}")
-                    self._update_error_status(prompt_doc['_id'], str(e))
+                    logger.error(f"Failed to encode image for prompt {prompt_doc['_id']}: {str(e)}")
+                    fail(prompt_doc, str(e))
+                    continue
+                await upload_queue.put((prompt_doc, data))
+        
+        async def encode_stage() -> None:
+            try:
+                await asyncio.gather(*(encode_worker() for _ in range(self.config.encode_workers)))
+            finally:
+                for _ in range(self.config.upload_concurrency):
+                    await upload_queue.put(None)
+        
+        async def upload_worker() -> None:
+            while (item := await upload_queue.get()) is not None:
+                prompt_doc, data = item
+                result = await self._store_result(prompt_doc, data)
+                if not result:
+                    # _store_result already marked the prompt itself
+                    failed.add(prompt_doc['_id'])
+                    fail(prompt_doc, "Upload failed")
+                    continue
+                
+                results.append(result)
+                key = keys.get(prompt_doc['_id'])
+                if key:
+                    try:
+                        self.cache.put(key, result.image_url)
+                    except Exception as e:
+                        logger.warning(f"Failed to cache result of prompt {prompt_doc['_id']}: {str(e)}")
+                    for doc in followers.pop(key, []):
+                        results.append(self._reuse_result(doc, result.image_url))
+        
+        # Keep the batch's leases alive while it is generated, since a
+        # single CPU pipeline call can outlast a third of the lease
+        keepalive = asyncio.create_task(self._renew_leases()) if self.lease else None
+        try:
+            # Wait for every stage, so no prompt is still in flight when the
+            # unfinished ones are marked below
+            outcomes = await asyncio.gather(
+                generate_stage(),
+                encode_stage(),
+                *(upload_worker() for _ in range(self.config.upload_concurrency)),
+                return_exceptions=True
+            )
+        finally:
+            if keepalive is not None:
+                keepalive.cancel()
+        errors = [outcome for outcome in outcomes if isinstance(outcome, BaseException)]
+        if errors:
+            logger.error(f"Error processing batch of {len(pending)} prompts: {str(errors[0])}",
+                         exc_info=errors[0])
+            completed = {result.prompt_id for result in results}
+            for prompt_docs in groups.values():
+                for prompt_doc in prompt_docs:
+                    if prompt_doc['_id'] not in failed and str(prompt_doc['_id']) not in completed:
+                        fail(prompt_doc, str(errors[0]))
+        
+        if self.cache:
+            logger.info(f"Result cache: {self.cache.stats()}")
+        
+        if self.callbacks is not None:
+            for result in results:
+                self.callbacks.send({
+                    "prompt_id": result.prompt_id,
+                    "prompt": result.prompt,
+                    "image_url": result.image_url
+                })
+        
+        return results
+    
+    async def _renew_leases(self) -> None:
+        """Renew this worker's leases every third of the lease period until cancelled."""
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.lease.lease_seconds / 3)
+            try:
+                await loop.run_in_executor(None, self.lease.renew, True)
+            except PyMongoError as e:
+                logger.warning(f"Failed to renew leases: {str(e)}")
+    
+    def _resolve_cached(self, prompt_docs: List[Dict], params: GenerationParams,
+                        keys: Dict[Any, str], followers: Dict[str, List[Dict]],
+                        results: List[GenerationResult]) -> List[Dict]:
+        """Complete prompts whose result is already cached.
+        
+        Identical uncached prompts are collapsed onto the first one, which is
+        the only one generated; the rest are recorded in ``followers``.
+        
+        Returns:
+            Prompt documents that still need to be generated
+        """
+        if not self.cache:
+            return prompt_docs
+        
+        misses = []
+        for prompt_doc in prompt_docs:
+            if prompt_doc.get("cache") is False:
+                misses.append(prompt_doc)
+                continue
             
-            if results and self.config.callback_url:
-                await self._send_callback(results)
+            key = self._cache_key(prompt_doc, params)
+            if key in followers:
+                followers[key].append(prompt_doc)
+                continue
             
-            return results
+            try:
+                url = self.cache.get(key)
+            except PyMongoError as e:
+                # The cache only saves work; generate the prompt instead
+                logger.warning(f"Result cache lookup failed for prompt {prompt_doc['_id']}: {str(e)}")
+                url = None
+            if url:
+                logger.info(f"Result cache hit for prompt {prompt_doc['_id']}")
+                METRICS.inc("cache_hits_total")
+                results.append(self._reuse_result(prompt_doc, url))
+                continue
             
-        except Exception as e:
-            logger.error(f"Error processing prompts: {str(e)}")
-            raise
+            keys[prompt_doc['_id']] = key
+            followers[key] = []
+            misses.append(prompt_doc)
+        return misses
+    
+    def _cache_key(self, prompt_doc: Dict, params: GenerationParams) -> str:
+        """Result cache key for a prompt generated with ``params``.
+        
+        Besides the generation parameters, the key covers the pipeline's
+        weight dtype and CPU optimizations, since images generated at a
+        different precision or with VAE tiling differ.
+        """
+        inputs = asdict(params)
+        inputs["scheduler"] = type(self._scheduler(params.scheduler)).__name__
+        return cache_key(
+            model_id=self.config.model_id,
+            dtype=str(self.model.unet.dtype),
+            cpu_optimize=self._cpu_optimize,
+            vae_tiling=self._cpu_optimize and self.config.vae_tiling,
+            prompt=prompt_doc['text'],
+            seed=self._seed(prompt_doc),
+            **inputs
+        )
+    
+    def _scheduler(self, name: str) -> Any:
+        """Scheduler instance for a scheduler name, sharing the model's noise schedule."""
+        if name not in self._schedulers:
+            self._schedulers[name] = build_scheduler(name, self._schedulers["default"])
+            logger.info(f"Created {type(self._schedulers[name]).__name__} for scheduler {name}")
+        return self._schedulers[name]
+    
+    def _reuse_result(self, prompt_doc: Dict, image_url: str) -> GenerationResult:
+        """Complete a prompt with an image that is already stored."""
+        self._update_success_status(prompt_doc, image_url)
+        return GenerationResult(
+            prompt_id=str(prompt_doc['_id']),
+            prompt=prompt_doc['text'],
+            image_url=image_url
+        )
+    
+    @staticmethod
+    def _seed(prompt_doc: Dict) -> Optional[int]:
+        """Seed requested by a prompt document, if any."""
+        seed = prompt_doc.get("seed")
+        return None if seed is None else int(seed)
+    
+    def _group_by_params(self, pending: List[Dict]) -> Dict[GenerationParams, List[Dict]]:
+        """Group prompt documents by their generation parameters."""
+        groups: Dict[GenerationParams, List[Dict]] = {}
+        for prompt_doc in pending:
+            try:
+                params = GenerationParams.from_document(prompt_doc, self.config)
+                self._seed(prompt_doc)
+            except (TypeError, ValueError) as e:
+                logger.error(f"Invalid generation parameters for prompt {prompt_doc['_id']}: {str(e)}")
+                self._update_error_status(prompt_doc, f"Invalid generation parameters: {str(e)}")
+                continue
+            groups.setdefault(params, []).append(prompt_doc)
+        return groups
+    
+    def _sub_batch_size(self, params: GenerationParams) -> int:
+        """Number of prompts per pipeline call, bounded by ``max_batch_pixels``."""
+        by_memory = self.config.max_batch_pixels // (params.width * params.height)
+        return max(1, min(self.config.generation_batch_size, by_memory))
+    
+    @staticmethod
+    def _chunk(items: List[Dict], size: int) -> List[List[Dict]]:
+        """Split a list into consecutive chunks of at most ``size`` items."""
+        return [items[i:i + size] for i in range(0, len(items), size)]
+    
+    def claim_pending(self) -> List[Dict]:
+        """Claim up to ``batch_size`` pending prompts.
+        
+        With leases enabled the prompts are moved to ``processing`` under this
+        worker's lease, so concurrent workers never pick the same prompt.
+        With priority scheduling the batch is chosen by the
+        ``FairShareScheduler`` instead of in ``_id`` order, and holds prompts
+        of a single priority class.
+        """
+        collection = self.db[self.config.collection_name]
+        query = {"status": "pending"}
+        
+        if self.scheduler:
+            return self._claim_scheduled(collection, query)
+        
+        if not self.lease:
+            return list(collection.find(query).limit(self.config.batch_size))
+        
+        self.lease.reclaim_expired(query)
+        return self.lease.claim_next(query, self.config.batch_size)
+    
+    def _claim_scheduled(self, collection: Any, query: Dict) -> List[Dict]:
+        """Claim the prompts the scheduler selects, in service order."""
+        if self.lease:
+            self.lease.reclaim_expired(query)
+            selected = self.scheduler.select(self.lease.claimable_query(query), self.config.batch_size)
+            claimed = self.lease.claim([doc['_id'] for doc in selected], query)
+        else:
+            selected = self.scheduler.select(query, self.config.batch_size)
+            claimed = list(collection.find({**query, "_id": {"$in": [doc['_id'] for doc in selected]}}))
+        
+        by_id = {doc['_id']: doc for doc in claimed}
+        served = [doc for doc in selected if doc['_id'] in by_id]
+        self.scheduler.commit(served)
+        return [by_id[doc['_id']] for doc in served]
     
-    async def _process_single_prompt(self, prompt_doc: Dict) -> Optional[GenerationResult]:
-        """Process a single prompt document."""
+    async def _encode(self, image: Image.Image) -> bytes:
+        """Encode an image in the encoder process pool.
+        
+        The recorded encode latency includes waiting for a free encoder.
+        """
+        loop = asyncio.get_running_loop()
+        with METRICS.timer("encode"):
+            return await loop.run_in_executor(
+                self._encode_executor,
+                encode_image,
+                image,
+                self.config.image_format
+            )
+    
+    async def _store_result(self, prompt_doc: Dict, data: bytes) -> Optional[GenerationResult]:
+        """Upload an encoded image and record the result for its prompt."""
         try:
             prompt_id = str(prompt_doc['_id'])
             prompt_text = prompt_doc['text']
             
-            logger.info(f"Processing prompt: {prompt_text[:50]}...")
-            
-            # Generate image
-            image = await self._generate_image(prompt_text)
-            
-            # Upload to GCS
-            filename = f"{prompt_id}_{int(datetime.now().timestamp())}.png"
-            gcs_url = self.storage.upload_image(image, filename)
+            # Upload to storage on the upload thread pool
+            extension = self.config.image_format.lower()
+            filename = f"{prompt_id}_{int(datetime.now().timestamp())}.{extension}"
+            loop = asyncio.get_running_loop()
+            with METRICS.timer("upload"):
+                gcs_url = await loop.run_in_executor(
+                    self._upload_executor,
+                    self.storage.upload_bytes,
+                    data,
+                    filename,
+                    CONTENT_TYPES[self.config.image_format]
+                )
             
             # Update MongoDB
-            self._update_success_status(prompt_id, gcs_url)
+            self._update_success_status(prompt_doc, gcs_url)
             
             return GenerationResult(
                 prompt_id=prompt_id,
@@ -111,79 +539,116 @@ class ImageGenerator:
             
         except Exception as e:
             logger.error(f"Failed to process prompt {prompt_doc['_id']}: {str(e)}")
-            self._update_error_status(prompt_doc['_id'], str(e))
+            self._update_error_status(prompt_doc, str(e))
             return None
     
-    async def _generate_image(self, prompt: str) -> Image.Image:
-        """Generate image from text prompt."""
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(
-            None,
-            lambda: self.model(
-                prompt,
-                num_inference_steps=self.config.num_inference_steps
-            )["images"][0]
-        )
+    async def _generate_images(self, prompts: List[str], params: GenerationParams,
+                               seeds: Optional[List[Optional[int]]] = None) -> List[Image.Image]:
+        """Generate one image per prompt in a single pipeline call.
+        
+        Prompts with a seed get their own seeded generator so the result is
+        reproducible. If the batch runs out of memory it is split in half
+        and retried.
+        """
+        seeds = seeds or [None] * len(prompts)
+        generators = None
+        if any(seed is not None for seed in seeds):
+            generators = []
+            for seed in seeds:
+                generator = torch.Generator(device=self.config.device)
+                if seed is None:
+                    generator.seed()
+                else:
+                    generator.manual_seed(seed)
+                generators.append(generator)
+        
+        scheduler = self._scheduler(params.scheduler)
+        
+        def generate() -> List[Image.Image]:
+            # Batches share one scheduler and run one at a time on this thread
+            self.model.scheduler = scheduler
+            if self.profiler:
+                self.profiler.start()
+            step_timer = StepTimer()
+            with METRICS.timer("generate"):
+                images = self.model(
+                    prompts,
+                    num_inference_steps=params.num_inference_steps,
+                    width=params.width,
+                    height=params.height,
+                    guidance_scale=params.guidance_scale,
+                    generator=generators,
+                    callback_on_step_end=step_timer
+                )["images"]
+            if self.profiler:
+                self.profiler.step()
+            logger.info(f"Generated {len(prompts)} images: {step_timer.summary()}")
+            return images
+        
+        logger.info(f"Generating {len(prompts)} images ({params})")
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self._generation_executor, generate)
+        except RuntimeError as e:
+            if len(prompts) == 1 or "out of memory" not in str(e).lower():
+                raise
+            logger.warning(f"Out of memory generating {len(prompts)} images, splitting batch")
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            half = len(prompts) // 2
+            return (
+                await self._generate_images(prompts[:half], params, seeds[:half])
+                + await self._generate_images(prompts[half:], params, seeds[half:])
+            )
     
-    def _update_success_status(self, prompt_id: str, image_url: str) -> None:
-        """Update document status after successful processing."""
-        self.db[self.config.collection_name].update_one(
-            {"_id": prompt_id},
+    def _update_success_status(self, prompt_doc: Dict[str, Any], image_url: str) -> None:
+        """Queue a status update after successful processing.
+        
+        Claimed prompts are only updated while this worker still holds
+        their lease.
+        """
+        self.writer.update_one(
+            owned_filter(prompt_doc),
             {
                 "$set": {
                     "status": "completed",
                     "image_url": image_url,
                     "completed_at": datetime.utcnow()
-                }
+                },
+                "$unset": LEASE_FIELDS
             }
         )
-        logger.info(f"Updated status for prompt {prompt_id}: completed")
+        METRICS.inc("prompts_total", status="completed")
+        logger.info(f"Queued status update for prompt {prompt_doc['_id']}: completed")
     
-    def _update_error_status(self, prompt_id: str, error: str) -> None:
-        """Update document status after processing error."""
-        self.db[self.config.collection_name].update_one(
-            {"_id": prompt_id},
+    def _update_error_status(self, prompt_doc: Dict[str, Any], error: str) -> None:
+        """Queue a status update after processing error."""
+        self.writer.update_one(
+            owned_filter(prompt_doc),
             {
                 "$set": {
                     "status": "error",
                     "error": error,
                     "error_at": datetime.utcnow()
-                }
+                },
+                "$unset": LEASE_FIELDS
             }
         )
-        logger.error(f"Updated status for prompt {prompt_id}: error")
-    
-    async def _send_callback(self, results: List[GenerationResult]) -> None:
-        """Send callback with results if URL is configured."""
-        if not self.config.callback_url:
-            return
-            
-        try:
-            data = {
-                "results": [
-                    {
-                        "prompt_id": r.prompt_id,
-                        "prompt": r.prompt,
-                        "image_url": r.image_url
-                    }
-                    for r in results
-                ]
-            }
-            
-            response = requests.post(
-                self.config.callback_url,
-                json=data,
-                timeout=self.config.callback_timeout
-            )
-            response.raise_for_status()
-            logger.info(f"Callback sent successfully to {self.config.callback_url}")
-            
-        except Exception as e:
-            logger.error(f"Callback failed: {str(e)}")
+        METRICS.inc("prompts_total", status="error")
+        logger.error(f"Queued status update for prompt {prompt_doc['_id']}: error")
     
     def cleanup(self) -> None:
         """Clean up resources."""
         try:
+            if self.profiler:
+                # Write what was recorded when there were fewer batches than requested
+                self._generation_executor.submit(self.profiler.stop).result()
+            self._generation_executor.shutdown(wait=True)
+            self._encode_executor.shutdown(wait=True)
+            self._upload_executor.shutdown(wait=True)
+            self.writer.close()
+            if self.callbacks is not None:
+                self.callbacks.close()
             self.mongo_client.close()
             logger.info("Cleaned up resources")
         except Exception as e:
@@ -0,0 +1,77 @@
+"""Named generation profiles and the schedulers they can select."""
+from typing import Any, Dict, Optional
+
+# Scheduler names accepted in the configuration and in prompt documents,
+# mapped to diffusers scheduler classes. "default" keeps the scheduler the
+# pipeline was loaded with.
+SCHEDULERS: Dict[str, Optional[str]] = {
+    "default": None,
+    "dpm++": "DPMSolverMultistepScheduler",
+    "euler": "EulerDiscreteScheduler",
+    "euler_a": "EulerAncestralDiscreteScheduler",
+    "ddim": "DDIMScheduler",
+}
+
+# Keyword arguments passed to ``from_config`` when building a scheduler
+SCHEDULER_OPTIONS: Dict[str, Dict[str, Any]] = {
+    "dpm++": {"algorithm_type": "dpmsolver++", "solver_order": 2},
+}
+
+# Generation presets; fields a profile leaves out keep their configured value.
+# DPM-Solver++ and Euler converge in 15-25 steps where the default
+# PNDM scheduler needs about 50, and CPU time grows linearly with steps.
+GENERATION_PROFILES: Dict[str, Dict[str, Any]] = {
+    "fast": {"scheduler": "dpm++", "num_inference_steps": 15},
+    "balanced": {"scheduler": "dpm++", "num_inference_steps": 25},
+    "euler": {"scheduler": "euler", "num_inference_steps": 20},
+    "preview": {"scheduler": "dpm++", "num_inference_steps": 15,
+                "width": 384, "height": 384, "guidance_scale": 6.0},
+    "quality": {"scheduler": "default", "num_inference_steps": 50},
+}
+
+def get_profile(name: str) -> Dict[str, Any]:
+    """
+    Look up a generation profile by name.
+
+    Args:
+        name: Profile name
+
+    Returns:
+        Generation parameters set by the profile
+
+    Raises:
+        ValueError: If the profile does not exist
+    """
+    try:
+        return GENERATION_PROFILES[name]
+    except KeyError:
+        raise ValueError(
+            f"Unknown generation profile {name!r}, expected one of: {', '.join(GENERATION_PROFILES)}"
+        ) from None
+
+def check_scheduler(name: str) -> str:
+    """
+    Validate a scheduler name.
+
+    Raises:
+        ValueError: If the scheduler is not supported
+    """
+    if name not in SCHEDULERS:
+        raise ValueError(f"Unknown scheduler {name!r}, expected one of: {', '.join(SCHEDULERS)}")
+    return name
+
+def build_scheduler(name: str, base: Any) -> Any:
+    """
+    Create scheduler ``name`` from the configuration of the loaded scheduler.
+
+    Args:
+        name: Scheduler name other than ``default``
+        base: Scheduler the pipeline was loaded with
+
+    Returns:
+        New scheduler sharing the model's noise schedule
+    """
+    import diffusers
+
+    scheduler_class = getattr(diffusers, SCHEDULERS[name])
+    return scheduler_class.from_config(base.config, **SCHEDULER_OPTIONS.get(name, {}))
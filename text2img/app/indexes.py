@@ -0,0 +1,117 @@
+"""MongoDB index management for the prompt queue."""
+import logging
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.collection import Collection
+from pymongo.errors import PyMongoError
+
+logger = logging.getLogger(__name__)
+
+PROMPT_INDEXES = [
+    # Pending-prompt queries in claim order
+    IndexModel(
+        [("status", ASCENDING), ("_id", ASCENDING)],
+        name="status_id"
+    ),
+    # Priority scheduling: highest-priority pending prompts per dataset
+    IndexModel(
+        [("status", ASCENDING), ("dataset_id", ASCENDING), ("priority", DESCENDING), ("_id", ASCENDING)],
+        name="status_dataset_id_priority_id"
+    ),
+    # Lease expiry, renewal and claim read-back
+    IndexModel(
+        [("lease_expires_at", ASCENDING)],
+        name="processing_lease_expires_at",
+        partialFilterExpression={"status": "processing"}
+    ),
+    IndexModel(
+        [("worker_id", ASCENDING)],
+        name="processing_worker_id",
+        partialFilterExpression={"status": "processing"}
+    ),
+    IndexModel(
+        [("lease_token", ASCENDING)],
+        name="lease_token",
+        sparse=True
+    ),
+]
+
+def ensure_indexes(collection: Collection) -> List[str]:
+    """
+    Create the indexes backing the pending-prompt queries.
+    
+    Index creation is idempotent, so this is safe to run on every startup.
+    
+    Args:
+        collection: Prompt collection
+        
+    Returns:
+        Names of the indexes that were ensured
+    """
+    names = collection.create_indexes(PROMPT_INDEXES)
+    logger.info(f"Ensured indexes on {collection.name}: {', '.join(names)}")
+    return names
+
+def _plan_stages(plan: Dict[str, Any]) -> Iterator[str]:
+    """Yield every stage name in an explain plan tree."""
+    yield plan.get("stage", "")
+    if "inputStage" in plan:
+        yield from _plan_stages(plan["inputStage"])
+    for child in plan.get("inputStages", []):
+        yield from _plan_stages(child)
+
+def check_query_coverage(
+    collection: Collection,
+    query: Dict[str, Any],
+    sort: Optional[List] = None
+) -> bool:
+    """
+    Check that a query is served by an index rather than a collection scan.
+    
+    Logs a warning when the winning plan contains a COLLSCAN stage.
+    
+    Args:
+        collection: Collection to run the explain against
+        query: Query filter to check
+        sort: Optional sort specification used with the query
+        
+    Returns:
+        True if the query uses an index, False otherwise
+    """
+    cursor = collection.find(query)
+    if sort:
+        cursor = cursor.sort(sort)
+    
+    try:
+        winning_plan = cursor.explain()["queryPlanner"]["winningPlan"]
+    except (PyMongoError, KeyError) as e:
+        logger.warning(f"Could not explain query on {collection.name}: {str(e)}")
+        return True
+    
+    # Slot-based engine plans nest the classic plan under "queryPlan"
+    winning_plan = winning_plan.get("queryPlan", winning_plan)
+    
+    if "COLLSCAN" in _plan_stages(winning_plan):
+        logger.warning(f"Query on {collection.name} is not covered by an index: {query}")
+        return False
+    return True
+
+def check_pending_queries(collection: Collection) -> bool:
+    """
+    Check index coverage of the hot pending-prompt queries.
+    
+    Args:
+        collection: Prompt collection
+        
+    Returns:
+        True if every query uses an index
+    """
+    return all([
+        check_query_coverage(collection, {"status": "pending"}, [("_id", ASCENDING)]),
+        check_query_coverage(
+            collection,
+            {"status": "processing", "lease_expires_at": {"$lt": datetime.utcnow()}}
+        ),
+    ])
@@ -0,0 +1,174 @@
+"""Lease-based claiming of pending work so several workers can share a collection."""
+import logging
+import os
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Sequence
+
+from pymongo import ASCENDING
+from pymongo.collection import Collection
+
+logger = logging.getLogger(__name__)
+
+LEASE_FIELDS = {"lease_token": "", "lease_expires_at": ""}
+
+def owned_filter(document: Dict[str, Any]) -> Dict[str, Any]:
+    """Filter matching ``document`` only while it is still held under its lease.
+
+    Documents claimed without a lease are matched by ``_id`` alone. A
+    completion write using this filter matches nothing once the lease has
+    expired and another worker has claimed the document.
+
+    Args:
+        document: Work document, with ``lease_token`` if it was claimed
+    """
+    if document.get("lease_token"):
+        return {"_id": document["_id"], "lease_token": document["lease_token"]}
+    return {"_id": document["_id"]}
+
+def default_worker_id() -> str:
+    """Build a worker ID that is unique per host and process."""
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+class WorkLease:
+    """Claims pending documents for one worker under an expiring lease.
+
+    Claimed documents move from ``pending`` to ``processing`` and carry the
+    worker ID, a per-claim token and a lease expiry. Documents whose lease
+    has expired are claimable again, so work held by a crashed worker is
+    picked up by the others.
+    """
+
+    def __init__(self, collection: Collection, worker_id: Optional[str] = None,
+                 lease_seconds: int = 900):
+        """Initialize the lease manager.
+
+        Args:
+            collection: Collection holding the work documents
+            worker_id: Identifier recorded on claimed documents
+            lease_seconds: How long a claim stays valid without renewal
+        """
+        self.collection = collection
+        self.worker_id = worker_id or default_worker_id()
+        self.lease_seconds = lease_seconds
+        self._last_renewal = time.monotonic()
+
+    def claimable_query(self, query: Dict[str, Any]) -> Dict[str, Any]:
+        """Turn a ``status: pending`` query into one matching claimable work.
+
+        Args:
+            query: Base query; any ``status`` condition is replaced
+        """
+        base = {k: v for k, v in query.items() if k != "status"}
+        return {
+            **base,
+            "$or": [
+                {"status": "pending"},
+                {"status": "processing", "lease_expires_at": {"$lt": datetime.utcnow()}}
+            ]
+        }
+
+    def claim(self, ids: Sequence[Any], query: Dict[str, Any],
+              projection: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """Atomically claim whichever of ``ids`` are still claimable.
+
+        Args:
+            ids: Candidate document IDs
+            query: Base query the documents must still match
+            projection: Fields to return for the claimed documents
+
+        Returns:
+            Claimed documents in ``_id`` order
+        """
+        if not ids:
+            return []
+
+        token = uuid.uuid4().hex
+        self.collection.update_many(
+            {**self.claimable_query(query), "_id": {"$in": list(ids)}},
+            {"$set": {
+                "status": "processing",
+                "worker_id": self.worker_id,
+                "lease_token": token,
+                "lease_expires_at": self._expiry()
+            }}
+        )
+        claimed = list(
+            self.collection.find({"lease_token": token}, projection).sort("_id", ASCENDING)
+        )
+        if len(claimed) < len(ids):
+            logger.debug(f"Claimed {len(claimed)}/{len(ids)} documents, rest taken by other workers")
+        return claimed
+
+    def claim_next(self, query: Dict[str, Any], limit: int,
+                   projection: Optional[Dict[str, Any]] = None,
+                   attempts: int = 3) -> List[Dict[str, Any]]:
+        """Claim up to ``limit`` of the oldest claimable documents.
+
+        Retries when every candidate was taken by a concurrent worker.
+
+        Args:
+            query: Base query selecting the work
+            limit: Maximum number of documents to claim
+            projection: Fields to return for the claimed documents
+            attempts: Number of candidate rounds to try
+        """
+        for _ in range(attempts):
+            candidates = self.collection.find(
+                self.claimable_query(query), {"_id": 1}
+            ).sort("_id", ASCENDING).limit(limit)
+            ids = [doc["_id"] for doc in candidates]
+            if not ids:
+                return []
+
+            claimed = self.claim(ids, query, projection)
+            if claimed:
+                return claimed
+        return []
+
+    def renew(self, force: bool = False) -> None:
+        """Extend this worker's outstanding leases.
+
+        Renewal is skipped unless a third of the lease period has passed
+        since the last one, so it is cheap to call after every batch.
+
+        Args:
+            force: Renew regardless of when the last renewal happened
+        """
+        if not force and time.monotonic() - self._last_renewal < self.lease_seconds / 3:
+            return
+
+        self.collection.update_many(
+            {"status": "processing", "worker_id": self.worker_id},
+            {"$set": {"lease_expires_at": self._expiry()}}
+        )
+        self._last_renewal = time.monotonic()
+
+    def reclaim_expired(self, query: Dict[str, Any], include_own: bool = False) -> int:
+        """Return documents with expired leases to the pending state.
+
+        Args:
+            query: Base query limiting which documents are reclaimed
+            include_own: Also reclaim unexpired claims held under this
+                worker ID, left behind by a previous run of the same worker
+
+        Returns:
+            Number of reclaimed documents
+        """
+        base = {k: v for k, v in query.items() if k != "status"}
+        stale = [{"lease_expires_at": {"$lt": datetime.utcnow()}}]
+        if include_own:
+            stale.append({"worker_id": self.worker_id})
+        result = self.collection.update_many(
+            {**base, "status": "processing", "$or": stale},
+            {"$set": {"status": "pending"}, "$unset": {**LEASE_FIELDS, "worker_id": ""}}
+        )
+        if result.modified_count:
+            logger.warning(f"Reclaimed {result.modified_count} documents with expired leases")
+        return result.modified_count
+
+    def _expiry(self) -> datetime:
+        """Lease expiry time for a claim made now."""
+        return datetime.utcnow() + timedelta(seconds=self.lease_seconds)
@@ -0,0 +1,88 @@
+"""Stable Diffusion pipeline loading from local caches and snapshots."""
+import logging
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+import torch
+from diffusers import StableDiffusionPipeline
+
+logger = logging.getLogger(__name__)
+
+def is_snapshot(path: Optional[str]) -> bool:
+    """Check whether ``path`` holds a complete saved pipeline snapshot."""
+    return bool(path) and (Path(path) / "model_index.json").is_file()
+
+def load_pipeline(model_id: str, device: str = "cpu",
+                  cache_dir: Optional[str] = None, offline: bool = False,
+                  snapshot_dir: Optional[str] = None,
+                  dtype: Optional[torch.dtype] = None) -> StableDiffusionPipeline:
+    """
+    Load a Stable Diffusion pipeline with as little copying as possible.
+
+    A snapshot written by ``save_snapshot`` is preferred when present and is
+    loaded from safetensors without touching the network. Otherwise weights
+    are resolved from ``cache_dir`` (or the default Hugging Face cache),
+    preferring safetensors files, which are memory-mapped instead of
+    unpickled, when the checkpoint ships them. ``low_cpu_mem_usage``
+    materialises each weight once rather than copying it over a randomly
+    initialised model.
+
+    Args:
+        model_id: Hub model ID or local pipeline directory
+        device: ``cuda`` or ``cpu``
+        cache_dir: Pre-populated Hugging Face cache directory
+        offline: Never contact the Hub; fail if the weights are not cached
+        snapshot_dir: Directory of a saved snapshot to load from if present
+        dtype: Weight dtype; defaults to float16 on CUDA and float32 on CPU
+
+    Returns:
+        Pipeline on ``device``, ready for inference
+    """
+    started = time.monotonic()
+    options: Dict[str, Any] = {
+        "torch_dtype": dtype or (torch.float16 if device == "cuda" else torch.float32),
+        "low_cpu_mem_usage": True,
+        "local_files_only": offline,
+    }
+    source = model_id
+    if is_snapshot(snapshot_dir):
+        source = snapshot_dir
+        options.update(local_files_only=True, use_safetensors=True)
+    elif cache_dir:
+        options["cache_dir"] = cache_dir
+
+    logger.info(f"Loading model: {source}")
+    pipeline = StableDiffusionPipeline.from_pretrained(source, **options)
+    pipeline.to(device)
+    logger.info(f"Model loaded on {device} in {time.monotonic() - started:.1f}s")
+    return pipeline
+
+def save_snapshot(pipeline: StableDiffusionPipeline, snapshot_dir: str) -> None:
+    """
+    Save a loaded pipeline as a safetensors snapshot.
+
+    The snapshot keeps the pipeline's dtype, so an fp16 pipeline is saved in
+    fp16. It is written to a temporary directory next to ``snapshot_dir``
+    and renamed into place, so a concurrent loader never sees a partial
+    snapshot.
+
+    Args:
+        pipeline: Loaded pipeline
+        snapshot_dir: Target directory, replaced if it exists
+    """
+    target = Path(snapshot_dir)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=target.parent, prefix=f".{target.name}-")
+    try:
+        pipeline.save_pretrained(tmp_dir, safe_serialization=True)
+        if target.exists():
+            shutil.rmtree(target)
+        os.replace(tmp_dir, target)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    logger.info(f"Saved pipeline snapshot to {target}")
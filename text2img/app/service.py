@@ -0,0 +1,153 @@
+"""Long-running generation service that keeps the pipeline resident."""
+import asyncio
+import logging
+import signal
+import threading
+from typing import Optional
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+from .config import Config
+from .core import ImageGenerator
+
+logger = logging.getLogger(__name__)
+
+# Change events that can make a prompt pending
+PENDING_CHANGES = [
+    {
+        "$match": {
+            "$or": [
+                {"operationType": {"$in": ["insert", "replace"]}, "fullDocument.status": "pending"},
+                {"operationType": "update", "updateDescription.updatedFields.status": "pending"},
+            ]
+        }
+    }
+]
+
+class GenerationService:
+    """Processes prompts continuously with a single resident model.
+
+    New work is picked up as soon as MongoDB reports it through a change
+    stream. On standalone servers, where change streams are unavailable,
+    the service polls with an interval that backs off while the queue is
+    empty and resets as soon as work is found.
+    """
+
+    def __init__(self, generator: ImageGenerator, config: Config):
+        """Initialize the service around an already loaded generator."""
+        self.generator = generator
+        self.config = config
+        self.batches = 0
+        self.processed = 0
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stop: Optional[asyncio.Event] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stopping = threading.Event()
+        self._watcher: Optional[threading.Thread] = None
+
+    async def run(self) -> None:
+        """Process prompts until stopped by SIGTERM/SIGINT or ``stop()``."""
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        self._wakeup = asyncio.Event()
+
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                self._loop.add_signal_handler(sig, self.stop)
+            except (NotImplementedError, RuntimeError):
+                # Signal handlers are unavailable on some platforms/threads
+                pass
+
+        if self.config.use_change_streams:
+            self._watcher = threading.Thread(
+                target=self._watch_changes,
+                name="text2img-change-stream",
+                daemon=True
+            )
+            self._watcher.start()
+
+        interval = self.config.poll_interval_min
+        logger.info("Generation service started")
+
+        try:
+            while not self._stop.is_set():
+                self._wakeup.clear()
+                try:
+                    found = await self._process_next()
+                except Exception as e:
+                    # Keep the daemon alive through transient MongoDB or
+                    # generation errors; retry after the poll interval
+                    logger.error(f"Error processing prompts, retrying in {interval:.1f}s: {str(e)}",
+                                 exc_info=True)
+                    found = False
+
+                if found:
+                    interval = self.config.poll_interval_min
+                    continue
+
+                await self._wait(interval)
+                interval = min(interval * 2, self.config.poll_interval_max)
+        finally:
+            self._stopping.set()
+            if self._watcher is not None:
+                self._watcher.join(timeout=5)
+            logger.info(
+                f"Generation service stopped after {self.batches} batches, "
+                f"{self.processed} images"
+            )
+
+    async def _process_next(self) -> bool:
+        """Claim and process one batch of prompts.
+
+        Returns:
+            Whether any prompts were processed
+        """
+        writer = self.generator.writer
+        # Status updates of the last batch that failed to write are retried
+        # first: until they are written those prompts still look pending
+        # (or leased) and would be generated again
+        writer.flush()
+        if writer.pending:
+            logger.warning(f"{writer.pending} status updates not yet written, not claiming new prompts")
+            return False
+
+        pending = self.generator.claim_pending()
+        if not pending:
+            return False
+
+        # Prompts already claimed are always finished, even when a
+        # shutdown was requested meanwhile
+        results = await self.generator.process_prompts(pending)
+        writer.flush()
+        self.batches += 1
+        self.processed += len(results)
+        return True
+
+    def stop(self) -> None:
+        """Request a graceful shutdown after the in-flight batch."""
+        if self._stop is not None and not self._stop.is_set():
+            logger.info("Shutdown requested, draining in-flight prompts")
+            self._stop.set()
+            self._wakeup.set()
+
+    async def _wait(self, timeout: float) -> None:
+        """Sleep until new work is signalled, shutdown, or ``timeout``."""
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def _watch_changes(self) -> None:
+        """Wake the main loop whenever a prompt becomes pending."""
+        collection = self.generator.db[self.config.collection_name]
+        try:
+            with collection.watch(PENDING_CHANGES, max_await_time_ms=1000) as stream:
+                logger.info("Watching prompt collection for changes")
+                while not self._stopping.is_set():
+                    if stream.try_next() is not None:
+                        self._loop.call_soon_threadsafe(self._wakeup.set)
+        except OperationFailure as e:
+            logger.warning(f"Change streams unavailable, falling back to polling: {str(e)}")
+        except PyMongoError as e:
+            logger.error(f"Change stream failed, falling back to polling: {str(e)}")
@@ -1,108 +1,280 @@
-"""Google Cloud Storage operations for image storage."""
+"""Image storage with pluggable GCS, local filesystem and S3 backends."""
+import hashlib
 import io
+import os
+import tempfile
+from abc import ABC, abstractmethod
 from typing import Optional
 from pathlib import Path
 import logging
 
-from google.cloud import storage
-from google.cloud.storage import Blob, Bucket
 from PIL import Image
 
 from .config import Config
 
 logger = logging.getLogger(__name__)
 
+CONTENT_TYPES = {
+    "PNG": "image/png",
+    "WEBP": "image/webp",
+}
+
+def encode_image(image: Image.Image, image_format: str = "PNG") -> bytes:
+    """
+    Encode an image to bytes.
+
+    Kept at module level so it can run in a process pool.
+
+    Args:
+        image: PIL Image to encode
+        image_format: Output format, PNG or WEBP
+
+    Returns:
+        Encoded image data
+    """
+    img_byte_arr = io.BytesIO()
+    if image_format == "WEBP":
+        image.save(img_byte_arr, format=image_format, lossless=True)
+    else:
+        image.save(img_byte_arr, format=image_format)
+    return img_byte_arr.getvalue()
+
+class StorageBackend(ABC):
+    """Object store that images are written to."""
+
+    @abstractmethod
+    def write(self, key: str, data: bytes, content_type: str) -> str:
+        """
+        Store data under a key.
+
+        Args:
+            key: Object key, relative to the backend root
+            data: Object contents
+            content_type: MIME type of the data
+
+        Returns:
+            URL of the stored object
+        """
+
+    @abstractmethod
+    def read(self, url: str) -> Optional[bytes]:
+        """Return the contents of a stored object, or None if it does not exist."""
+
+    @abstractmethod
+    def delete(self, url: str) -> bool:
+        """Delete a stored object, returning False if it did not exist."""
+
+class GCSBackend(StorageBackend):
+    """Google Cloud Storage bucket."""
+
+    def __init__(self, bucket: str):
+        """Initialize GCS client and bucket."""
+        from google.cloud import storage
+
+        self.bucket_name = bucket
+        self.client = storage.Client()
+        self.bucket = self.client.bucket(bucket)
+        logger.info(f"Initialized GCS connection to bucket: {bucket}")
+
+    def _key(self, url: str) -> str:
+        return url.replace(f"gs://{self.bucket_name}/", "")
+
+    def write(self, key: str, data: bytes, content_type: str) -> str:
+        blob = self.bucket.blob(key)
+        blob.upload_from_string(data, content_type=content_type, timeout=30)
+        return f"gs://{self.bucket_name}/{key}"
+
+    def read(self, url: str) -> Optional[bytes]:
+        blob = self.bucket.blob(self._key(url))
+        return blob.download_as_bytes() if blob.exists() else None
+
+    def delete(self, url: str) -> bool:
+        blob = self.bucket.blob(self._key(url))
+        if not blob.exists():
+            return False
+        blob.delete()
+        return True
+
+class LocalBackend(StorageBackend):
+    """
+    Directory on a local or network filesystem.
+
+    Files are spread over two levels of hash-named subdirectories so that no
+    single directory grows too large, and are written to a temporary file
+    and renamed into place so readers never see partial images. Files get
+    the usual ``0o666 & ~umask`` permissions rather than the owner-only mode
+    of temporary files, so other users and services can read them.
+    """
+
+    def __init__(self, root: str, shard_depth: int = 2):
+        """Initialize the output directory."""
+        self.root = Path(root).resolve()
+        self.shard_depth = shard_depth
+        self.root.mkdir(parents=True, exist_ok=True)
+        # os.umask can only be read by setting it, so read it once here
+        umask = os.umask(0)
+        os.umask(umask)
+        self.file_mode = 0o666 & ~umask
+        logger.info(f"Initialized local storage in: {self.root}")
+
+    def _path(self, key: str) -> Path:
+        key_path = Path(key)
+        digest = hashlib.sha1(key_path.name.encode()).hexdigest()
+        shards = [digest[2 * i:2 * i + 2] for i in range(self.shard_depth)]
+        return self.root.joinpath(key_path.parent, *shards, key_path.name)
+
+    def _from_url(self, url: str) -> Path:
+        return Path(url[len("file://"):]) if url.startswith("file://") else Path(url)
+
+    def write(self, key: str, data: bytes, content_type: str) -> str:
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                os.fchmod(f.fileno(), self.file_mode)
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+        return path.as_uri()
+
+    def read(self, url: str) -> Optional[bytes]:
+        path = self._from_url(url)
+        return path.read_bytes() if path.exists() else None
+
+    def delete(self, url: str) -> bool:
+        path = self._from_url(url)
+        if not path.exists():
+            return False
+        path.unlink()
+        return True
+
+class S3Backend(StorageBackend):
+    """Amazon S3 or any S3-compatible object store (MinIO, Ceph, ...)."""
+
+    def __init__(self, bucket: str, endpoint_url: Optional[str] = None):
+        """Initialize the S3 client."""
+        try:
+            import boto3
+        except ImportError as e:
+            raise ImportError("The S3 storage backend requires boto3 (pip install boto3)") from e
+
+        self.bucket = bucket
+        self.client = boto3.client("s3", endpoint_url=endpoint_url)
+        logger.info(f"Initialized S3 connection to bucket: {bucket}")
+
+    def _key(self, url: str) -> str:
+        return url.replace(f"s3://{self.bucket}/", "")
+
+    def write(self, key: str, data: bytes, content_type: str) -> str:
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=data, ContentType=content_type)
+        return f"s3://{self.bucket}/{key}"
+
+    def read(self, url: str) -> Optional[bytes]:
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=self._key(url))["Body"].read()
+        except self.client.exceptions.NoSuchKey:
+            return None
+
+    def delete(self, url: str) -> bool:
+        key = self._key(url)
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+        except self.client.exceptions.ClientError:
+            return False
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+        return True
+
+def create_backend(config: Config) -> StorageBackend:
+    """Create the storage backend selected by ``config.storage_backend``."""
+    if config.storage_backend == "gcs":
+        return GCSBackend(config.gcs_bucket)
+    if config.storage_backend == "local":
+        return LocalBackend(config.local_output_dir)
+    if config.storage_backend == "s3":
+        return S3Backend(config.s3_bucket, config.s3_endpoint_url)
+    raise ValueError(f"Unknown storage backend: {config.storage_backend}")
+
 class StorageManager:
-    """Handles Google Cloud Storage operations."""
-    
+    """Handles image storage operations on the configured backend."""
+
     def __init__(self, config: Config):
-        """Initialize GCS client and bucket."""
+        """Initialize the configured storage backend."""
         self.config = config
-        self.client = storage.Client()
-        self.bucket = self.client.bucket(config.gcs_bucket)
-        logger.info(f"Initialized GCS connection to bucket: {config.gcs_bucket}")
-    
+        self.backend = create_backend(config)
+
     def upload_image(self, image: Image.Image, filename: str) -> str:
         """
-        Upload an image to GCS and return its URL.
-        
+        Encode an image as PNG, upload it and return its URL.
+
         Args:
             image: PIL Image to upload
-            filename: Desired filename in GCS
-        
+            filename: Desired filename
+
         Returns:
-            GCS URL for the uploaded image
+            URL for the uploaded image
+        """
+        return self.upload_bytes(encode_image(image), filename, CONTENT_TYPES["PNG"])
+
+    def upload_bytes(self, data: bytes, filename: str, content_type: str) -> str:
+        """
+        Upload already encoded image data and return its URL.
+
+        Args:
+            data: Encoded image data
+            filename: Desired filename
+            content_type: MIME type of the data
+
+        Returns:
+            URL for the uploaded image
         """
         try:
-            # Convert image to bytes
-            img_byte_arr = io.BytesIO()
-            image.save(img_byte_arr, format='PNG')
-            img_byte_arr.seek(0)
-            
-            # Construct blob path
-            blob_path = f"{self.config.gcs_prefix}/{filename}"
-            blob: Blob = self.bucket.blob(blob_path)
-            
-            # Upload with content type
-            blob.upload_from_file(
-                img_byte_arr,
-                content_type='image/png',
-                timeout=30
-            )
-            
-            url = f"gs://{self.config.gcs_bucket}/{blob_path}"
+            url = self.backend.write(f"{self.config.gcs_prefix}/{filename}", data, content_type)
             logger.info(f"Uploaded image to: {url}")
             return url
-            
+
         except Exception as e:
             logger.error(f"Failed to upload image {filename}: {str(e)}")
             raise
-    
+
     def delete_image(self, url: str) -> None:
         """
-        Delete an image from GCS.
-        
+        Delete a stored image.
+
         Args:
-            url: GCS URL of the image to delete
+            url: URL of the image to delete
         """
         try:
-            # Extract blob path from URL
-            path = url.replace(f"gs://{self.config.gcs_bucket}/", "")
-            blob: Blob = self.bucket.blob(path)
-            
-            # Delete if exists
-            if blob.exists():
-                blob.delete()
+            if self.backend.delete(url):
                 logger.info(f"Deleted image: {url}")
             else:
                 logger.warning(f"Image not found: {url}")
-                
+
         except Exception as e:
             logger.error(f"Failed to delete image {url}: {str(e)}")
             raise
-    
+
     def get_image_data(self, url: str) -> Optional[bytes]:
         """
-        Retrieve image data from GCS.
-        
+        Retrieve stored image data.
+
         Args:
-            url: GCS URL of the image
-            
+            url: URL of the image
+
         Returns:
             Image data as bytes, or None if not found
         """
         try:
-            # Extract blob path from URL
-            path = url.replace(f"gs://{self.config.gcs_bucket}/", "")
-            blob: Blob = self.bucket.blob(path)
-            
-            # Download if exists
-            if blob.exists():
-                return blob.download_as_bytes()
-            else:
+            data = self.backend.read(url)
+            if data is None:
                 logger.warning(f"Image not found: {url}")
-                return None
-                
+            return data
+
         except Exception as e:
             logger.error(f"Failed to retrieve image {url}: {str(e)}")
-            raise
\ No newline at end of file
+            raise
@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+"""
+Text-to-Image Benchmark
+Generates images for synthetic prompts end to end, against mongomock (or a
+real MongoDB) and the local storage backend, and reports throughput,
+per-stage latency, peak memory and MongoDB round trips as JSON.
+"""
+import argparse
+import asyncio
+import functools
+import inspect
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import ExitStack, contextmanager
+from dataclasses import asdict
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List
+from unittest import mock
+
+import numpy as np
+
+from app.generation_profiles import GENERATION_PROFILES, SCHEDULERS
+from app.utils import setup_logging
+
+logger = logging.getLogger(__name__)
+
+MOCK_MONGO_URI = "mongodb://localhost:27017"
+
+MONGO_METHODS = (
+    "find", "find_one", "find_one_and_update", "update_one", "update_many",
+    "insert_one", "insert_many", "bulk_write", "aggregate", "count_documents",
+    "delete_one", "delete_many", "replace_one", "create_index", "create_indexes",
+)
+
+SUBJECTS = ["cat", "lighthouse", "robot", "forest", "city street", "teapot", "mountain lake", "violin"]
+STYLES = ["oil painting", "photograph", "watercolor", "pencil sketch", "isometric render"]
+SETTINGS = ["at sunset", "in the rain", "under a starry sky", "in spring", "at dawn", "in fog"]
+
+def create_synthetic_prompts(count: int, seed: int = 0) -> List[str]:
+    """Return ``count`` distinct prompts built from a small vocabulary."""
+    rng = random.Random(seed)
+    return [
+        f"a {rng.choice(STYLES)} of a {rng.choice(SUBJECTS)} {rng.choice(SETTINGS)}, variation {i}"
+        for i in range(count)
+    ]
+
+def create_tiny_pipeline(directory: str) -> str:
+    """
+    Save a randomly initialised Stable Diffusion pipeline small enough to run anywhere.
+
+    Images are noise, but every stage of the pipeline runs, so the
+    benchmark needs neither network access nor a GPU.
+    """
+    from diffusers import AutoencoderKL, PNDMScheduler, StableDiffusionPipeline, UNet2DConditionModel
+    from transformers import CLIPTextConfig, CLIPTextModel, CLIPTokenizer
+
+    os.makedirs(directory, exist_ok=True)
+    vocab = {"<|startoftext|>": 0, "<|endoftext|>": 1, "!": 2}
+    for i, char in enumerate("abcdefghijklmnopqrstuvwxyz"):
+        vocab[char] = 3 + i
+        vocab[char + "</w>"] = 29 + i
+    vocab_file = os.path.join(directory, "vocab.json")
+    merges_file = os.path.join(directory, "merges.txt")
+    with open(vocab_file, "w") as f:
+        json.dump(vocab, f)
+    with open(merges_file, "w") as f:
+        f.write("#version: 0.2\n")
+
+    pipeline = StableDiffusionPipeline(
+        vae=AutoencoderKL(
+            block_out_channels=(16, 32), in_channels=3, out_channels=3,
+            down_block_types=("DownEncoderBlock2D", "DownEncoderBlock2D"),
+            up_block_types=("UpDecoderBlock2D", "UpDecoderBlock2D"),
+            latent_channels=4, norm_num_groups=8
+        ),
+        text_encoder=CLIPTextModel(CLIPTextConfig(
+            vocab_size=len(vocab), hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+            num_attention_heads=4, max_position_embeddings=77, projection_dim=32,
+            bos_token_id=0, eos_token_id=1, pad_token_id=1
+        )),
+        tokenizer=CLIPTokenizer(vocab_file, merges_file, model_max_length=77),
+        unet=UNet2DConditionModel(
+            sample_size=32, in_channels=4, out_channels=4, block_out_channels=(32, 64),
+            layers_per_block=1, down_block_types=("CrossAttnDownBlock2D", "DownBlock2D"),
+            up_block_types=("UpBlock2D", "CrossAttnUpBlock2D"), cross_attention_dim=32,
+            attention_head_dim=4, norm_num_groups=8
+        ),
+        scheduler=PNDMScheduler(skip_prk_steps=True),
+        safety_checker=None,
+        feature_extractor=None,
+        requires_safety_checker=False
+    )
+    pipeline.save_pretrained(directory, safe_serialization=True)
+    return directory
+
+class StageTimer:
+    """Collects wall-clock latencies of named pipeline stages."""
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.samples[stage].append(seconds)
+
+    @contextmanager
+    def wrap(self, owner: Any, name: str, stage: str) -> Iterator[None]:
+        """Time every call of ``owner.name`` (sync or async) as ``stage`` until the context exits."""
+        original = getattr(owner, name)
+
+        if inspect.iscoroutinefunction(original):
+            @functools.wraps(original)
+            async def timed(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await original(*args, **kwargs)
+                finally:
+                    self.record(stage, time.perf_counter() - started)
+        else:
+            @functools.wraps(original)
+            def timed(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return original(*args, **kwargs)
+                finally:
+                    self.record(stage, time.perf_counter() - started)
+
+        setattr(owner, name, timed)
+        try:
+            yield
+        finally:
+            if isinstance(owner, type):
+                setattr(owner, name, original)
+            else:
+                delattr(owner, name)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """Call count, total and p50/p95/p99 latency in milliseconds per stage."""
+        result = {}
+        for stage, samples in sorted(self.samples.items()):
+            ms = np.asarray(samples) * 1000
+            result[stage] = {
+                "calls": len(samples),
+                "total_ms": round(float(ms.sum()), 3),
+                "p50_ms": round(float(np.percentile(ms, 50)), 3),
+                "p95_ms": round(float(np.percentile(ms, 95)), 3),
+                "p99_ms": round(float(np.percentile(ms, 99)), 3),
+            }
+        return result
+
+class MongoCallCounter:
+    """
+    Counts MongoDB round trips by operation.
+
+    Real servers are observed through pymongo command monitoring. For
+    mongomock, which sends no commands, the public collection methods are
+    counted instead; calls made from inside another counted call are not.
+    """
+
+    def __init__(self):
+        self.counts: Counter = Counter()
+        self._local = threading.local()
+
+    def listener(self):
+        """Command listener to pass to ``pymongo.monitoring.register``."""
+        from pymongo import monitoring
+
+        counter = self
+
+        class Listener(monitoring.CommandListener):
+            def started(self, event):
+                if not getattr(counter._local, "depth", 0):
+                    counter.counts[event.command_name] += 1
+
+            def succeeded(self, event):
+                pass
+
+            def failed(self, event):
+                pass
+
+        return Listener()
+
+    @contextmanager
+    def patch_mongomock(self) -> Iterator[None]:
+        """Count calls to mongomock collection methods until the context exits."""
+        from mongomock.collection import Collection
+
+        originals = {name: getattr(Collection, name) for name in MONGO_METHODS}
+        for name, original in originals.items():
+            setattr(Collection, name, self._counted(name, original))
+        try:
+            yield
+        finally:
+            for name, original in originals.items():
+                setattr(Collection, name, original)
+
+    @contextmanager
+    def paused(self) -> Iterator[None]:
+        """Do not count calls made by the benchmark itself."""
+        depth = getattr(self._local, "depth", 0)
+        self._local.depth = depth + 1
+        try:
+            yield
+        finally:
+            self._local.depth = depth
+
+    def _counted(self, name: str, original: Callable) -> Callable:
+        @functools.wraps(original)
+        def counted(*args, **kwargs):
+            depth = getattr(self._local, "depth", 0)
+            if depth == 0:
+                self.counts[name] += 1
+            self._local.depth = depth + 1
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self._local.depth = depth
+        return counted
+
+def peak_rss_mb() -> Dict[str, float]:
+    """Peak resident set size of this process and of its finished children, in MB."""
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return {
+        "self": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1),
+        "children": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1),
+    }
+
+async def run_benchmark(args: argparse.Namespace) -> Dict[str, Any]:
+    """Generate images for synthetic prompts end to end and measure every stage."""
+    import pymongo
+
+    timer = StageTimer()
+    mongo_calls = MongoCallCounter()
+
+    with ExitStack() as stack:
+        workdir = stack.enter_context(tempfile.TemporaryDirectory(prefix="text2img-benchmark-"))
+        mongo_uri = args.mongo_uri
+        if mongo_uri:
+            pymongo.monitoring.register(mongo_calls.listener())
+        else:
+            try:
+                import mongomock
+            except ImportError:
+                raise SystemExit("mongomock is required without --mongo-uri: pip install mongomock")
+            stack.enter_context(mongomock.patch(servers=(("localhost", 27017),)))
+            # app.core binds MongoClient at import time
+            stack.enter_context(mock.patch("app.core.MongoClient", pymongo.MongoClient))
+            mongo_uri = MOCK_MONGO_URI
+
+        from app.config import Config
+        from app.core import GenerationParams, ImageGenerator
+        from app.metrics import METRICS
+
+        model_id = args.model_id
+        if args.tiny_model:
+            model_id = create_tiny_pipeline(os.path.join(workdir, "tiny-sd"))
+
+        collection_name = f"benchmark_{datetime.utcnow():%Y%m%d%H%M%S}"
+        config = Config(
+            mongo_uri=mongo_uri,
+            database_name=args.database,
+            collection_name=collection_name,
+            storage_backend="local",
+            local_output_dir=os.path.join(workdir, "output"),
+            model_id=model_id,
+            num_inference_steps=args.steps,
+            width=args.width,
+            height=args.height,
+            scheduler=args.scheduler,
+            generation_profile=args.generation_profile,
+            generation_batch_size=args.generation_batch_size,
+            cpu_optimize=args.cpu_optimize,
+            cpu_dtype=args.cpu_dtype,
+            vae_tiling=args.vae_tiling,
+            intra_op_threads=args.threads,
+            device="cpu" if args.cpu else Config.device,
+            offline=args.tiny_model,
+            batch_size=args.batch_size,
+            image_format=args.image_format,
+            encode_workers=args.encode_workers,
+            upload_concurrency=args.upload_concurrency,
+            cache_enabled=args.cache,
+            cache_collection_name=f"{collection_name}_cache",
+            ensure_indexes=bool(args.mongo_uri)
+        )
+        config.validate()
+
+        started = time.perf_counter()
+        generator = stack.enter_context(ImageGenerator(config))
+        load_seconds = time.perf_counter() - started
+
+        collection = generator.db[collection_name]
+        prompts = create_synthetic_prompts(args.warmup + args.prompts, args.seed)
+        
+        # Warm up the model and spawn the encoder processes outside the measurement
+        if args.warmup:
+            collection.insert_many([
+                {"text": prompt, "status": "pending", "seed": i}
+                for i, prompt in enumerate(prompts[:args.warmup])
+            ])
+            while collection.count_documents({"status": "pending"}):
+                await generator.process_pending_prompts()
+            generator.writer.flush()
+            collection.delete_many({})
+        
+        collection.insert_many([
+            {"text": prompt, "status": "pending", "seed": i}
+            for i, prompt in enumerate(prompts[args.warmup:], start=args.warmup)
+        ])
+        if not args.mongo_uri:
+            stack.enter_context(mongo_calls.patch_mongomock())
+        METRICS.reset()
+
+        stack.enter_context(timer.wrap(generator, "_generate_images", "generate"))
+        stack.enter_context(timer.wrap(generator, "_encode", "encode"))
+        stack.enter_context(timer.wrap(generator, "_store_result", "upload"))
+        stack.enter_context(timer.wrap(generator.writer.collection, "bulk_write", "mongo_write"))
+
+        started = time.perf_counter()
+        generated = 0
+        while True:
+            with mongo_calls.paused():
+                if not collection.count_documents({"status": "pending"}):
+                    break
+            generated += len(await generator.process_pending_prompts())
+        generator.writer.flush()
+        elapsed = time.perf_counter() - started
+        denoise_step = METRICS.to_dict()["stages"].get("denoise_step")
+
+        with mongo_calls.paused():
+            counts = {
+                status: collection.count_documents({"status": status})
+                for status in ("completed", "error", "pending", "processing")
+            }
+            generator.db.drop_collection(collection_name)
+            generator.db.drop_collection(config.cache_collection_name)
+
+    import diffusers
+    import torch
+
+    return {
+        "service": "text2img",
+        "timestamp": datetime.utcnow().isoformat(),
+        "environment": {
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "diffusers": diffusers.__version__,
+            "cpu_count": os.cpu_count(),
+            "device": config.device,
+            "mongo": "server" if args.mongo_uri else "mongomock",
+        },
+        "parameters": {
+            "prompts": args.prompts,
+            "warmup": args.warmup,
+            "model_id": "tiny-random-sd" if args.tiny_model else args.model_id,
+            "steps": args.steps,
+            "width": args.width,
+            "height": args.height,
+            "scheduler": args.scheduler,
+            "generation_profile": args.generation_profile,
+            "batch_size": args.batch_size,
+            "generation_batch_size": args.generation_batch_size,
+            "image_format": args.image_format,
+            "cache": args.cache,
+            "cpu_optimize": args.cpu_optimize,
+            "cpu_dtype": str(generator.model.unet.dtype),
+            "threads": torch.get_num_threads(),
+            # Parameters prompts were generated with, after applying the profile
+            "generation_params": asdict(GenerationParams.from_document({}, config)),
+        },
+        "counts": {**counts, "results": generated},
+        "model_load_seconds": round(load_seconds, 3),
+        "elapsed_seconds": round(elapsed, 3),
+        "images_per_second": round(counts["completed"] / elapsed, 3) if elapsed else 0.0,
+        "stages": timer.summary(),
+        # Latency of single denoising steps, interpolated from histogram buckets
+        "denoise_step": denoise_step,
+        "mongo_round_trips": {"total": sum(mongo_calls.counts.values()), **dict(mongo_calls.counts)},
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+async def main():
+    """Main entry point."""
+    parser = argparse.ArgumentParser(
+        description="Benchmark the Text-to-Image pipeline on synthetic prompts",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument("--prompts", type=int, default=20, help="Number of synthetic prompts")
+    parser.add_argument("--warmup", type=int, default=2, help="Prompts generated before measuring")
+    parser.add_argument("--mongo-uri", help="MongoDB to benchmark against (default: in-memory mongomock)")
+    parser.add_argument("--database", default="text2img_benchmark", help="Database used for the benchmark")
+    parser.add_argument("--model-id", default="runwayml/stable-diffusion-v1-5", help="Stable Diffusion model")
+    parser.add_argument("--tiny-model", action="store_true",
+                        help="Use a tiny randomly initialised pipeline instead of --model-id (no network)")
+    parser.add_argument("--cpu", action="store_true", help="Run on CPU even if a GPU is available")
+    parser.add_argument("--steps", type=int, default=20, help="Inference steps per image")
+    parser.add_argument("--width", type=int, default=512, help="Image width")
+    parser.add_argument("--height", type=int, default=512, help="Image height")
+    parser.add_argument("--scheduler", default="default", choices=list(SCHEDULERS), help="Scheduler")
+    parser.add_argument("--generation-profile", choices=list(GENERATION_PROFILES),
+                        help="Generation profile, overriding --steps, --scheduler and the image size it sets")
+    parser.add_argument("--cpu-optimize", action="store_true",
+                        help="Attention/VAE slicing and channels_last on CPU")
+    parser.add_argument("--cpu-dtype", default="float32", choices=["float32", "bfloat16"],
+                        help="Weight dtype with --cpu-optimize")
+    parser.add_argument("--vae-tiling", action="store_true", help="Decode images tile by tile with --cpu-optimize")
+    parser.add_argument("--threads", type=int, help="Torch intra-op threads with --cpu-optimize")
+    parser.add_argument("--batch-size", type=int, default=10, help="Prompts claimed per batch")
+    parser.add_argument("--generation-batch-size", type=int, default=4, help="Prompts per pipeline call")
+    parser.add_argument("--image-format", default="PNG", choices=["PNG", "WEBP"], help="Output encoding")
+    parser.add_argument("--encode-workers", type=int, default=2, help="Image encoding processes")
+    parser.add_argument("--upload-concurrency", type=int, default=4, help="Concurrent uploads")
+    parser.add_argument("--cache", action="store_true", help="Enable the result cache")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the synthetic prompts")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    parser.add_argument("--log-level", default="WARNING", help="Logging level")
+    args = parser.parse_args()
+
+    setup_logging(args.log_level)
+    report = await run_benchmark(args)
+
+    text = json.dumps(report, indent=2, default=str)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+        logger.warning(f"Benchmark report written to {args.output}")
+    else:
+        print(text)
+
+if __name__ == "__main__":
+    asyncio.run(main())
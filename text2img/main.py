@@ -2,16 +2,26 @@
 """
 Text-to-Image Generation Service
 Processes text prompts from MongoDB, generates images using Stable Diffusion,
-and stores them in Google Cloud Storage.
+and stores them in Google Cloud Storage, S3 or a local directory.
 """
 import argparse
 import asyncio
+import atexit
+import os
 import sys
 from pathlib import Path
 from datetime import datetime
 
+from pymongo import MongoClient
+
 from app.config import Config
 from app.core import ImageGenerator
+from app.generation_profiles import GENERATION_PROFILES, SCHEDULERS
+from app.indexes import check_pending_queries, ensure_indexes
+from app.metrics import METRICS
+from app.models import load_pipeline, save_snapshot
+from app.scheduler import parse_weights
+from app.service import GenerationService
 from app.utils import setup_logging, validate_mongo_uri, validate_gcs_bucket
 
 async def main():
@@ -24,27 +34,180 @@ async def main():
     
     parser.add_argument(
         "--mongo-uri",
-        required=True,
+        default=os.environ.get("MONGO_URI"),
         help="MongoDB connection URI (e.g., mongodb://localhost:27017/dbname)"
     )
     
+    parser.add_argument(
+        "--storage-backend",
+        choices=["gcs", "local", "s3"],
+        default=os.environ.get("STORAGE_BACKEND", "gcs"),
+        help="Where generated images are stored"
+    )
+    
     parser.add_argument(
         "--gcs-bucket",
-        required=True,
-        help="Google Cloud Storage bucket name"
+        default=os.environ.get("GCS_BUCKET"),
+        help="Google Cloud Storage bucket name (gcs backend)"
+    )
+    
+    parser.add_argument(
+        "--output-dir",
+        default=os.environ.get("LOCAL_OUTPUT_DIR", "output"),
+        help="Output directory (local backend)"
+    )
+    
+    parser.add_argument(
+        "--s3-bucket",
+        default=os.environ.get("S3_BUCKET"),
+        help="S3 bucket name (s3 backend)"
+    )
+    
+    parser.add_argument(
+        "--s3-endpoint-url",
+        default=os.environ.get("S3_ENDPOINT_URL"),
+        help="Endpoint URL for S3-compatible object stores"
+    )
+    
+    parser.add_argument(
+        "--model-cache-dir",
+        default=os.environ.get("MODEL_CACHE_DIR"),
+        help="Pre-populated Hugging Face cache to load the model from"
+    )
+    
+    parser.add_argument(
+        "--snapshot-dir",
+        default=os.environ.get("MODEL_SNAPSHOT_DIR"),
+        help="Pipeline snapshot to load instead of the model when present"
+    )
+    
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        default=os.environ.get("HF_HUB_OFFLINE", "false").lower() in ("1", "true"),
+        help="Never contact the Hugging Face Hub when loading the model"
+    )
+    
+    parser.add_argument(
+        "--save-snapshot",
+        metavar="DIR",
+        help="Load the model, save a ready-to-load pipeline snapshot to DIR and exit"
+    )
+    
+    parser.add_argument(
+        "--scheduler",
+        choices=list(SCHEDULERS),
+        default=os.environ.get("SCHEDULER", "default"),
+        help="Scheduler used when a prompt does not choose one"
+    )
+    
+    parser.add_argument(
+        "--generation-profile",
+        choices=list(GENERATION_PROFILES),
+        default=os.environ.get("GENERATION_PROFILE") or None,
+        help="Generation profile applied to prompts without their own settings"
+    )
+    
+    parser.add_argument(
+        "--cpu-optimize",
+        action="store_true",
+        default=os.environ.get("CPU_OPTIMIZE", "false").lower() == "true",
+        help="Use attention and VAE slicing and channels_last weights on CPU"
+    )
+    
+    parser.add_argument(
+        "--cpu-dtype",
+        choices=["float32", "bfloat16"],
+        default=os.environ.get("CPU_DTYPE", "float32"),
+        help="Weight dtype with --cpu-optimize; bfloat16 needs native CPU support"
+    )
+    
+    parser.add_argument(
+        "--vae-tiling",
+        action="store_true",
+        default=os.environ.get("VAE_TILING", "false").lower() == "true",
+        help="Decode images tile by tile with --cpu-optimize"
+    )
+    
+    parser.add_argument(
+        "--intra-op-threads",
+        type=int,
+        default=int(os.environ.get("INTRA_OP_THREADS", "0")) or None,
+        help="Torch intra-op threads with --cpu-optimize"
+    )
+    
+    parser.add_argument(
+        "--inter-op-threads",
+        type=int,
+        default=int(os.environ.get("INTER_OP_THREADS", "0")) or None,
+        help="Torch inter-op threads with --cpu-optimize"
+    )
+    
+    parser.add_argument(
+        "--priority-scheduling",
+        action="store_true",
+        default=os.environ.get("PRIORITY_SCHEDULING", "false").lower() == "true",
+        help="Claim prompts by priority and weighted fair share across datasets"
+    )
+    
+    parser.add_argument(
+        "--fair-share-weights",
+        default=os.environ.get("FAIR_SHARE_WEIGHTS"),
+        help="Per-dataset weights, e.g. interactive=4,backfill=1"
     )
     
     parser.add_argument(
         "--callback-url",
+        default=os.environ.get("CALLBACK_URL"),
         help="Optional callback URL for completion notifications"
     )
     
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=int(os.environ.get("METRICS_PORT", "0")) or None,
+        help="Serve Prometheus metrics on this port while running"
+    )
+    
+    parser.add_argument(
+        "--metrics-dump",
+        metavar="PATH",
+        default=os.environ.get("METRICS_DUMP"),
+        help="Write per-stage latency metrics as JSON to PATH at exit"
+    )
+    
+    parser.add_argument(
+        "--profile",
+        type=int,
+        metavar="N",
+        default=int(os.environ.get("PROFILE_BATCHES", "0")),
+        help="Profile the first N pipeline calls with torch.profiler"
+    )
+    
+    parser.add_argument(
+        "--profile-dir",
+        default=os.environ.get("PROFILE_DIR", "profiles"),
+        help="Directory profiler traces are written to"
+    )
+    
     parser.add_argument(
         "--log-file",
         type=Path,
         help="Optional log file path"
     )
     
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="Keep the model loaded and process new prompts until SIGTERM"
+    )
+    
+    parser.add_argument(
+        "--ensure-indexes",
+        action="store_true",
+        help="Create MongoDB indexes, check query coverage and exit"
+    )
+    
     parser.add_argument(
         "--log-level",
         default="INFO",
@@ -55,12 +218,33 @@ async def main():
     args = parser.parse_args()
 
     try:
+        # Build a pipeline snapshot, e.g. while building the container image
+        if args.save_snapshot:
+            logger = setup_logging(level=args.log_level, log_file=args.log_file)
+            pipeline = load_pipeline(
+                os.environ.get("MODEL_ID", Config.model_id),
+                device=Config.device,
+                cache_dir=args.model_cache_dir,
+                offline=args.offline
+            )
+            save_snapshot(pipeline, args.save_snapshot)
+            return
+        
         # Validate arguments
+        if not args.mongo_uri:
+            parser.error("--mongo-uri is required")
+        
         if not validate_mongo_uri(args.mongo_uri):
             parser.error("Invalid MongoDB URI format")
             
-        if not validate_gcs_bucket(args.gcs_bucket):
-            parser.error("Invalid GCS bucket name format")
+        if args.storage_backend == "gcs":
+            if not args.gcs_bucket:
+                parser.error("--gcs-bucket is required with the gcs storage backend")
+            if not validate_gcs_bucket(args.gcs_bucket):
+                parser.error("Invalid GCS bucket name format")
+        
+        if args.storage_backend == "s3" and not args.s3_bucket:
+            parser.error("--s3-bucket is required with the s3 storage backend")
         
         # Setup logging
         logger = setup_logging(
@@ -70,22 +254,63 @@ async def main():
         
         logger.info("Starting Text-to-Image Generation Service")
         logger.info(f"MongoDB URI: {args.mongo_uri}")
-        logger.info(f"GCS Bucket: {args.gcs_bucket}")
+        logger.info(f"Storage backend: {args.storage_backend}")
+        if args.gcs_bucket:
+            logger.info(f"GCS Bucket: {args.gcs_bucket}")
         
         if args.callback_url:
             logger.info(f"Callback URL: {args.callback_url}")
         
-        # Initialize configuration
+        # Initialize configuration from the environment and the command line
         config = Config.from_args(
             mongo_uri=args.mongo_uri,
             gcs_bucket=args.gcs_bucket,
-            callback_url=args.callback_url
+            callback_url=args.callback_url,
+            storage_backend=args.storage_backend,
+            local_output_dir=args.output_dir,
+            s3_bucket=args.s3_bucket,
+            s3_endpoint_url=args.s3_endpoint_url,
+            model_cache_dir=args.model_cache_dir,
+            model_snapshot_dir=args.snapshot_dir,
+            offline=args.offline,
+            metrics_port=args.metrics_port,
+            metrics_dump_path=args.metrics_dump,
+            profile_batches=args.profile,
+            profile_dir=args.profile_dir,
+            scheduler=args.scheduler,
+            generation_profile=args.generation_profile,
+            cpu_optimize=args.cpu_optimize,
+            cpu_dtype=args.cpu_dtype,
+            vae_tiling=args.vae_tiling,
+            intra_op_threads=args.intra_op_threads,
+            inter_op_threads=args.inter_op_threads,
+            priority_scheduling=args.priority_scheduling,
+            fair_share_weights=parse_weights(args.fair_share_weights)
         )
+        config.validate()
+        
+        if args.ensure_indexes:
+            with MongoClient(config.mongo_uri) as client:
+                collection = client[config.database_name][config.collection_name]
+                ensure_indexes(collection)
+                if not check_pending_queries(collection):
+                    sys.exit(1)
+            logger.info("Indexes ensured")
+            return
+        
+        if config.metrics_port:
+            METRICS.start_http_server(config.metrics_port)
+        if config.metrics_dump_path:
+            atexit.register(METRICS.dump, config.metrics_dump_path)
         
         # Process images
         start_time = datetime.now()
         
         with ImageGenerator(config) as generator:
+            if args.daemon:
+                await GenerationService(generator, config).run()
+                return
+            
             results = await generator.process_pending_prompts()
             
             duration = datetime.now() - start_time